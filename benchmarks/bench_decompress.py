@@ -0,0 +1,149 @@
+"""Times the decompression of synthetic installer payloads.
+
+A synthetic linux .run (see synthetic.py) is written for each compression,
+its libraries only partly random so they compress about as well as real
+ones, and every library is extracted from it with makeself.extract() in
+each CUDATOOLKIT_DECOMPRESS mode (see decompress.py):
+  inline - decompressed in the parsing thread
+  python - a Python thread decompresses
+  auto - a multi-threaded decompressor tool, where one is installed
+Results are written as JSON, e.g.
+
+    python benchmarks/bench_decompress.py --size-mb 256 -o decompress.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform as pyplatform
+import posixpath
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, os.pardir, 'scripts'))
+
+import decompress
+import makeself
+import synthetic
+
+MODES = ('inline', 'python', 'auto')
+COMPRESSIONS = {'gz': 'gzip', 'xz': 'xz', 'bz2': 'bzip2'}
+
+
+def compressible_bytes(size, seed, random_fraction):
+    """Returns size bytes of which about random_fraction is incompressible,
+    the rest repeats a short pattern as code and tables would.
+    """
+    rng = random.Random(seed)
+    pattern = rng.randbytes(64)
+    block = 4096
+    chunks = []
+    for i in range(0, size, block):
+        n = min(block, size - i)
+        if rng.random() < random_fraction:
+            chunks.append(rng.randbytes(n))
+        else:
+            chunks.append((pattern * (n // len(pattern) + 1))[:n])
+    return b''.join(chunks)
+
+
+def payload_files(total, nlibs, random_fraction):
+    size = total // nlibs
+    return [('pkg/lib64/libsynthetic%d.so.1' % i,
+             compressible_bytes(size, i, random_fraction))
+            for i in range(nlibs)]
+
+
+def _select(name):
+    return name if '/lib64/' in name else None
+
+
+def _descend(name):
+    return posixpath.basename(name).startswith('cuda-linux')
+
+
+def bench(path, mode, workdir, repeat):
+    """Returns the best of repeat extractions of every library from the
+    .run at path in the decompression mode
+    """
+    os.environ['CUDATOOLKIT_DECOMPRESS'] = mode
+    times = []
+    for i in range(repeat):
+        dest = os.path.join(workdir, 'out')
+        shutil.rmtree(dest, ignore_errors=True)
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            makeself.extract(path, dest, _select, _descend)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--compressions', nargs='+', default=['gz', 'xz'],
+                        choices=sorted(COMPRESSIONS))
+    parser.add_argument('--size-mb', type=float, default=64.0,
+                        help="uncompressed size of the libraries")
+    parser.add_argument('--libs', type=int, default=16,
+                        help="number of libraries")
+    parser.add_argument('--random-fraction', type=float, default=0.3,
+                        help="fraction of the library content that is "
+                        "incompressible")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('-o', '--output', default=None,
+                        help="write the JSON results here, default stdout")
+    args = parser.parse_args(argv)
+
+    total = int(args.size_mb * 1024 * 1024)
+    files = payload_files(total, args.libs, args.random_fraction)
+    results = []
+    workdir = tempfile.mkdtemp(prefix='cudatoolkit-bench-')
+    saved = os.environ.get('CUDATOOLKIT_DECOMPRESS')
+    try:
+        for compression in args.compressions:
+            path = os.path.join(workdir, 'synthetic-%s.run' % compression)
+            synthetic.write_linux_blob(path, files, compression)
+            tool = decompress.find_tool(COMPRESSIONS[compression])
+            for mode in MODES:
+                if mode == 'auto' and tool is None:
+                    continue
+                seconds = bench(path, mode, workdir, args.repeat)
+                result = {'compression': compression,
+                          'mode': mode,
+                          'tool': (os.path.basename(tool[0])
+                                   if mode == 'auto' else None),
+                          'blob_bytes': os.path.getsize(path),
+                          'seconds': seconds,
+                          'mb_per_s': total / seconds / 1e6}
+                print("%(compression)s %(mode)s: %(seconds).3fs, "
+                      "%(mb_per_s).1f MB/s" % result, file=sys.stderr)
+                results.append(result)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+        if saved is None:
+            os.environ.pop('CUDATOOLKIT_DECOMPRESS', None)
+        else:
+            os.environ['CUDATOOLKIT_DECOMPRESS'] = saved
+
+    report = {'python': sys.version.split()[0],
+              'machine': pyplatform.machine(),
+              'cpus': os.cpu_count(),
+              'parameters': {k: v for k, v in vars(args).items()
+                             if k != 'output'},
+              'uncompressed_bytes': total,
+              'results': results}
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
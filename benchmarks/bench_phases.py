@@ -0,0 +1,204 @@
+"""Times the phases of scripts/build.py on synthetic CUDA blobs.
+
+For each CUDA version in build.config and each platform a synthetic blob
+is generated (see synthetic.py), served from a local HTTP server and run
+through download_blobs, check_md5, extract, get_paths (the file plan of
+every package) and copy_files (staging every package). Results are written
+as JSON so they can be compared across changes, e.g.
+
+    python benchmarks/bench_phases.py --lib-size-mb 4 -o before.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform as pyplatform
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, os.pardir, 'scripts'))
+
+import build
+import synthetic
+from httpserver import LocalServer
+from phasetrace import DiskMeter
+
+PLATFORMS = ('linux', 'windows', 'osx')
+
+
+@contextlib.contextmanager
+def _untar_mount(mntpnt, image):
+    """Stands in for hdiutil, the synthetic osx image is a tar of the
+    image directory
+    """
+    with tarfile.open(image) as tar:
+        tar.extractall(mntpnt)
+    yield mntpnt
+
+
+@contextlib.contextmanager
+def _quiet(verbose):
+    if verbose:
+        yield
+    else:
+        with contextlib.redirect_stdout(io.StringIO()):
+            yield
+
+
+@contextlib.contextmanager
+def _chdir(path):
+    cwd = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(cwd)
+
+
+def _tree_stats(path):
+    nfiles = nbytes = 0
+    for root, dirs, files in os.walk(path):
+        for fn in files:
+            fp = os.path.join(root, fn)
+            if not os.path.islink(fp):
+                nfiles += 1
+                nbytes += os.path.getsize(fp)
+    return nfiles, nbytes
+
+
+def bench(version, platform, workdir, args):
+    """Runs the phases for one version and platform, returns a result dict
+    """
+    ver_cfg = build.config[version]
+    site = os.path.join(workdir, 'site')
+    src_dir = os.path.join(workdir, 'src')
+    extract_dir = os.path.join(workdir, 'extract')
+    prefixes = os.path.join(workdir, 'prefixes')
+    for d in (src_dir, extract_dir, prefixes):
+        os.makedirs(d)
+
+    t0 = time.perf_counter()
+    with LocalServer(site, rate=args.rate) as server:
+        ver_cfg, plt_cfg = synthetic.build_site(
+            site, server.url, version, platform, ver_cfg, ver_cfg[platform],
+            lib_size=int(args.lib_size_mb * (1 << 20)),
+            filler_size=int(args.filler_mb * (1 << 20)),
+            extra_libs=args.extra_libs, compression=args.compression)
+        generate = time.perf_counter() - t0
+        blob_bytes = os.path.getsize(os.path.join(
+            site, version, platform,
+            *(ver_cfg['installers_url_ext'].split('/') + [plt_cfg['blob']])))
+
+        impl = build.dispatcher[platform]
+        pkg_names = sorted(ver_cfg['pkg_libs'])
+        phases = {}
+
+        def timed(name, func, *fargs):
+            start = time.perf_counter()
+            with _quiet(args.verbose):
+                result = func(*fargs)
+            phases[name] = time.perf_counter() - start
+            return result
+
+        with _chdir(src_dir):
+            extractor = impl(version, ver_cfg, plt_cfg,
+                             prefix=os.path.join(prefixes, 'cudatoolkit'),
+                             src_dir=src_dir,
+                             cache_dir=os.path.join(workdir, 'cache'))
+            timed('download_blobs', extractor.download_blobs)
+            timed('check_md5', extractor.check_md5)
+            with DiskMeter(extract_dir) as meter:
+                timed('extract', extractor.extract, extract_dir)
+            plan = timed('get_paths', extractor.plan, pkg_names)
+
+            def copy_all():
+                for pkg_name in pkg_names:
+                    prefix = os.path.join(prefixes, pkg_name)
+                    extractor.for_prefix(prefix).copy(pkg_name)
+            timed('copy_files', copy_all)
+
+    payload_files, payload_bytes = _tree_stats(prefixes)
+    return {'version': version,
+            'platform': platform,
+            'generate_seconds': generate,
+            'blob_bytes': blob_bytes,
+            'planned_files': sum(len(v) for v in plan.values()),
+            'payload_files': payload_files,
+            'payload_bytes': payload_bytes,
+            'extract_peak_disk_bytes': meter.peak,
+            'extract_disk_bytes': meter.final,
+            'phases': phases,
+            'total_seconds': sum(phases.values())}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--versions', nargs='+', default=build.versions)
+    parser.add_argument('--platforms', nargs='+', choices=PLATFORMS,
+                        default=None, help="defaults to linux and osx, and "
+                        "windows if 7za is available")
+    parser.add_argument('--lib-size-mb', type=float, default=1.0,
+                        help="size of each synthetic library")
+    parser.add_argument('--filler-mb', type=float, default=16.0,
+                        help="size of the content no package needs")
+    parser.add_argument('--extra-libs', type=int, default=20,
+                        help="number of libraries no package needs")
+    parser.add_argument('--compression', default='gz',
+                        choices=('gz', 'xz', 'bz2'),
+                        help="compression of the linux/osx payloads")
+    parser.add_argument('--rate', type=float, default=None,
+                        help="throttle the server to this many bytes/s "
+                        "per request")
+    parser.add_argument('--workdir', default=None,
+                        help="keep the generated files here")
+    parser.add_argument('-o', '--output', default=None,
+                        help="write the JSON results here, default stdout")
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    platforms = args.platforms
+    if platforms is None:
+        platforms = ['linux', 'osx']
+        if synthetic.sevenzip() is not None:
+            platforms.insert(1, 'windows')
+
+    # there is no hdiutil here, the osx image is a tar
+    build.OsxExtractor.mount = staticmethod(_untar_mount)
+
+    results = []
+    root = args.workdir or tempfile.mkdtemp(prefix='cudatoolkit-bench-')
+    try:
+        for version in args.versions:
+            for platform in platforms:
+                workdir = os.path.join(root, '%s-%s' % (version, platform))
+                shutil.rmtree(workdir, ignore_errors=True)
+                os.makedirs(workdir)
+                result = bench(version, platform, workdir, args)
+                print("%(version)s %(platform)s: %(total_seconds).3fs" %
+                      result, file=sys.stderr)
+                results.append(result)
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(root, ignore_errors=True)
+
+    report = {'python': sys.version.split()[0],
+              'machine': pyplatform.machine(),
+              'cpus': os.cpu_count(),
+              'parameters': {k: v for k, v in vars(args).items()
+                             if k not in ('output', 'verbose', 'workdir')},
+              'results': results}
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
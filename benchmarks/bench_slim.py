@@ -0,0 +1,137 @@
+"""Times slimming synthetic ELF libraries and what it saves.
+
+Synthetic shared libraries (see synthetic.elf_bytes()) with a static
+symbol table and a share of debug info are slimmed as staging does with
+CUDATOOLKIT_SLIM set (see slim.py), once per installed tool. For each the
+bytes before and after, the time slimming (and checking the dynamic
+symbols) took, and the time to install the libraries, copying them into a
+fresh prefix as a package install does, before and after are written as
+JSON, e.g.
+
+    python benchmarks/bench_slim.py --libs 16 --lib-size-mb 8 -o slim.json
+
+Slimming leaves the loaded segments as they are, so it is the install
+(and transfer) of a package that gets cheaper rather than loading it.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform as pyplatform
+import shutil
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, os.pardir, 'scripts'))
+
+import slim
+import synthetic
+
+
+def write_libs(dirpath, nlibs, size, debug_fraction, nsymbols):
+    """Writes nlibs synthetic libraries into dirpath, returns their paths
+    """
+    os.makedirs(dirpath)
+    paths = []
+    for i in range(nlibs):
+        name = 'libsynthetic%d.so.1' % i
+        symbols = ['synthetic%d_%d' % (i, j) for j in range(nsymbols)]
+        path = os.path.join(dirpath, name)
+        with open(path, 'wb') as f:
+            f.write(synthetic.elf_bytes(name, size, i + 1, symbols,
+                                        debug_fraction))
+        paths.append(path)
+    return paths
+
+
+def install_seconds(paths, dest, repeat):
+    """Returns the best of repeat copies of paths into a fresh dest
+    """
+    times = []
+    for i in range(repeat):
+        shutil.rmtree(dest, ignore_errors=True)
+        os.makedirs(dest)
+        start = time.perf_counter()
+        for path in paths:
+            shutil.copyfile(path, os.path.join(dest, os.path.basename(path)))
+        times.append(time.perf_counter() - start)
+    shutil.rmtree(dest, ignore_errors=True)
+    return min(times)
+
+
+def total_bytes(paths):
+    return sum(os.path.getsize(path) for path in paths)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--libs', type=int, default=8,
+                        help="number of libraries")
+    parser.add_argument('--lib-size-mb', type=float, default=4.0,
+                        help="size of each library")
+    parser.add_argument('--debug-fraction', type=float, default=0.25,
+                        help="fraction of each library that is debug info")
+    parser.add_argument('--symbols', type=int, default=64,
+                        help="exported functions per library")
+    parser.add_argument('--jobs', type=int, default=None,
+                        help="libraries slimmed concurrently")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('-o', '--output', default=None,
+                        help="write the JSON results here, default stdout")
+    args = parser.parse_args(argv)
+
+    size = int(args.lib_size_mb * 1024 * 1024)
+    results = []
+    with tempfile.TemporaryDirectory(prefix='cudatoolkit-bench-') as root:
+        source = os.path.join(root, 'original')
+        original = write_libs(source, args.libs, size, args.debug_fraction,
+                              args.symbols)
+        before = install_seconds(original, os.path.join(root, 'prefix'),
+                                 args.repeat)
+        for name, arguments in slim.TOOLS:
+            exe = shutil.which(name)
+            if exe is None:
+                continue
+            staged = os.path.join(root, name)
+            shutil.copytree(source, staged)
+            paths = [os.path.join(staged, os.path.basename(p))
+                     for p in original]
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                slimmed, nbytes, saved = slim.slim_files(
+                    paths, (exe, arguments), args.jobs)
+            seconds = time.perf_counter() - start
+            after = install_seconds(paths, os.path.join(root, 'prefix'),
+                                    args.repeat)
+            result = {'tool': name,
+                      'slimmed': slimmed,
+                      'bytes_before': nbytes,
+                      'bytes_after': total_bytes(paths),
+                      'bytes_saved': saved,
+                      'slim_seconds': seconds,
+                      'install_seconds_before': before,
+                      'install_seconds_after': after}
+            print("%(tool)s: saved %(bytes_saved)d of %(bytes_before)d bytes "
+                  "in %(slim_seconds).3fs, install %(install_seconds_before).3fs"
+                  " -> %(install_seconds_after).3fs" % result, file=sys.stderr)
+            results.append(result)
+
+    report = {'python': sys.version.split()[0],
+              'machine': pyplatform.machine(),
+              'cpus': os.cpu_count(),
+              'parameters': {k: v for k, v in vars(args).items()
+                             if k != 'output'},
+              'results': results}
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""Measures how long build.py takes to start, that is to import it and load
+the configuration of one CUDA version, which every output pays.
+
+Each sample is a fresh interpreter. Results are written as JSON, e.g.
+
+    python benchmarks/bench_startup.py --repeat 20 --version 9.1
+    python benchmarks/bench_startup.py --scripts /path/to/old/scripts
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SCRIPTS = os.path.join(HERE, os.pardir, 'scripts')
+
+STARTUP = "import build; build.config[%r]"
+
+
+def sample(code, cwd=None):
+    """Returns the wall time of a fresh interpreter running code
+    """
+    start = time.perf_counter()
+    subprocess.check_call([sys.executable, '-c', code], cwd=cwd)
+    return time.perf_counter() - start
+
+
+def import_times(scripts, version, top=10):
+    """Returns the top modules by cumulative import time, in microseconds
+    """
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                           STARTUP % version], cwd=scripts,
+                          stderr=subprocess.PIPE, universal_newlines=True,
+                          check=True)
+    rows = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        rows.append({'module': name.strip(), 'self_us': int(self_us),
+                     'cumulative_us': int(cumulative_us)})
+    rows.sort(key=lambda row: -row['cumulative_us'])
+    return rows[:top]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scripts', default=SCRIPTS,
+                        help="the directory holding build.py")
+    parser.add_argument('--version', default='9.1',
+                        help="the CUDA version to load the config of")
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('-o', '--output', default=None,
+                        help="write the JSON results here, default stdout")
+    args = parser.parse_args(argv)
+
+    scripts = os.path.abspath(args.scripts)
+    # baseline, an interpreter doing nothing
+    empty = [sample('pass') for _ in range(args.repeat)]
+    times = [sample(STARTUP % args.version, scripts)
+             for _ in range(args.repeat)]
+    report = {'python': sys.version.split()[0],
+              'scripts': scripts,
+              'version': args.version,
+              'repeat': args.repeat,
+              'interpreter_seconds': statistics.median(empty),
+              'startup_seconds': statistics.median(times),
+              'startup_min_seconds': min(times),
+              'build_import_seconds': statistics.median(times) -
+                                      statistics.median(empty),
+              'top_imports': import_times(scripts, args.version)}
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
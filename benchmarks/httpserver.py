@@ -0,0 +1,90 @@
+"""A local HTTP server standing in for developer.nvidia.com.
+
+Serves a directory with support for single Range requests, which is all
+the downloader needs. Optionally throttled to mimic a slow link, or
+ignoring Range requests as some servers do.
+"""
+import functools
+import http.server
+import os
+import re
+import threading
+import time
+
+_RANGE_RE = re.compile(r'bytes=(\d+)-(\d*)$')
+
+
+class RangeRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """Static file handler honouring "Range: bytes=start-[end]"
+    """
+
+    # bytes per second per request, None for unlimited
+    rate = None
+    # whether Range requests are honoured, else the whole file is sent
+    ranges = True
+
+    def log_message(self, *args):
+        pass
+
+    def _send_body(self, f, nbytes):
+        while nbytes > 0:
+            buf = f.read(min(1024 * 1024, nbytes))
+            if not buf:
+                break
+            self.wfile.write(buf)
+            nbytes -= len(buf)
+            if self.rate:
+                time.sleep(len(buf) / self.rate)
+
+    def do_GET(self):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        m = _RANGE_RE.match(self.headers.get('Range', ''))
+        if m and self.ranges:
+            start = int(m.group(1))
+            if m.group(2):
+                end = min(int(m.group(2)), size - 1)
+            if start >= size:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%d' % size)
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range',
+                             'bytes %d-%d/%d' % (start, end, size))
+        else:
+            self.send_response(200)
+        if self.ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        with open(path, 'rb') as f:
+            f.seek(start)
+            self._send_body(f, end - start + 1)
+
+
+class LocalServer(object):
+    """Context manager running a threaded server for root in the background,
+    the url attribute is the base url of root.
+    """
+
+    def __init__(self, root, rate=None, ranges=True):
+        handler = type('Handler', (RangeRequestHandler,),
+                       {'rate': rate, 'ranges': ranges})
+        self.httpd = http.server.ThreadingHTTPServer(
+            ('127.0.0.1', 0), functools.partial(handler, directory=root))
+        self.url = 'http://127.0.0.1:%d/' % self.httpd.server_address[1]
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,422 @@
+"""Synthetic CUDA installer blobs for benchmarking build.py.
+
+The blobs have the layout each extractor expects, the libraries have valid
+ELF, PE or Mach-O headers (naming the library as it would be loaded) but
+are otherwise filled with random data:
+  linux   - a makeself .run whose payload holds a nested cuda-linux*.run
+            with the toolkit, plus samples and driver stand ins
+  windows - a 7z archive of per component directories (needs 7za)
+  osx     - a stand in for the .dmg, a tar of the image directory holding
+            the .tar.gz payloads that OsxExtractor._mount_extract() reads
+
+build_site() writes a blob, its patches and an md5sum list in the layout
+of the urls in build.config, ready to be served by httpserver.LocalServer.
+"""
+import hashlib
+import io
+import os
+import random
+import shutil
+import struct
+import subprocess
+import tarfile
+import tempfile
+
+MAKESELF_HEADER = '''#!/bin/sh
+# This script was generated using Makeself 2.1.5 (synthetic)
+CRCsum="0000000000"
+MD5="00000000000000000000000000000000"
+label="%(label)s"
+script="./install.sh"
+targetdir="pkg"
+filesizes="%(size)d"
+keep="n"
+
+MS_dd()
+{
+    blocks=`expr $3 / 1024`
+}
+
+MS_Check()
+{
+    offset=`head -n %(skip)d "$1" | wc -c | tr -d " "`
+}
+
+offset=`head -n %(skip)d "$0" | wc -c | tr -d " "`
+echo "Synthetic makeself archive, not installable"
+exit 1
+'''
+
+
+def random_bytes(size, seed):
+    """Returns size incompressible bytes, the same for the same seed
+    """
+    return random.Random(seed).randbytes(size)
+
+
+def _align(data, n):
+    return data + bytes(-len(data) % n)
+
+
+def elf_bytes(soname, size, seed, symbols=None, debug_fraction=0.25):
+    """Returns an x86_64 ELF shared object of about size bytes that the
+    binutils can read: a loadable segment with the dynamic symbols and
+    section (naming soname) and a random .text, plus a static symbol table
+    and random .debug_info which strip removes.
+    Arguments:
+      soname - the DT_SONAME
+      size - the size of the object
+      seed - seed of the random content
+      symbols - the names of the exported functions, defaults to one
+                named after the library
+      debug_fraction - the fraction of size that is debug info
+    """
+    if symbols is None:
+        symbols = [soname.split('.')[0] + '_synthetic']
+    strtab = b'\0' + b''.join(s.encode('utf-8') + b'\0' for s in symbols)
+    dynstr = b'\0' + soname.encode('utf-8') + b'\0'
+    sym_names = []
+    for sym in symbols:
+        sym_names.append(len(dynstr))
+        dynstr += sym.encode('utf-8') + b'\0'
+    names = ['', '.dynsym', '.dynstr', '.dynamic', '.text', '.symtab',
+             '.strtab', '.debug_info', '.shstrtab']
+    shstrtab = b'\0'
+    name_offsets = {'': 0}
+    for name in names[1:]:
+        name_offsets[name] = len(shstrtab)
+        shstrtab += name.encode('ascii') + b'\0'
+    debug_size = int(size * debug_fraction)
+    text_size = max(16 * len(symbols), size - debug_size - 1024)
+    text_size -= text_size % 16
+
+    data = bytes(64 + 2 * 56)
+    offsets = {}
+
+    def add(name, content, align):
+        nonlocal data
+        data = _align(data, align)
+        offsets[name] = (len(data), len(content))
+        data += content
+
+    # symbol tables need the .text offset, lay out .text's place first
+    dynsym_size = 24 * (1 + len(symbols))
+    add('.dynsym', bytes(dynsym_size), 8)
+    add('.dynstr', dynstr, 1)
+    dynamic_size = 16 * 6
+    add('.dynamic', bytes(dynamic_size), 8)
+    add('.text', random_bytes(text_size, seed), 16)
+    text_off = offsets['.text'][0]
+    load_end = len(data)
+
+    def syms(name_offsets_, binding):
+        out = bytes(24)
+        for i, name_off in enumerate(name_offsets_):
+            # STT_FUNC, 16 bytes each in .text (section 4)
+            out += struct.pack('<IBBHQQ', name_off, (binding << 4) | 2, 0, 4,
+                               text_off + 16 * i, 16)
+        return out
+
+    dynsym = syms(sym_names, 1)
+    static_names = []
+    pos = 1
+    for sym in symbols:
+        static_names.append(pos)
+        pos += len(sym) + 1
+    add('.symtab', syms(static_names, 1), 8)
+    add('.strtab', strtab, 1)
+    add('.debug_info', random_bytes(debug_size, -seed - 1), 1)
+    add('.shstrtab', shstrtab, 1)
+    dynamic = struct.pack('<' + 'qQ' * 6, 14, 1, 5, offsets['.dynstr'][0],
+                          6, offsets['.dynsym'][0], 10, len(dynstr), 11, 24,
+                          0, 0)
+    data = bytearray(data)
+    off = offsets['.dynsym'][0]
+    data[off:off + dynsym_size] = dynsym
+    off = offsets['.dynamic'][0]
+    data[off:off + dynamic_size] = dynamic
+    data = bytes(_align(bytes(data), 8))
+    shoff = len(data)
+
+    # (type, flags, link, info, align, entsize) of each section
+    kinds = {'': (0, 0, 0, 0, 0, 0),
+             '.dynsym': (11, 2, 2, 1, 8, 24),
+             '.dynstr': (3, 2, 0, 0, 1, 0),
+             '.dynamic': (6, 3, 2, 0, 8, 16),
+             '.text': (1, 6, 0, 0, 16, 0),
+             '.symtab': (2, 0, 6, 1, 8, 24),
+             '.strtab': (3, 0, 0, 0, 1, 0),
+             '.debug_info': (1, 0, 0, 0, 1, 0),
+             '.shstrtab': (3, 0, 0, 0, 1, 0)}
+    sections = b''
+    for name in names:
+        sh_type, flags, link, info, align, entsize = kinds[name]
+        offset, length = offsets.get(name, (0, 0))
+        addr = offset if flags & 2 else 0
+        sections += struct.pack('<IIQQQQIIQQ', name_offsets[name], sh_type,
+                                flags, addr, offset, length, link, info,
+                                align, entsize)
+    header = (b'\x7fELF' + bytes([2, 1, 1, 0]) + bytes(8) +
+              struct.pack('<HHIQQQIHHHHHH', 3, 62, 1, 0, 64, shoff, 0, 64, 56,
+                          2, 64, len(names), len(names) - 1))
+    dyn_off, dyn_len = offsets['.dynamic']
+    phdrs = struct.pack('<IIQQQQQQ', 1, 5, 0, 0, 0, load_end, load_end,
+                        0x1000)
+    phdrs += struct.pack('<IIQQQQQQ', 2, 6, dyn_off, dyn_off, dyn_off,
+                         dyn_len, dyn_len, 8)
+    return header + phdrs + data[64 + 112:] + sections
+
+
+def pe_bytes(size, seed):
+    """Returns a minimal x86_64 PE DLL of about size bytes
+    """
+    data = b'MZ' + bytes(0x3a) + struct.pack('<I', 0x40)
+    data += b'PE\0\0' + struct.pack('<HHIIIHH', 0x8664, 0, 0, 0, 0, 0, 0x2022)
+    return data + random_bytes(max(0, size - len(data)), seed)
+
+
+def macho_bytes(install_name, size, seed):
+    """Returns a minimal x86_64 Mach-O dylib of about size bytes with
+    install_name as its LC_ID_DYLIB
+    """
+    name = install_name.encode('utf-8') + b'\0'
+    name += bytes(-(24 + len(name)) % 8)
+    cmd = struct.pack('<IIIIII', 0xd, 24 + len(name), 24, 0, 0, 0) + name
+    data = struct.pack('<IiiIIIII', 0xfeedfacf, 0x01000007, 3, 6, 1,
+                       len(cmd), 0, 0) + cmd
+    return data + random_bytes(max(0, size - len(data)), seed)
+
+
+def library_bytes(platform, filename, soname, size, seed):
+    """Returns the content of a synthetic library for platform
+    """
+    if platform == 'linux':
+        return elf_bytes(soname, size, seed)
+    if platform == 'windows':
+        return pe_bytes(size, seed)
+    return macho_bytes('@rpath/' + filename, size, seed)
+
+
+def _tar_bytes(files, compression):
+    buf = io.BytesIO()
+    mode = 'w:%s' % compression if compression else 'w'
+    with tarfile.open(fileobj=buf, mode=mode) as tar:
+        for name, data in files:
+            info = tarfile.TarInfo(name)
+            info.mtime = 0
+            if isinstance(data, tuple):
+                info.type = tarfile.SYMTYPE
+                info.linkname = data[1]
+                tar.addfile(info)
+            else:
+                info.size = len(data)
+                info.mode = 0o755
+                tar.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+
+def makeself_bytes(files, compression='gz', label='synthetic'):
+    """Returns a makeself archive of files, a list of (name, data) where
+    data is bytes or ('symlink', target).
+    """
+    payload = _tar_bytes(files, compression)
+    skip = MAKESELF_HEADER.count('\n')
+    header = MAKESELF_HEADER % {'label': label, 'size': len(payload),
+                                'skip': skip}
+    return header.encode('ascii') + payload
+
+
+def _lib_names(fmt, name, full_version):
+    """Returns the files for a library, a list of (filename, data) where data
+    is the SONAME of the concrete library or ('symlink', target).
+    """
+    pattern = fmt.format(name)
+    if '*' not in pattern:
+        return [(pattern, pattern)]
+    base = pattern.replace('*', '')
+    short = '.'.join(full_version.split('.')[:2])
+    concrete = '%s.%s' % (base, full_version)
+    # the short name is the SONAME
+    return [(concrete, '%s.%s' % (base, short)),
+            ('%s.%s' % (base, short), ('symlink', concrete)),
+            (base, ('symlink', '%s.%s' % (base, short)))]
+
+
+class Layout(object):
+    """Where each kind of file lives in the synthetic toolkit of a platform
+    """
+
+    dirs = {'linux': {'cuda': 'lib64', 'nvvm': 'nvvm/lib64',
+                      'libdevice': 'nvvm/libdevice', 'filler': 'doc'},
+            'windows': {'cuda': 'CUDAToolkit/bin', 'nvvm': 'nvcc/nvvm/bin',
+                        'libdevice': 'nvcc/nvvm/libdevice',
+                        'filler': 'jre/bin'},
+            'osx': {'cuda': 'Developer/NVIDIA/CUDA/lib',
+                    'nvvm': 'Developer/NVIDIA/CUDA/nvvm/lib',
+                    'libdevice': 'Developer/NVIDIA/CUDA/nvvm/libdevice',
+                    'filler': 'Developer/NVIDIA/CUDA/doc'}}
+
+    def __init__(self, platform):
+        self.platform = platform
+
+    def path(self, kind, filename):
+        return '%s/%s' % (self.dirs[self.platform][kind], filename)
+
+
+def toolkit_files(ver_cfg, plt_cfg, platform, full_version, lib_size=1 << 20,
+                  filler_size=8 << 20, extra_libs=0, seed=0, only=None):
+    """Returns the files of a synthetic toolkit as a list of (name, data).
+    Arguments:
+      ver_cfg, plt_cfg - the build.config entries for the version/platform
+      platform - one of 'linux', 'windows', 'osx'
+      full_version - version used in the names of globbed libraries
+      lib_size - bytes in each library
+      filler_size - bytes of files no package needs (docs, samples)
+      extra_libs - number of extra libraries no package needs
+      seed - seed of the random content
+      only - if given, just the libraries named in here
+    """
+    layout = Layout(platform)
+    files = []
+    counter = [seed]
+
+    def content(size):
+        counter[0] += 1
+        return random_bytes(size, counter[0])
+
+    def add_lib(kind, fmt, name):
+        for filename, data in _lib_names(fmt, name, full_version):
+            if not isinstance(data, tuple):
+                counter[0] += 1
+                data = library_bytes(platform, filename, data, lib_size,
+                                     counter[0])
+            files.append((layout.path(kind, filename), data))
+
+    for pkg_name, libs in sorted(ver_cfg['pkg_libs'].items()):
+        if pkg_name == 'nvvm':
+            continue
+        fmt = plt_cfg['nvtoolsext_fmt'] if pkg_name == 'nvtx' else plt_cfg['cuda_lib_fmt']
+        for lib in libs:
+            if only is None or lib in only:
+                add_lib('cuda', fmt, lib)
+    if only is None or 'nvvm' in only:
+        add_lib('nvvm', plt_cfg['nvvm_lib_fmt'], 'nvvm')
+        for v in ver_cfg['libdevice_versions']:
+            files.append((layout.path('libdevice',
+                                      plt_cfg['libdevice_lib_fmt'].format(v)),
+                          b'BC\xc0\xde' + content(lib_size // 8)))
+    if only is None:
+        for i in range(extra_libs):
+            add_lib('cuda', plt_cfg['cuda_lib_fmt'], 'extra%d' % i)
+        if filler_size:
+            files.append((layout.path('filler', 'filler.dll' if platform ==
+                                      'windows' else 'filler.pdf'),
+                          content(filler_size)))
+    return files
+
+
+def write_linux_blob(path, files, compression='gz'):
+    """Writes files as a synthetic CUDA .run installer
+    """
+    inner = makeself_bytes(files, compression, 'CUDA toolkit')
+    outer = makeself_bytes([('run_files/cuda-linux.synthetic.run', inner),
+                            ('run_files/cuda-samples.synthetic.run',
+                             random_bytes(64 * 1024, -1)),
+                            ('run_files/NVIDIA-Linux-synthetic.run',
+                             random_bytes(64 * 1024, -2))],
+                           compression, 'CUDA installer')
+    with open(path, 'wb') as f:
+        f.write(outer)
+
+
+def sevenzip():
+    """Returns the 7-zip executable or None
+    """
+    return shutil.which('7za') or shutil.which('7z')
+
+
+def write_windows_blob(path, files):
+    """Writes files as a 7z archive standing in for the windows installer
+    """
+    exe = sevenzip()
+    if exe is None:
+        raise RuntimeError('7za is needed to create windows blobs')
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, data in files:
+            dst = os.path.join(tmp, *name.split('/'))
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            with open(dst, 'wb') as f:
+                f.write(data)
+        if os.path.exists(path):
+            os.remove(path)
+        subprocess.check_call([exe, 'a', '-t7z', '-bd', os.path.abspath(path),
+                               '.'], cwd=tmp, stdout=subprocess.DEVNULL)
+
+
+def write_osx_blob(path, files, ntarballs=2):
+    """Writes a stand in for the osx .dmg, a tar of an image directory with
+    the files split across ntarballs .tar.gz payloads
+    """
+    image = io.BytesIO()
+    with tarfile.open(fileobj=image, mode='w') as tar:
+        for i in range(ntarballs):
+            data = _tar_bytes(files[i::ntarballs], 'gz')
+            info = tarfile.TarInfo('CUDAMacOSXInstaller.app/Contents/'
+                                   'Resources/payload/cuda_mac_%d.tar.gz' % i)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    with open(path, 'wb') as f:
+        f.write(image.getvalue())
+
+
+def write_blob(platform, path, files, compression='gz'):
+    if platform == 'linux':
+        write_linux_blob(path, files, compression)
+    elif platform == 'windows':
+        write_windows_blob(path, files)
+    else:
+        write_osx_blob(path, files)
+
+
+def md5sum(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for buf in iter(lambda: f.read(1 << 20), b''):
+            md5.update(buf)
+    return md5.hexdigest()
+
+
+def build_site(root, url, version, platform, ver_cfg, plt_cfg, **kwargs):
+    """Writes a synthetic blob, patches and md5sum list for a version and
+    platform under root, laid out as the urls in the config expect.
+    Returns (ver_cfg, plt_cfg) copies pointing at url, the url of root.
+    Other keyword arguments go to toolkit_files().
+    """
+    compression = kwargs.pop('compression', 'gz')
+    full_version = version + '.99'
+    site = os.path.join(root, version, platform)
+    base_url = '%s%s/%s/' % (url, version, platform)
+    ver_cfg = dict(ver_cfg, base_url=base_url, md5_url=base_url + 'md5sum.txt')
+    plt_cfg = dict(plt_cfg, NvToolsExtPath=None)
+
+    installers = os.path.join(site, *ver_cfg['installers_url_ext'].split('/'))
+    patch_dir = os.path.join(site, *ver_cfg['patch_url_ext'].split('/'))
+    os.makedirs(installers, exist_ok=True)
+    os.makedirs(patch_dir, exist_ok=True)
+
+    blob = os.path.join(installers, plt_cfg['blob'])
+    write_blob(platform, blob, toolkit_files(ver_cfg, plt_cfg, platform,
+                                             full_version, **kwargs),
+               compression)
+    sums = ['%s  %s' % (md5sum(blob), plt_cfg['blob'])]
+    # each patch updates cublas to a newer version
+    for i, p in enumerate(plt_cfg['patches']):
+        patch_kwargs = dict(kwargs, only=('cublas',), seed=1000 + i)
+        files = toolkit_files(ver_cfg, plt_cfg, platform,
+                              '%s.%d' % (full_version, 100 + i), **patch_kwargs)
+        path = os.path.join(patch_dir, p)
+        write_blob(platform, path, files, compression)
+        sums.append('%s  %s' % (md5sum(path), p))
+    with open(os.path.join(site, 'md5sum.txt'), 'w') as f:
+        f.write('\n'.join(sums) + '\n')
+    return ver_cfg, plt_cfg
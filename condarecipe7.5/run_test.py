@@ -3,6 +3,10 @@ import os
 from numba.cuda.cudadrv.libs import test, get_cudalib
 from numba.cuda.cudadrv.nvvm import NVVM
 
+# the copy in the recipe's source, cudart installs the same file next to
+# its index
+import cudalibs
+
 
 def run_test():
     if not test():
@@ -15,7 +19,16 @@ def run_test():
     if sys.platform.startswith('win'):
         # windows libs have no dot
         lookfor = lookfor.replace('.', '')
-    return lookfor in gotlib
+    if lookfor not in gotlib:
+        return False
+    installed = os.path.join(cudalibs.libdir(), cudalibs.INDEX_DIR,
+                             'cudalibs.py')
+    if not os.path.isfile(installed):
+        return False
+    indexed = cudalibs.find('cublas')
+    print("Indexed cublas", indexed)
+    return (indexed is not None and os.path.isfile(indexed) and
+            lookfor in os.path.basename(indexed))
 
 
 sys.exit(0 if run_test() else 1)
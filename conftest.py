@@ -0,0 +1,3 @@
+# the run_test.py scripts of the recipes are run by conda-build against an
+# installed package, they are not tests of the build scripts
+collect_ignore_glob = ['condarecipe*/run_test.py']
@@ -0,0 +1,248 @@
+"""Minimal readers for the binary formats of the CUDA libraries.
+
+Just enough of ELF (linux), Mach-O (osx), PE (windows) and LLVM bitcode
+(libdevice) is parsed to tell the formats apart, check their headers and
+read the name a library is loaded by. Files are mapped rather than read,
+only the pages holding the headers are touched, and nothing is loaded so
+no GPU or driver is needed.
+"""
+import mmap
+import os
+import struct
+
+ELF_MAGIC = b'\x7fELF'
+PE_MAGIC = b'MZ'
+BITCODE_MAGIC = b'BC\xc0\xde'
+# the wrapper some libdevice versions put around the bitcode
+BITCODE_WRAPPER_MAGIC = b'\xde\xc0\x17\x0b'
+MACHO_MAGICS = {b'\xfe\xed\xfa\xce': ('>', 32), b'\xce\xfa\xed\xfe': ('<', 32),
+                b'\xfe\xed\xfa\xcf': ('>', 64), b'\xcf\xfa\xed\xfe': ('<', 64)}
+MACHO_FAT_MAGIC = b'\xca\xfe\xba\xbe'
+
+ET_DYN = 3
+SHT_DYNAMIC = 6
+SHT_DYNSYM = 11
+SHN_UNDEF = 0
+DT_NULL = 0
+DT_SONAME = 14
+MH_DYLIB = 6
+LC_ID_DYLIB = 0xd
+IMAGE_FILE_DLL = 0x2000
+PE_MACHINES = {0x14c: 'x86', 0x8664: 'x86_64', 0xaa64: 'arm64'}
+ELF_MACHINES = {3: 'x86', 62: 'x86_64', 21: 'ppc64', 183: 'aarch64'}
+
+
+def identify(path):
+    """Returns the format of the file at path, one of 'elf', 'macho', 'pe',
+    'bitcode' or None if it is none of these.
+    """
+    with open(path, 'rb') as f:
+        magic = f.read(4)
+    return _identify(magic)
+
+
+def _identify(magic):
+    if magic == ELF_MAGIC:
+        return 'elf'
+    if magic in MACHO_MAGICS or magic == MACHO_FAT_MAGIC:
+        return 'macho'
+    if magic[:2] == PE_MAGIC:
+        return 'pe'
+    if magic in (BITCODE_MAGIC, BITCODE_WRAPPER_MAGIC):
+        return 'bitcode'
+    return None
+
+
+def _cstring(data, offset):
+    end = data.find(b'\0', offset)
+    if end < 0:
+        raise ValueError('Unterminated string')
+    return data[offset:end].decode('utf-8', 'replace')
+
+
+def elf_info(data):
+    """Returns a dictionary of the header fields of the ELF image data
+    """
+    bits = {1: 32, 2: 64}[data[4]]
+    end = {1: '<', 2: '>'}[data[5]]
+    e_type, e_machine = struct.unpack_from(end + 'HH', data, 16)
+    return {'bits': bits, 'type': e_type,
+            'machine': ELF_MACHINES.get(e_machine, e_machine),
+            'soname': elf_soname(data)}
+
+
+def _elf_sections(data):
+    """Returns the byte order of the ELF image data and its section headers,
+    each (name, type, flags, addr, offset, size, link, info, ...)
+    """
+    bits = {1: 32, 2: 64}[data[4]]
+    end = {1: '<', 2: '>'}[data[5]]
+    if bits == 64:
+        shoff, = struct.unpack_from(end + 'Q', data, 0x28)
+        shentsize, shnum = struct.unpack_from(end + 'HH', data, 0x3a)
+        shdr = end + 'IIQQQQIIQQ'
+    else:
+        shoff, = struct.unpack_from(end + 'I', data, 0x20)
+        shentsize, shnum = struct.unpack_from(end + 'HH', data, 0x2e)
+        shdr = end + 'IIIIIIIIII'
+    return end, [struct.unpack_from(shdr, data, shoff + i * shentsize)
+                 for i in range(shnum)]
+
+
+def elf_soname(data):
+    """Returns the DT_SONAME of the ELF image data or None
+    """
+    end, sections = _elf_sections(data)
+    dyn = end + ('qQ' if data[4] == 2 else 'iI')
+    for sh in sections:
+        if sh[1] != SHT_DYNAMIC:
+            continue
+        # (name, type, flags, addr, offset, size, link, ...)
+        offset, size, link = sh[4], sh[5], sh[6]
+        strtab = sections[link][4]
+        for pos in range(offset, offset + size, struct.calcsize(dyn)):
+            tag, val = struct.unpack_from(dyn, data, pos)
+            if tag == DT_NULL:
+                break
+            if tag == DT_SONAME:
+                return _cstring(data, strtab + val)
+    return None
+
+
+def elf_dynamic_symbols(data):
+    """Returns the dynamic symbols of the ELF image data as a sorted list of
+    (name, value, size, info, other, defined), which strip leaves as they
+    are even though the sections may move.
+    """
+    end, sections = _elf_sections(data)
+    if data[4] == 2:
+        # (name, info, other, shndx, value, size)
+        sym = end + 'IBBHQQ'
+    else:
+        # (name, value, size, info, other, shndx) reordered as above
+        sym = end + 'IIIBBH'
+    symbols = []
+    for sh in sections:
+        if sh[1] != SHT_DYNSYM:
+            continue
+        offset, size, link = sh[4], sh[5], sh[6]
+        strtab = sections[link][4]
+        step = struct.calcsize(sym)
+        for pos in range(offset, offset + size, step):
+            fields = struct.unpack_from(sym, data, pos)
+            if data[4] == 2:
+                name, info, other, shndx, value, symsize = fields
+            else:
+                name, value, symsize, info, other, shndx = fields
+            symbols.append((_cstring(data, strtab + name), value, symsize,
+                            info, other, shndx != SHN_UNDEF))
+    return sorted(symbols)
+
+
+def dynamic_symbols(path):
+    """Returns the dynamic symbols of the ELF file at path, see
+    elf_dynamic_symbols(). Raises ValueError if it is not a valid ELF file.
+    """
+    with open(path, 'rb') as f:
+        if _identify(f.read(4)) != 'elf':
+            raise ValueError('Not an ELF file: %s' % path)
+        try:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                return elf_dynamic_symbols(data)
+        except (struct.error, KeyError, IndexError) as e:
+            raise ValueError('Malformed elf file: %r' % (e,))
+
+
+def _macho_base(data):
+    if data[:4] == MACHO_FAT_MAGIC:
+        # the first architecture will do, they all share the install name
+        base, = struct.unpack_from('>I', data, 8 + 8)
+        return base
+    return 0
+
+
+def macho_info(data):
+    """Returns a dictionary of the header fields of the Mach-O image data
+    """
+    base = _macho_base(data)
+    end, bits = MACHO_MAGICS[data[base:base + 4]]
+    filetype, = struct.unpack_from(end + 'I', data, base + 12)
+    return {'bits': bits, 'type': filetype, 'fat': base != 0,
+            'install_name': macho_install_name(data)}
+
+
+def macho_install_name(data):
+    """Returns the LC_ID_DYLIB install name of the Mach-O image data or None
+    """
+    base = _macho_base(data)
+    end, bits = MACHO_MAGICS[data[base:base + 4]]
+    ncmds, = struct.unpack_from(end + 'I', data, base + 16)
+    pos = base + (32 if bits == 64 else 28)
+    for _ in range(ncmds):
+        cmd, cmdsize = struct.unpack_from(end + 'II', data, pos)
+        if cmd == LC_ID_DYLIB:
+            name_offset, = struct.unpack_from(end + 'I', data, pos + 8)
+            return _cstring(data, pos + name_offset)
+        pos += cmdsize
+    return None
+
+
+def pe_info(data):
+    """Returns a dictionary of the COFF header fields of the PE image data
+    """
+    pe_offset, = struct.unpack_from('<I', data, 0x3c)
+    if data[pe_offset:pe_offset + 4] != b'PE\0\0':
+        raise ValueError('No PE signature')
+    machine, = struct.unpack_from('<H', data, pe_offset + 4)
+    characteristics, = struct.unpack_from('<H', data, pe_offset + 22)
+    return {'machine': PE_MACHINES.get(machine, machine),
+            'dll': bool(characteristics & IMAGE_FILE_DLL)}
+
+
+def bitcode_info(data):
+    """Returns a dictionary describing the LLVM bitcode data
+    """
+    if data[:4] == BITCODE_WRAPPER_MAGIC:
+        offset, size = struct.unpack_from('<II', data, 8)
+        if data[offset:offset + 4] != BITCODE_MAGIC:
+            raise ValueError('Bitcode wrapper does not hold bitcode')
+        return {'wrapped': True, 'size': size}
+    return {'wrapped': False, 'size': len(data)}
+
+
+_INFO = {'elf': elf_info, 'macho': macho_info, 'pe': pe_info,
+         'bitcode': bitcode_info}
+
+
+def inspect(path):
+    """Returns a dictionary describing the file at path, the key 'format'
+    is as identify() and the rest depends on it. Raises ValueError if the
+    file claims to be one of the formats but cannot be parsed as it.
+    """
+    with open(path, 'rb') as f:
+        fmt = _identify(f.read(4))
+        if fmt is None:
+            return {'format': None}
+        try:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                info = _INFO[fmt](data)
+        except (struct.error, KeyError, IndexError) as e:
+            raise ValueError('Malformed %s file: %r' % (fmt, e))
+    info['format'] = fmt
+    return info
+
+
+def soname(path):
+    """Returns the name the library at path is loaded by: the SONAME of an
+    ELF library, the install name of a Mach-O one, else the filename.
+    Returns None for an ELF or Mach-O library without one.
+    """
+    try:
+        info = inspect(path)
+    except ValueError:
+        return None
+    if info['format'] == 'elf':
+        return info['soname']
+    if info['format'] == 'macho':
+        return info['install_name']
+    return os.path.basename(path)
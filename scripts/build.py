@@ -1,27 +1,41 @@
 from __future__ import print_function
+import argparse
 import fnmatch
+import functools
+import hashlib
+import json
 import os
+import posixpath
+import re
 import sys
 import shutil
-import tarfile
+import threading
+import time
 import urllib.parse as urlparse
-import yaml
 
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
+from copy import copy as shallow_copy
 from pathlib import Path
 from subprocess import check_call
 from tempfile import TemporaryDirectory as tempdir
 
-from conda.exports import download, hashsum_file
-import pickle
-
-config = {}
-versions = ['7.5', '8.0', '9.0', '9.1']
-for v in versions:
-    config[v] = {'linux': {}, 'windows': {}, 'osx': {}}
-
-
-# The config dictionary looks like:
+import binfmt
+import cudalibs
+import manifest
+import slim
+import validate
+from cache import (BlobCache, ChecksumCache, ExtractCache, StagedCache,
+                   blob_cache_config, default_cache_dir, md5sum_file,
+                   staged_cache_bytes, write_json)
+from downloader import fetch, mirror_url
+from libindex import LibraryIndex, version_key
+from phasetrace import DiskMeter, PhaseTracer, disk_metering, traced_run
+from stage import stage_file, unshared
+
+
+# The configuration of each CUDA version lives in cuda_versions/<version>.json
+# and is only read when that version is asked for from the config mapping:
 # config[cuda_version(s)...]
 #
 # and for each cuda_version the keys:
@@ -29,7 +43,7 @@ for v in versions:
 # patch_url_ext the extra path needed to reach the patch directory from base_url
 # installers_url_ext the extra path needed to reach the local installers directory
 # md5_url the url for checksums
-# cuda_libraries the libraries to copy in
+# pkg_libs the libraries to copy in for each package
 # libdevice_versions the library device versions supported (.bc files)
 # linux the linux platform config (see below)
 # windows the windows platform config (see below)
@@ -39,222 +53,107 @@ for v in versions:
 # a dictionary containing keys:
 # blob the name of the downloaded file, for linux this is the .run file
 # patches a list of the patch files for the blob, they are applied in order
-# cuda_lib_fmt string format for the cuda libraries
+# cuda_lib_fmt string format for the cuda libraries, on linux from 8.0 these
+#              are globs to pick up the symlinks
+# nvtoolsext_fmt string format for the nvToolsExt library (nvtx package)
 # nvvm_lib_fmt string format for the nvvm libraries
 # libdevice_lib_fmt string format for the libdevice.compute bitcode file
+# NvToolsExtPath (windows) the path components of the default NvToolsExt
+#                install, see below
 #
 # To accommodate nvtoolsext not being present as a DLL in the installer PE32s on windows,
 # the windows variant of this script supports assembly directly from a pre-installed 
 # CUDA toolkit. The environment variable "NVTOOLSEXT_INSTALL_PATH" can be set to the
 # installation path of the CUDA toolkit's NvToolsExt location (this is not the user
 # defined install directory) and the DLL will be taken from that location.
+# When the windows packages are built on another platform (--platform windows)
+# it should point at a copy of that directory.
+
+scripts_dir = os.path.dirname(os.path.abspath(__file__))
+config_dir = os.path.join(scripts_dir, 'cuda_versions')
+
 
+def load_version_config(version):
+    """Reads the configuration of a CUDA version from config_dir
+    """
+    path = os.path.join(config_dir, '%s.json' % version)
+    try:
+        with open(path, 'r') as f:
+            ver_config = json.load(f)
+    except FileNotFoundError:
+        raise KeyError("No configuration for CUDA version %s" % version)
+    for plt in ('linux', 'windows', 'osx'):
+        nvt_path = ver_config[plt].get('NvToolsExtPath')
+        if nvt_path is not None:
+            drive, rest = nvt_path[0], nvt_path[1:]
+            ver_config[plt]['NvToolsExtPath'] = os.path.join(drive + os.sep,
+                                                             *rest)
+    return ver_config
+
+
+class _LazyConfig(dict):
+    """The config dictionary, versions are loaded on first access
+    """
 
+    def __missing__(self, version):
+        ver_config = self[version] = load_version_config(version)
+        return ver_config
 
-######################
-### CUDA 7.5 setup ###
-######################
-
-cu_75 = config['7.5']
-cu_75['base_url'] = "http://developer.download.nvidia.com/compute/cuda/7.5/Prod/"
-cu_75['patch_url_ext'] = ''
-cu_75['installers_url_ext'] = 'local_installers/'
-cu_75['md5_url'] = "http://developer.download.nvidia.com/compute/cuda/7.5/Prod/docs/sidebar/md5sum.txt"
-cu_75['pkg_libs'] = {
-    'cudart': ['cudart'],
-    'cufft': ['cufft'],
-    'cublas': ['cublas'],
-    'cusparse': ['cusparse'],
-    'cusolver': ['cusolver'],
-    'curand': ['curand'],
-    'npp': ['nppc', 'nppi', 'npps'],
-    'nvblas': ['nvblas'],
-    'nvrtc': ['nvrtc', 'nvrtc-builtins'],
-    'nvvm': ['nvvm', '20.10', '30.10', '35.10', '50.10'],
-    'cupti': ['cupti']
-    }
-cu_75['libdevice_versions'] = ['20.10', '30.10', '35.10', '50.10']
-
-cu_75['linux'] = {'blob': 'cuda_7.5.18_linux.run',
-                  'patches': [],
-                  'cuda_lib_fmt': 'lib{0}.so.7.5',
-                  'nvvm_lib_fmt': 'lib{0}.so.3.0.0',
-                  'libdevice_lib_fmt': 'libdevice.compute_{0}.bc'
-                  }
-
-cu_75['windows'] = {'blob': 'cuda_7.5.18_win10.exe',
-                    'patches': [],
-                    'cuda_lib_fmt': '{0}64_75.dll',
-                    'nvvm_lib_fmt': '{0}64_30_0.dll',
-                    'libdevice_lib_fmt': 'libdevice.compute_{0}.bc'
-                    }
-
-cu_75['osx'] = {'blob': 'cuda_7.5.27_mac.dmg',
-                'patches': [],
-                'cuda_lib_fmt': 'lib{0}.7.5.dylib',
-                'nvvm_lib_fmt': 'lib{0}.3.0.0.dylib',
-                'libdevice_lib_fmt': 'libdevice.compute_{0}.bc'
-                }
-
-######################
-### CUDA 8.0 setup ###
-######################
-
-cu_8 = config['8.0']
-cu_8['base_url'] = "https://developer.nvidia.com/compute/cuda/8.0/Prod2/"
-cu_8['installers_url_ext'] = 'local_installers/'
-cu_8['patch_url_ext'] = 'patches/2/'
-cu_8['md5_url'] = "https://developer.nvidia.com/compute/cuda/8.0/Prod2/docs/sidebar/md5sum-txt"
-cu_8['pkg_libs'] = {
-    'cudart': ['cudart'],
-    'cufft': ['cufft'],
-    'cublas': ['cublas'],
-    'cusparse': ['cusparse'],
-    'curand': ['curand'],
-    'cusolver': ['cusolver'],
-    'npp': ['nppc', 'nppi', 'npps'],
-    'nvrtc': ['nvrtc', 'nvrtc-builtins'],
-    'nvblas': ['nvblas'],
-    'nvgraph': ['nvgraph'],
-    'cupti': ['cupti'],
-    'nvtx': ['nvToolsExt'], # Change package name to nvToolsExt?
-    'nvvm': ['nvvm', '20.10', '30.10', '35.10', '50.10'],
-    }
-cu_8['libdevice_versions'] = ['20.10', '30.10', '35.10', '50.10']
-
-cu_8['linux'] = {'blob': 'cuda_8.0.61_375.26_linux-run',
-                 'patches': ['cuda_8.0.61.2_linux-run'],
-                 # need globs to handle symlinks
-                 'cuda_lib_fmt': 'lib{0}.so*',
-                 'nvtoolsext_fmt': 'lib{0}.so*',
-                 'nvvm_lib_fmt': 'lib{0}.so*',
-                 'libdevice_lib_fmt': 'libdevice.compute_{0}.bc'
-                 }
-
-cu_8['windows'] = {'blob': 'cuda_8.0.61_windows-exe',
-                   'patches': ['cuda_8.0.61.2_windows-exe'],
-                   'cuda_lib_fmt': '{0}64_80.dll',
-                   'nvtoolsext_fmt': '{0}64_1.dll',
-                   'nvvm_lib_fmt': '{0}64_31_0.dll',
-                   'libdevice_lib_fmt': 'libdevice.compute_{0}.bc',
-                   'NvToolsExtPath' :
-                       os.path.join('c:' + os.sep, 'Program Files',
-                                    'NVIDIA Corporation', 'NVToolsExt', 'bin')
-                   }
-
-cu_8['osx'] = {'blob': 'cuda_8.0.61_mac-dmg',
-               'patches': ['cuda_8.0.61.2_mac-dmg'],
-               'cuda_lib_fmt': 'lib{0}.8.0.dylib',
-               'nvtoolsext_fmt': 'lib{0}.1.dylib',
-               'nvvm_lib_fmt': 'lib{0}.3.1.0.dylib',
-               'libdevice_lib_fmt': 'libdevice.compute_{0}.bc'
-               }
-
-######################
-### CUDA 9.0 setup ###
-######################
-cu_9 = config['9.0']
-cu_9['base_url'] = "https://developer.nvidia.com/compute/cuda/9.0/Prod/"
-cu_9['installers_url_ext'] = 'local_installers/'
-cu_9['md5_url'] = "https://developer.download.nvidia.com/compute/cuda/9.0/Prod/docs/sidebar/md5sum.txt"
-cu_9['patch_url_ext'] = ''
-cu_9['pkg_libs'] = {
-    'cudart': ['cudart'],
-    'cufft': ['cufft'],
-    'cublas': ['cublas'],
-    'cusparse': ['cusparse'],
-    'curand': ['curand'],
-    'cusolver': ['cusolver'],
-    'npp': ['nppc', 'nppial', 'nppicc', 'nppicom', 'nppidei', 'nppif', 'nppig', 'nppim', 'nppist', 'nppisu', 'nppitc', 'npps'],
-    'nvrtc': ['nvrtc', 'nvrtc-builtins'],
-    'nvblas': ['nvblas'],
-    'nvgraph': ['nvgraph'],
-    'cupti': ['cupti'],
-    'nvtx': ['nvToolsExt'], # Change package name to nvToolsExt?
-    'nvvm': ['nvvm', '10'],
-    }
-cu_9['libdevice_versions'] = ['10']
-
-cu_9['linux'] = {'blob': 'cuda_9.0.176_384.81_linux-run',
-                 'patches': [],
-                 # need globs to handle symlinks
-                 'cuda_lib_fmt': 'lib{0}.so*',
-                 'nvtoolsext_fmt': 'lib{0}.so*',
-                 'nvvm_lib_fmt': 'lib{0}.so*',
-                 'libdevice_lib_fmt': 'libdevice.{0}.bc'
-                 }
-
-cu_9['windows'] = {'blob': 'cuda_9.0.176_windows-exe',
-                   'patches': [],
-                   'cuda_lib_fmt': '{0}64_90.dll',
-                   'nvtoolsext_fmt': '{0}64_1.dll',
-                   'nvvm_lib_fmt': '{0}64_32_0.dll',
-                   'libdevice_lib_fmt': 'libdevice.{0}.bc',
-                   'NvToolsExtPath' :
-                       os.path.join('c:' + os.sep, 'Program Files',
-                                    'NVIDIA Corporation', 'NVToolsExt', 'bin')
-                   }
-
-cu_9['osx'] = {'blob': 'cuda_9.0.176_mac-dmg',
-               'patches': [],
-               'cuda_lib_fmt': 'lib{0}.9.0.dylib',
-               'nvtoolsext_fmt': 'lib{0}.1.dylib',
-               'nvvm_lib_fmt': 'lib{0}.3.2.0.dylib',
-               'libdevice_lib_fmt': 'libdevice.{0}.bc'
-               }
-
-######################
-### CUDA 9.1 setup ###
-######################
-cu_91 = config['9.1']
-cu_91['base_url'] = "https://developer.nvidia.com/compute/cuda/9.1/Prod/"
-cu_91['installers_url_ext'] = 'local_installers/'
-cu_91['md5_url'] = "https://developer.download.nvidia.com/compute/cuda/9.1/Prod/docs/sidebar/md5sum.txt"
-cu_91['patch_url_ext'] = 'patches/1/'
-cu_91['pkg_libs'] = {
-    'cudart': ['cudart'],
-    'cufft': ['cufft'],
-    'cublas': ['cublas'],
-    'cusparse': ['cusparse'],
-    'curand': ['curand'],
-    'cusolver': ['cusolver'],
-    'npp': ['nppc', 'nppial', 'nppicc', 'nppicom', 'nppidei', 'nppif', 'nppig', 'nppim', 'nppist', 'nppisu', 'nppitc', 'npps'],
-    'nvrtc': ['nvrtc', 'nvrtc-builtins'],
-    'nvblas': ['nvblas'],
-    'nvgraph': ['nvgraph'],
-    'cupti': ['cupti'],
-    'nvtx': ['nvToolsExt'], # Change package name to nvToolsExt?
-    'nvvm': ['nvvm', '10'],
-    }
-cu_91['libdevice_versions'] = ['10']
-
-cu_91['linux'] = {'blob': 'cuda_9.1.85_387.26_linux',
-                 'patches': ['cuda_9.1.85.1_linux'],
-                 # need globs to handle symlinks
-                 'cuda_lib_fmt': 'lib{0}.so*',
-                 'nvtoolsext_fmt': 'lib{0}.so*',
-                 'nvvm_lib_fmt': 'lib{0}.so*',
-                 'libdevice_lib_fmt': 'libdevice.{0}.bc'
-                 }
-
-cu_91['windows'] = {'blob': 'cuda_9.1.85_windows',
-                   'patches': ['cuda_9.1.85.1_windows'],
-                   'cuda_lib_fmt': '{0}64_91.dll',
-                   'nvtoolsext_fmt': '{0}64_1.dll',
-                   'nvvm_lib_fmt': '{0}64_32_0.dll',
-                   'libdevice_lib_fmt': 'libdevice.{0}.bc',
-                   'NvToolsExtPath' :
-                       os.path.join('c:' + os.sep, 'Program Files',
-                                    'NVIDIA Corporation', 'NVToolsExt', 'bin')
-                   }
-
-cu_91['osx'] = {'blob': 'cuda_9.1.128_mac',
-               'patches': [],
-               'cuda_lib_fmt': 'lib{0}.9.1.dylib',
-               'nvtoolsext_fmt': 'lib{0}.1.dylib',
-               'nvvm_lib_fmt': 'lib{0}.3.2.0.dylib',
-               'libdevice_lib_fmt': 'libdevice.{0}.bc'
-               }
+
+config = _LazyConfig()
+versions = sorted((fn[:-len('.json')] for fn in os.listdir(config_dir)
+                   if fn.endswith('.json')), key=version_key)
+
+
+@functools.lru_cache(maxsize=None)
+def scripts_digest():
+    """Returns the sha256 of the build scripts, build.py and the modules next
+    to it, any change to them may change what is staged. Computed once.
+    """
+    h = hashlib.sha256()
+    for fn in sorted(os.listdir(scripts_dir)):
+        if fn.endswith('.py'):
+            h.update(fn.encode('utf-8') + b'\0')
+            with open(os.path.join(scripts_dir, fn), 'rb') as f:
+                h.update(hashlib.sha256(f.read()).digest())
+    return h.hexdigest()
+
+
+def blob_downloads(ver_config, plt_config):
+    """Returns (url, filename) of the blob and each patch of a version and
+    platform, in that order.
+    """
+    base_url = ver_config['base_url']
+    dl_url = urlparse.urljoin(base_url, ver_config['installers_url_ext'])
+    downloads = [(urlparse.urljoin(dl_url, plt_config['blob']),
+                  plt_config['blob'])]
+    for p in plt_config['patches']:
+        dl_url = urlparse.urljoin(base_url, ver_config['patch_url_ext'])
+        downloads.append((urlparse.urljoin(dl_url, p), p))
+    return downloads
+
+
+def check_published_md5(md5_path, filename, md5sum, required=True):
+    """Checks md5sum against the checksums published in the file md5_path
+    for filename, if the file is not listed this is an error only if
+    required is set. Raises RuntimeError on a mismatch. Returns whether the
+    md5sum was checked against a published one.
+    """
+    # get checksums
+    with open(md5_path, 'r') as f:
+        checksums = [x.strip().split() for x in f.read().splitlines() if x]
+
+    # check md5 and filename match up
+    check_dict = {x[0]: x[1] for x in checksums}
+    name_prefix = filename[:-7]
+    if check_dict.get(md5sum, '').startswith(name_prefix):
+        return True
+    listed = any(x.startswith(name_prefix) for x in check_dict.values())
+    if required or listed:
+        msg = "md5sum mismatch for %s: %s" % (filename, md5sum)
+        raise RuntimeError(msg)
+    print("No published md5sum for %s, not verified" % filename)
+    return False
 
 
 class Extractor(object):
@@ -266,12 +165,24 @@ class Extractor(object):
               'osx': 'lib',
               'windows': os.path.join('Library', 'bin')}
 
-    def __init__(self, version, ver_config, plt_config):
+    # the platform the packages are for, which need not be the one the
+    # build runs on, set by the platform specific extractors
+    platform = None
+
+    def __init__(self, version, ver_config, plt_config, prefix=None,
+                 src_dir=None, cache_dir=None, hardlink=False):
         """Initialise an instance:
         Arguments:
           version - CUDA version string
           ver_config - the configuration for this CUDA version
           plt_config - the configuration for this platform
+          prefix - the install prefix, defaults to $PREFIX
+          src_dir - the directory holding the blobs, defaults to $SRC_DIR
+          cache_dir - the root of the build caches, see default_cache_dir()
+          hardlink - whether files may be staged into the prefix as hard
+                     links to the caches, only for prefixes nothing edits
+                     in place, conda-build relocates the libraries in its
+                     $PREFIX by rewriting them
         """
         self.cu_version = version
         self.md5_url = ver_config['md5_url']
@@ -287,62 +198,363 @@ class Extractor(object):
         self.libdevice_lib_fmt = plt_config['libdevice_lib_fmt']
         self.patches = plt_config['patches']
         self.nvtoolsextpath = plt_config.get('NvToolsExtPath')
+        self.plt_config = plt_config
         self.config = {'version': version, **ver_config}
-        self.prefix = os.environ['PREFIX']
-        self.src_dir = os.environ['SRC_DIR']
-        self.output_dir = os.path.join(self.prefix, self.libdir[getplatform()])
-        self.symlinks = getplatform() == 'linux'
-        try:
-            os.mkdir(self.output_dir)
-        except FileExistsError:
-            pass
-
-    def create_link_scripts(self, pkg_name):
+        self.src_dir = src_dir or os.environ['SRC_DIR']
+        self.symlinks = self.platform == 'linux'
+        self.md5sums = {}
+        # the published md5sums are fetched once per run, see fetch_md5_list()
+        self._md5_list = None
+        self._md5_lock = threading.Lock()
+        self._indexes = {}
+        # listing of the store the indexes are built from instead of the
+        # store itself, see use_listing()
+        self.listing = None
+        # sha256 by (device, inode, size, mtime), shared by for_prefix copies
+        self._digests = {}
+        self.stage_mode = os.environ.get('CUDATOOLKIT_STAGE_MODE', 'auto')
+        if not hardlink:
+            self.stage_mode = unshared(self.stage_mode)
+        self.extract_peak_bytes = None
+        self.cache_dir = cache_dir or default_cache_dir()
+        self.checksums = ChecksumCache(self.cache_dir)
+        self.blob_cache = BlobCache(*blob_cache_config(self.cache_dir))
+        # a mirror tried before upstream, see mirror.py
+        self.mirror = os.environ.get('CUDATOOLKIT_MIRROR') or None
+        # the tool the staged linux libraries are slimmed with, see slim.py
+        self.slim_tool = None
+        if slim.enabled() and self.platform == 'linux':
+            self.slim_tool = slim.find_tool()
+            if self.slim_tool is None:
+                print("CUDATOOLKIT_SLIM is set but neither strip nor objcopy "
+                      "is installed, not slimming")
+        self._set_prefix(prefix or os.environ['PREFIX'])
+
+    def _set_prefix(self, prefix):
+        self.prefix = prefix
+        # the paths relative to prefix of everything staged into it
+        self.staged = []
+        # the manifest of a payload restored from the staged output cache
+        self._restored_manifest = None
+        # the bytes slimming saved, when the staged libraries are slimmed
+        self.slim_saved = None
+        self.output_dir = os.path.join(self.prefix, self.libdir[self.platform])
+
+    def for_prefix(self, prefix):
+        """Returns a copy of this extractor that installs into prefix, the
+        copy shares the downloaded and extracted blobs.
+        """
+        other = shallow_copy(self)
+        other._set_prefix(prefix)
+        return other
+
+    def make_link_scripts(self, pkg_name, plan=None):
+        """Writes the scripts run when pkg_name is linked into and unlinked
+        from an environment, if the platform needs any. plan is the file
+        plan (see plan()) to take the libraries from, made if not given.
+        """
         pass
 
+    def fetch_cached(self, url, path, verify):
+        """Fetches url to path through the shared download cache, a cached
+        copy is hard linked into place rather than downloaded. verify is as
+        for fetch() and returns whether the file was checked against a
+        published checksum, only files that were are added to the cache. A
+        cached copy that fails verify is dropped and fetched again. Returns
+        the md5sum of the file or None if path already existed.
+        """
+        if not os.path.isfile(path):
+            md5sum = self.blob_cache.materialize(url, path)
+            if md5sum is not None:
+                try:
+                    verify(path, md5sum)
+                    return md5sum
+                except RuntimeError as e:
+                    print("Dropping cached %s: %s" % (url, e))
+                    os.remove(path)
+                    self.blob_cache.drop(url)
+        checked = []
+
+        def check(part, md5sum):
+            checked.append(verify(part, md5sum))
+
+        md5sum = self.fetch_mirrored(url, path, check)
+        if md5sum is not None and checked and checked[-1]:
+            self.blob_cache.insert(url, path, md5sum)
+        return md5sum
+
+    def fetch_mirrored(self, url, path, verify=None):
+        """Fetches url to path from the mirror in CUDATOOLKIT_MIRROR if one
+        is set, falling back to url itself if the mirror does not have it
+        (or has a bad copy). Returns as fetch().
+        """
+        if self.mirror is not None and not os.path.isfile(path):
+            source = mirror_url(self.mirror, url)
+            try:
+                return fetch(source, path, verify=verify)
+            except (OSError, ValueError, RuntimeError) as e:
+                print("Cannot fetch %s from the mirror (%s), trying %s" %
+                      (source, e, url))
+        return fetch(url, path, verify=verify)
+
     def download_blobs(self):
-        """Downloads the binary blobs to the $SRC_DIR
-        """
-        dl_url = urlparse.urljoin(self.base_url, self.installers_url_ext)
-        dl_url = urlparse.urljoin(dl_url, self.cu_blob)
-        dl_path = os.path.join(self.src_dir, self.cu_blob)
-        if not os.path.isfile(dl_path):
-            print("downloading %s to %s" % (dl_url, dl_path))
-            download(dl_url, dl_path)
-        else:
-            print("Using existing downloaded file: %s" % dl_path)
-        for p in self.patches:
-            dl_url = urlparse.urljoin(self.base_url, self.patch_url_ext)
-            dl_url = urlparse.urljoin(dl_url, p)
-            dl_path = os.path.join(self.src_dir, p)
-            if not os.path.isfile(dl_path):
-                print("downloading %s to %s" % (dl_url, dl_path))
-                download(dl_url, dl_path)
-            else:
-                print("Using existing downloaded patch: %s" % dl_path)
+        """Downloads the binary blobs and the md5 checksums to the $SRC_DIR,
+        the files are fetched concurrently through the download cache. Each
+        downloaded file is checked against the md5 checksums before it is
+        moved into place.
+        """
+        downloads = blob_downloads(self.config, self.plt_config)
+
+        with ThreadPoolExecutor(max_workers=len(downloads) + 1) as pool:
+            md5_dl = pool.submit(self.fetch_md5_list)
+
+            def download(url, fn):
+                path = os.path.join(self.src_dir, fn)
+
+                def verify(part, md5sum):
+                    md5_dl.result()
+                    return self._check_file_md5(fn, md5sum,
+                                                required=fn == self.cu_blob)
+
+                # the md5sum is computed whilst downloading, keep it so the
+                # file is not read again to verify it
+                md5sum = self.fetch_cached(url, path, verify)
+                if md5sum is not None:
+                    self.checksums.record(path, md5sum)
+                    self.md5sums[fn] = md5sum
+
+            blob_dls = [pool.submit(download, url, fn) for url, fn in downloads]
+            for dl in [md5_dl] + blob_dls:
+                dl.result()
+
+    def md5_path(self):
+        """The path of the downloaded md5 checksums file
+        """
+        return os.path.join(self.src_dir, self.md5_url.split('/')[-1])
+
+    def fetch_md5_list(self):
+        """Fetches the published md5 checksums to md5_path(), replacing any
+        copy already there. The list changes upstream and cannot be checked
+        itself, so it is fetched once per run and never taken from the
+        download cache. Returns its path.
+        """
+        with self._md5_lock:
+            if self._md5_list is None:
+                path = self.md5_path()
+                fresh = path + '.fresh'
+                if os.path.isfile(fresh):
+                    os.remove(fresh)
+                self.fetch_mirrored(self.md5_url, fresh)
+                os.replace(fresh, path)
+                self._md5_list = path
+        return self._md5_list
 
     def check_md5(self):
-        """Checks the md5sums of the downloaded binaries
+        """Checks the md5sums of the downloaded blob and patches, the files
+        are hashed concurrently unless their md5sums are already known.
+        """
+        self.fetch_md5_list()
+
+        filenames = [self.cu_blob] + self.patches
+        with ThreadPoolExecutor(max_workers=len(filenames)) as pool:
+            md5sums = list(pool.map(self.file_md5, filenames))
+        for filename, md5sum in zip(filenames, md5sums):
+            self._check_file_md5(filename, md5sum,
+                                 required=filename == self.cu_blob)
+
+    def _check_file_md5(self, filename, md5sum, required=True):
+        """Checks md5sum against the published checksums for filename, see
+        check_published_md5()
         """
-        md5file = self.md5_url.split('/')[-1]
-        path = os.path.join(self.src_dir, md5file)
-        download(self.md5_url, path)
+        return check_published_md5(self.md5_path(), filename, md5sum,
+                                   required)
 
-        # compute hash of blob
-        blob_path = os.path.join(self.src_dir, self.cu_blob)
-        md5sum = hashsum_file(blob_path, 'md5')
+    def file_md5(self, filename):
+        """Returns the md5sum of a downloaded file in $SRC_DIR, the file is
+        only hashed if its md5sum is not in the persistent checksum cache.
+        """
+        if filename not in self.md5sums:
+            path = os.path.join(self.src_dir, filename)
+            self.md5sums[filename] = self.checksums.md5sum(path)
+        return self.md5sums[filename]
+
+    def cache_key(self):
+        """Returns the key of the extracted blob in the extraction cache, this
+        covers everything that determines the content of the extracted store.
+        """
+        h = hashlib.sha256()
+        for part in self._cache_key_parts():
+            h.update(part.encode('utf-8'))
+            h.update(b'\0')
+        return h.hexdigest()
+
+    def _cache_key_parts(self):
+        parts = [type(self).__name__, self.cu_version]
+        for fn in [self.cu_blob] + self.patches:
+            parts += [fn, self.file_md5(fn)]
+        return parts
+
+    def fingerprint(self, pkg_name):
+        """Returns the fingerprint of the payload staged for pkg_name, this
+        covers the blob and patch hashes, the configuration the package is
+        built from and the build scripts.
+        """
+        if pkg_name == 'cudatoolkit':
+            # the windows link scripts list the libraries of every package
+            pkg_libs = self.pkg_dict
+        else:
+            pkg_libs = self.pkg_dict.get(pkg_name)
+        inputs = {'package': pkg_name,
+                  'platform': self.platform,
+                  'blobs': self._cache_key_parts(),
+                  'pkg_libs': pkg_libs,
+                  'libdevice_versions': self.libdevice_versions,
+                  'platform_config': self.plt_config,
+                  'scripts': scripts_digest()}
+        if self.slim_tool is not None:
+            inputs['slim'] = os.path.basename(self.slim_tool[0])
+        data = json.dumps(inputs, sort_keys=True).encode('utf-8')
+        return hashlib.sha256(data).hexdigest()
+
+    def save_staged(self, cache, pkg_name):
+        """Stores everything staged into the prefix for pkg_name in the staged
+        output cache under its fingerprint, along with a manifest of it. The
+        payload is a copy (or reflink) of its own, conda-build rewrites the
+        files in the prefix after this.
+        """
+        mode = unshared(self.stage_mode)
+
+        def populate(entry):
+            files, links = [], {}
+            for rel in sorted(set(self.staged)):
+                src = os.path.join(self.prefix, rel)
+                if os.path.islink(src):
+                    links[rel] = os.readlink(src)
+                    continue
+                dst = os.path.join(entry, 'payload', rel)
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                stage_file(src, dst, mode)
+                files.append(rel)
+            return {'package': pkg_name, 'files': files, 'links': links,
+                    'output': '%s/%s/%s' % (self.platform, self.cu_version,
+                                            pkg_name),
+                    'manifest': self.manifest(pkg_name)}
+        cache.fetch(self.fingerprint(pkg_name), populate)
+
+    def _payload_problems(self, payload, saved):
+        """Returns the files of a staged output cache payload that differ
+        from the size and sha256 recorded for them in saved, the metadata
+        stored with it.
+        """
+        recorded = (saved.get('manifest') or {}).get('files', {})
 
-        # get checksums
-        with open(md5file, 'r') as f:
-            checksums = [x.strip().split() for x in f.read().splitlines() if x]
+        def differs(rel):
+            path = os.path.join(payload, rel)
+            expected = recorded.get(rel)
+            try:
+                return (expected is None or
+                        os.path.getsize(path) != expected['size'] or
+                        self.file_sha256(path) != expected['sha256'])
+            except FileNotFoundError:
+                return True
+
+        with ThreadPoolExecutor() as pool:
+            bad = list(pool.map(differs, saved['files']))
+        return [rel for rel, b in zip(saved['files'], bad) if b]
+
+    def restore_staged(self, cache, pkg_name):
+        """Stages the payload of pkg_name from the staged output cache if its
+        fingerprint is unchanged. Returns the number of files restored, or
+        None if the cache has no payload for the fingerprint. A payload that
+        no longer matches its manifest is dropped from the cache, which is
+        then a miss.
+        """
+        key = self.fingerprint(pkg_name)
+        manifest = cache.lookup(key)
+        if manifest is None:
+            return None
+        payload = os.path.join(cache.entry(key), 'payload')
+        problems = self._payload_problems(payload, manifest)
+        if problems:
+            print("Staged output cache entry %s of %s is damaged (%s), "
+                  "dropping it" % (cache.entry(key), pkg_name,
+                                   ', '.join(problems[:5])))
+            cache.discard(key)
+            return None
+        for rel, target in sorted(manifest['links'].items()):
+            path = os.path.join(self.prefix, rel)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if os.path.lexists(path):
+                os.remove(path)
+            os.symlink(target, path)
+        for rel in manifest['files']:
+            path = os.path.join(self.prefix, rel)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            stage_file(os.path.join(payload, rel), path, self.stage_mode)
+        self.staged = manifest['files'] + list(manifest['links'])
+        self._restored_manifest = manifest.get('manifest')
+        print("Restored %d files of %s from %s" %
+              (len(self.staged), pkg_name, cache.entry(key)))
+        return len(self.staged)
+
+    def file_sha256(self, path):
+        """Returns the sha256 of the file at path, hard links to one file
+        (such as the staged copies of an extracted file) are hashed once.
+        """
+        st = os.stat(path)
+        key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+        digest = self._digests.get(key)
+        if digest is None:
+            digest = self._digests[key] = md5sum_file(path, 'sha256')
+        return digest
+
+    def manifest(self, pkg_name):
+        """Returns the manifest of everything staged for pkg_name: the size
+        and sha256 of each file and where each symlink leads, see
+        manifest.py.
+        """
+        if self._restored_manifest is not None:
+            return self._restored_manifest
+        files, links = manifest.describe(self.prefix, self.staged,
+                                         self.file_sha256)
+        return {'package': pkg_name,
+                'cuda_version': self.cu_version,
+                'platform': self.platform,
+                'files': files,
+                'links': links}
+
+    def extract_cached(self, cache):
+        """Extracts the blob through the shared extraction cache, the first
+        caller runs extract() into the cache entry, all subsequent callers
+        reuse it. Sets self.store as extract() would, and
+        extract_peak_bytes if the extraction is metered (see
+        phasetrace.disk_metering()).
+        """
+        def populate(entry):
+            if not disk_metering():
+                self.extract(entry)
+                return {'store': os.path.relpath(self.store, entry)}
+            with DiskMeter(entry) as meter:
+                self.extract(entry)
+            self.extract_peak_bytes = meter.peak
+            print("Extraction used at most %d bytes on disk, %d are kept" %
+                  (meter.peak, meter.final))
+            return {'store': os.path.relpath(self.store, entry),
+                    'peak_bytes': meter.peak, 'bytes': meter.final}
+        entry, meta = cache.fetch(self.cache_key(), populate)
+        self.store = os.path.normpath(os.path.join(entry, meta['store']))
+        self._indexes.clear()
 
-        # check md5 and filename match up
-        check_dict = {x[0]: x[1] for x in checksums}
-        assert check_dict[md5sum].startswith(self.cu_blob[:-7])
+    def copy(self, pkg_name):
+        """Copies the extracted files for pkg_name into the conda package
+        platform specific directory. Returns the number of files copied.
+        """
+        return self.copy_files(pkg_name, *self.lib_dirs())
 
-    def copy(self, *args):
-        """The method to copy extracted files into the conda package platform
-        specific directory. Platform specific extractors must implement.
+    def lib_dirs(self):
+        """The method returning the directories holding the extracted cuda
+        libraries, nvvm libraries and libdevice files, in that order.
+        Platform specific extractors must implement.
         """
         raise RuntimeError('Must implement')
 
@@ -352,13 +564,72 @@ class Extractor(object):
         """
         raise RuntimeError('Must implement')
 
+    def extract_mode(self):
+        """How the blob is extracted, CUDATOOLKIT_EXTRACT_MODE is one of:
+          stream - only the files the packages need are written, straight
+                   to the store, and it is an error if that is not possible
+          full - the blob is unpacked in full (or installed on linux)
+          auto - stream, falling back to full (the default)
+        """
+        mode = os.environ.get('CUDATOOLKIT_EXTRACT_MODE', 'auto')
+        if mode not in ('auto', 'stream', 'full'):
+            raise ValueError("Unknown extraction mode: %s" % mode)
+        return mode
+
+    def library_index(self, dirpath):
+        """Returns the index of dirpath, the directory is scanned once (or
+        read from the listing) and matched against all the patterns in
+        wanted_patterns().
+        """
+        index = self._indexes.get(dirpath)
+        if index is None:
+            patterns = [p for v in self.wanted_patterns().values() for p in v]
+            listing = None
+            if self.listing is not None:
+                rel = os.path.relpath(dirpath, self.store)
+                listing = self.listing.get(rel.replace(os.sep, '/'), [])
+            index = self._indexes[dirpath] = LibraryIndex(dirpath, patterns,
+                                                          listing)
+        return index
+
+    def store_listing(self):
+        """Returns the listing of the library directories of the store, a
+        dictionary of the directory relative to the store (with / as the
+        separator) to the entries of it, see LibraryIndex.listing().
+        """
+        listing = {}
+        for dirpath in sorted(set(self.lib_dirs())):
+            rel = os.path.relpath(dirpath, self.store).replace(os.sep, '/')
+            try:
+                listing[rel] = self.library_index(dirpath).listing()
+            except FileNotFoundError:
+                listing[rel] = []
+        return listing
+
+    def archive_listing(self):
+        """Returns the listing, as store_listing(), of the store extract()
+        would produce by reading the archives in src_dir rather than
+        extracting them. Raises ValueError if that is not possible.
+        """
+        raise ValueError("%s cannot list its archives" % type(self).__name__)
+
+    def use_listing(self, listing, store=None):
+        """Plans from listing, as returned by store_listing(), rather than
+        from an extracted store. store is the directory the listing is of,
+        only the paths in the plan depend on it.
+        """
+        self.store = store or os.path.abspath('store')
+        self.listing = listing
+        self._indexes.clear()
+
     def get_paths(self, libraries, dirpath, template, pkg_filter=None):
         """Gets the paths to the various cuda libraries and bc files
         """
+        index = self.library_index(dirpath)
         pathlist = []
         for libname in libraries:
             filename = template.format(libname)
-            paths = fnmatch.filter(os.listdir(dirpath), filename)
+            paths = index.find(filename)
             if not paths:
                 msg = ("Cannot find item: %s, looked for %s" %
                        (libname, filename))
@@ -369,124 +640,363 @@ class Extractor(object):
                 msg += ". Found: \n"
                 msg += ', \n'.join([str(x) for x in paths])
                 raise RuntimeError(msg)
-            pathsforlib = []
             for path in paths:
-                tmppath = os.path.join(dirpath, path)
-                assert os.path.isfile(tmppath), 'missing {0}'.format(tmppath)
-                pathsforlib.append(tmppath)
+                assert index.exists(path), 'missing {0}'.format(index.path(path))
             if self.symlinks: # deal with symlinked items
                 # get all DSOs
-                concrete_dsos = [x for x in pathsforlib 
-                                 if not os.path.islink(x)]
-                # find the most recent library version by name
-                target_library = max(concrete_dsos)
+                concrete_dsos = [x for x in paths if not index.is_link(x)]
+                # find the most recent library version by version number
+                target_library = max(concrete_dsos, key=version_key)
                 # remove this from the list of concrete_dsos
                 # all that remains are DSOs that are not wanted
                 concrete_dsos.remove(target_library)
-                # drop the unwanted DSOs from the paths
-                [pathsforlib.remove(x) for x in concrete_dsos]
-            pathlist.extend(pathsforlib)
+                # drop the unwanted DSOs from the paths, along with the
+                # symlinks that lead to them
+                paths = [x for x in paths if x not in concrete_dsos and
+                         index.resolve(x) not in concrete_dsos]
+            pathlist.extend(index.path(x) for x in paths)
         return pathlist
 
     def copy_files(self, pkg_name, cuda_lib_dir, nvvm_lib_dir, libdevice_lib_dir):
         """Copies the various cuda libraries and bc files to the output_dir
         """
         if pkg_name == 'cudatoolkit':
-            return
-        filepaths = self._get_filepaths(pkg_name, cuda_lib_dir, nvvm_lib_dir, libdevice_lib_dir)
-        for fn in filepaths:
-            if os.path.islink(fn):
+            return 0
+        entries = self.plan_package(pkg_name, cuda_lib_dir, nvvm_lib_dir, libdevice_lib_dir)
+        copied = self.stage_plan(entries)
+        self.write_lib_index(pkg_name, entries)
+        return copied
+
+    def write_lib_index(self, pkg_name, entries):
+        """Writes the index of the libraries staged for pkg_name by the plan
+        entries into output_dir/cudatoolkit-libs/<pkg_name>.json, see
+        cudalibs.py which reads them and is installed along with the index
+        of cudart.
+        """
+        libraries = {}
+        libs = {}
+        for entry in entries:
+            libs.setdefault(entry['library'], []).append(entry)
+        for name, planned in libs.items():
+            links = sorted(os.path.basename(e['destination']) for e in planned
+                           if e['action'] == 'symlink')
+            files = [os.path.join(self.prefix, e['destination'])
+                     for e in planned if e['action'] == 'copy']
+            if len(files) != 1:
+                msg = ("Expected one file for %s, found %s" %
+                       (name, ', '.join(files)))
+                raise RuntimeError(msg)
+            path = files[0]
+            # no size or hash, conda-build rewrites the file when it
+            # relocates it after this
+            libraries[name] = {'file': os.path.basename(path),
+                               'links': links,
+                               'soname': binfmt.soname(path)}
+        index = {'package': pkg_name,
+                 'cuda_version': self.cu_version,
+                 'platform': self.platform,
+                 'libraries': libraries}
+        index_dir = os.path.join(self.output_dir, cudalibs.INDEX_DIR)
+        os.makedirs(index_dir, exist_ok=True)
+        index_path = os.path.join(index_dir, '%s.json' % pkg_name)
+        with open(index_path, 'w') as f:
+            json.dump(index, f, indent=2, sort_keys=True)
+        written = [index_path]
+        if pkg_name == 'cudart':
+            reader = os.path.join(index_dir, 'cudalibs.py')
+            shutil.copy(os.path.join(scripts_dir, 'cudalibs.py'), reader)
+            written.append(reader)
+        self.staged += [os.path.relpath(fn, self.prefix) for fn in written]
+        print("Wrote library index %s" % index_path)
+
+    def stage_plan(self, entries, jobs=None):
+        """Stages the plan entries of a package (see plan()) into the prefix,
+        symlinks are created as planned and files are staged concurrently
+        with stage_file() using self.stage_mode (CUDATOOLKIT_STAGE_MODE),
+        then slimmed if CUDATOOLKIT_SLIM is set (see slim.py). Returns the
+        number of entries staged.
+        """
+        os.makedirs(self.output_dir, exist_ok=True)
+        files = []
+        for entry in entries:
+            dst = os.path.join(self.prefix, entry['destination'])
+            if entry['action'] == 'symlink':
                 # replicate symlinks
-                symlinktarget = os.readlink(fn)
-                targetname = os.path.basename(fn)
-                symlink = os.path.join(self.output_dir, targetname)
-                print('linking %s to %s' % (symlinktarget, symlink))
-                os.symlink(symlinktarget, symlink)
+                print('linking %s to %s' % (entry['target'], dst))
+                if os.path.lexists(dst):
+                    os.remove(dst)
+                os.symlink(entry['target'], dst)
             else:
-                print('copying %s to %s' % (fn, self.output_dir))
-                shutil.copy(fn, self.output_dir)
+                files.append((os.path.join(self.store, entry['source']), dst))
+            self.staged.append(entry['destination'])
+
+        def stage(item):
+            src, dst = item
+            method = stage_file(src, dst, self.stage_mode)
+            print('copying %s to %s (%s)' % (src, os.path.dirname(dst), method))
+
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            list(pool.map(stage, files))
+        if self.slim_tool is not None and files:
+            slimmed, before, self.slim_saved = slim.slim_files(
+                [dst for src, dst in files], self.slim_tool, jobs)
+            print("Slimmed %d libraries in %s, saved %d of %d bytes" %
+                  (slimmed, self.prefix, self.slim_saved, before))
+        return len(entries)
+
+    def wanted_patterns(self):
+        """Returns the filename patterns of everything any package needs as a
+        dictionary keyed by the library directory they are found in, one of
+        'cuda', 'nvvm' or 'libdevice'.
+        """
+        cuda = []
+        for pkg_name, libs in self.pkg_dict.items():
+            if pkg_name == 'nvtx':
+                cuda += [self.nvtoolsext_fmt.format(lib) for lib in libs]
+            elif pkg_name != 'nvvm':
+                cuda += [self.cuda_lib_fmt.format(lib) for lib in libs]
+        return {'cuda': cuda,
+                'nvvm': [self.nvvm_lib_fmt.format('nvvm')],
+                'libdevice': [self.libdevice_lib_fmt.format(v)
+                              for v in self.libdevice_versions]}
+
+    def plan(self, pkg_names):
+        """Returns the file plan of pkg_names, a dictionary of package name to
+        a list of entries, one per file staged into the prefix:
+          library - the logical name of the library, as in the library index
+          source - the extracted file, relative to the store
+          destination - where it is staged, relative to the prefix
+          action - 'copy' or 'symlink'
+          size - the bytes copied, for a copy
+          target - the target of the link, for a symlink
+        The plan comes from the indexes of the library directories alone,
+        the files themselves are only looked at for their sizes (and not
+        at all when planning from a listing).
+        """
+        lib_dirs = self.lib_dirs()
+        return {pkg_name: self.plan_package(pkg_name, *lib_dirs)
+                for pkg_name in pkg_names if pkg_name != 'cudatoolkit'}
 
-    def _get_filepaths(self, pkg_name, cuda_lib_dir, nvvm_lib_dir, libdevice_lib_dir):
-        filepaths = []
+    def plan_package(self, pkg_name, cuda_lib_dir, nvvm_lib_dir, libdevice_lib_dir):
+        """Returns the plan entries of pkg_name, see plan()
+        """
+        libdir = self.libdir[self.platform]
+        entries = []
+        libs = self._get_libraries(pkg_name, cuda_lib_dir, nvvm_lib_dir,
+                                   libdevice_lib_dir)
+        for library, paths in libs.items():
+            for path in paths:
+                index = self.library_index(os.path.dirname(path))
+                name = os.path.basename(path)
+                entry = {'library': library,
+                         'source': os.path.relpath(path, self.store),
+                         'destination': os.path.join(libdir, name)}
+                if index.is_link(name):
+                    entry.update(action='symlink', target=index.links[name])
+                else:
+                    entry.update(action='copy', size=index.size(name))
+                entries.append(entry)
+        return entries
+
+    def _get_libraries(self, pkg_name, cuda_lib_dir, nvvm_lib_dir, libdevice_lib_dir):
+        """Returns a dictionary of the logical name of each library in
+        pkg_name to its extracted files, in package order.
+        """
         # nvToolsExt (nvtx) and nvvm are different from the rest of the cuda libraries,
         # it follows a different naming convention, this accommodates...
         if pkg_name == 'nvtx':
-            filepaths += self.get_paths(self.pkg_dict[pkg_name], cuda_lib_dir,
-                                        self.nvtoolsext_fmt)
+            libs = [(lib, lib, cuda_lib_dir, self.nvtoolsext_fmt)
+                    for lib in self.pkg_dict[pkg_name]]
         elif pkg_name == 'nvvm':
-            filepaths += self.get_paths(('nvvm',), nvvm_lib_dir, self.nvvm_lib_fmt)
-            filepaths += self.get_paths(self.libdevice_versions, libdevice_lib_dir,
-                                        self.libdevice_lib_fmt)
+            libs = [('nvvm', 'nvvm', nvvm_lib_dir, self.nvvm_lib_fmt)]
+            # libdevice is known by its file name, e.g. libdevice.10
+            libs += [(os.path.splitext(self.libdevice_lib_fmt.format(v))[0], v,
+                      libdevice_lib_dir, self.libdevice_lib_fmt)
+                     for v in self.libdevice_versions]
         else:
-            filepaths += self.get_paths(self.pkg_dict[pkg_name], cuda_lib_dir,
-                                        self.cuda_lib_fmt)
-        return filepaths
+            libs = [(lib, lib, cuda_lib_dir, self.cuda_lib_fmt)
+                    for lib in self.pkg_dict[pkg_name]]
+        libraries = {}
+        for name, lib, dirpath, template in libs:
+            libraries[name] = self.get_paths((lib,), dirpath, template)
+        return libraries
 
     def dump_config(self, pkg_name):
         """Dumps the config dictionary into the output directory
         """
         dumpfile = os.path.join(self.output_dir, '{}_config.yaml'.format(pkg_name))
+        import yaml  # only needed here, slow to import
         with open(dumpfile, 'w') as f:
             yaml.dump(self.config, f, default_flow_style=False)
 
 
+def windows_link_scripts(filenames):
+    """Returns the text of the post-link and pre-unlink scripts of the
+    cudatoolkit package on windows for filenames, the files in
+    %PREFIX%\\Library\\bin to make visible in %PREFIX%\\DLLs. Each file is
+    hard linked, or copied where that fails (e.g. across volumes), and the
+    output of every command goes to .messages.txt in a single redirection.
+    With no filenames the scripts do nothing, cmd rejects an empty block.
+    """
+    if not filenames:
+        return '@echo off\n', '@echo off\n'
+    messages = '>> "%PREFIX%\\.messages.txt" 2>&1'
+    src = '"%PREFIX%\\Library\\bin\\{0}"'
+    dst = '"%PREFIX%\\DLLs\\{0}"'
+    link = 'mklink /H {1} {0} || copy /Y {0} {1}'.format(src, dst)
+    post_link = ['@echo off',
+                 'if not exist "%PREFIX%\\DLLs" mkdir "%PREFIX%\\DLLs"',
+                 '(']
+    post_link += ['  ' + link.format(fn) for fn in filenames]
+    post_link += [') ' + messages]
+    pre_unlink = ['@echo off', '(']
+    pre_unlink += ['  del /F /Q ' + dst.format(fn) for fn in filenames]
+    pre_unlink += [') ' + messages]
+    return '\n'.join(post_link) + '\n', '\n'.join(pre_unlink) + '\n'
+
+
 class WindowsExtractor(Extractor):
-    """The windows extractor
+    """The windows extractor, the installers are read with 7za so this runs
+    on any platform.
     """
 
-    def copy(self, pkg_name):
-        self.copy_files(pkg_name,
-            cuda_lib_dir=self.store,
-            nvvm_lib_dir=self.store,
-            libdevice_lib_dir=self.store)
+    platform = 'windows'
+
+    def lib_dirs(self):
+        return self.store, self.store, self.store
 
-    def make_link_scripts(self, pkg_name):
+    def make_link_scripts(self, pkg_name, plan=None):
         if pkg_name == 'cudatoolkit':
-            self._create_cudatoolkit_link_scripts()
-
-
-    def _create_cudatoolkit_link_scripts(self):
-        # Can this be pulled from meta.yaml?
-        cudatoolkit_numba_deps = ['cudart', 'cufft', 'cublas',
-                                  'cusparse', 'curand', 'cusolver',
-                                  'npp', 'nvrtc', 'nvvm']
-        post_link_lines = []
-        pre_unlink_lines = []
-        post_link_template = ("mklink /H %PREFIX%\\DLLs\\{0} "
-                              "%PREFIX%\Library\\bin\\{0} "
-                              ">> %PREFIX%\\.messages.txt")
-        pre_unlink_template = ("del %PREFIX%\\DLLs\\{0} "
-                               ">> %PREFIX%\\.messages.txt")
-        for dep in cudatoolkit_numba_deps:
-            filepaths = self._get_filepaths(dep, self.store,
-                                            self.store, self.store)
-            fns = [os.path.basename(filepath) for filepath in filepaths]
-            post_link_lines += (post_link_template.format(fn) for fn in fns)
-            pre_unlink_lines += (pre_unlink_template.format(fn) for fn in fns)
+            self._create_cudatoolkit_link_scripts(plan)
+
+    def _cache_key_parts(self):
+        # the store also holds the dlls from the NvToolsExt install, and
+        # every dll in the blob if it is unpacked in full
+        nvt_path = os.environ.get('NVTOOLSEXT_INSTALL_PATH', self.nvtoolsextpath)
+        method = 'full' if self.extract_mode() == 'full' else 'selective'
+        return super()._cache_key_parts() + [str(nvt_path), method]
+
+    def _create_cudatoolkit_link_scripts(self, plan=None):
+        # every package cudatoolkit depends on, see meta.yaml
+        deps = sorted(self.pkg_dict)
+        if plan is None or not all(dep in plan for dep in deps):
+            plan = self.plan(deps)
+        filenames = sorted({os.path.basename(entry['destination'])
+                            for dep in deps for entry in plan[dep]})
+        post_link, pre_unlink = windows_link_scripts(filenames)
         print("Post-Link Commands:\n")
-        print("\n".join(post_link_lines))
-        print("Pre-Unlink Link Commands:\n")
-        print("\n".join(post_link_lines))
-        post_link_fn = os.path.join(self.prefix, "Scripts",
-                                    ".cudatoolkit-post-link.bat")
-        pre_unlink_fn = os.path.join(self.prefix, "Scripts",
-                                    ".cudatoolkit-pre-unlink.bat")
-        with open(post_link_fn, "w") as post_link_file:
-            for line in post_link_lines:
-                post_link_file.write("{}\n".format(line))
-        with open(pre_unlink_fn, "w") as pre_unlink_file:
-            for line in pre_unlink_lines:
-                pre_unlink_file.write("{}\n".format(line))
-
+        print(post_link)
+        print("Pre-Unlink Commands:\n")
+        print(pre_unlink)
+        scripts = os.path.join(self.prefix, "Scripts")
+        os.makedirs(scripts, exist_ok=True)
+        written = []
+        for name, text in (("post-link", post_link),
+                           ("pre-unlink", pre_unlink)):
+            fn = os.path.join(scripts, ".cudatoolkit-%s.bat" % name)
+            # cmd wants CRLF line endings
+            with open(fn, "w", newline="\r\n") as f:
+                f.write(text)
+            written.append(fn)
+        self.staged += [os.path.relpath(fn, self.prefix) for fn in written]
 
     def extract(self, extract_dir):
+        self.store = os.path.join(extract_dir, 'DLLs')
+        mode = self.extract_mode()
+        if mode == 'full':
+            self.extract_all(extract_dir)
+        else:
+            os.mkdir(self.store)
+            try:
+                self.extract_selective(self.store)
+            except ValueError as e:
+                if mode == 'stream':
+                    raise
+                print("Selective extraction failed (%s), unpacking "
+                      "everything" % e)
+                shutil.rmtree(self.store)
+                self.extract_all(extract_dir)
+
+        nvt_path = os.environ.get('NVTOOLSEXT_INSTALL_PATH', self.nvtoolsextpath)
+        print("NvToolsExt path: %s" % nvt_path)
+        if nvt_path is not None:
+            if not Path(nvt_path).is_dir():
+                msg = ("NVTOOLSEXT_INSTALL_PATH is invalid "
+                        "or inaccessible: %s" % nvt_path)
+                raise ValueError(msg)
+            for path, dirs, files in os.walk(nvt_path):
+                for filename in fnmatch.filter(files, "*.dll"):
+                    if not Path(os.path.join(
+                            self.store, filename)).is_file():
+                        shutil.copy(
+                            os.path.join(path, filename),
+                            self.store)
+
+    def _select_members(self):
+        """Lists the blob and the patches and returns a dictionary of the
+        filename of each file the packages need to (archive, member, size)
+        of the copy of it to extract, a file in a patch replaces the one of
+        the same name in the blob. Raises ValueError if the archives cannot
+        be listed.
+        """
+        import sevenzip  # only needed when extracting
+
+        patterns = [p for v in self.wanted_patterns().values() for p in v]
+        match = re.compile('|'.join(fnmatch.translate(p)
+                                    for p in patterns)).match
+        chosen = {}
+        for runfile in [self.cu_blob] + self.patches:
+            path = os.path.join(self.src_dir, runfile)
+            found = {}
+            for name, size in sorted(sevenzip.list_members(path)):
+                dirname, filename = posixpath.split(name)
+                if 'jre' not in dirname and match(filename):
+                    # the first of a name in an archive wins, as in a walk
+                    found.setdefault(filename, (path, name, size))
+            chosen.update(found)
+        if not chosen:
+            raise ValueError("no libraries found in %s" % self.cu_blob)
+        return chosen
+
+    def archive_listing(self):
+        listing = {fn: size for fn, (_, _, size)
+                   in self._select_members().items()}
+        nvt_path = os.environ.get('NVTOOLSEXT_INSTALL_PATH', self.nvtoolsextpath)
+        if nvt_path is not None and Path(nvt_path).is_dir():
+            for path, dirs, files in os.walk(nvt_path):
+                for filename in fnmatch.filter(files, "*.dll"):
+                    if filename not in listing:
+                        listing[filename] = os.path.getsize(
+                            os.path.join(path, filename))
+        return {'.': [[fn, size, None] for fn, size in sorted(listing.items())]}
+
+    def extract_selective(self, store):
+        """Extracts just the dlls and bitcode files the packages need from
+        the blob and the patches straight into store. The archives are
+        listed first, a file in a patch replaces the one of the same name
+        in the blob. Raises ValueError if the blob cannot be read this way.
+        """
+        import sevenzip  # only needed when extracting
+
+        chosen = self._select_members()
+        for runfile in [self.cu_blob] + self.patches:
+            path = os.path.join(self.src_dir, runfile)
+            members = sorted(name for src, name, size in chosen.values()
+                             if src == path)
+            if members:
+                print("Extracting %d files from %s" % (len(members), runfile))
+                sevenzip.extract_files(path, members, store)
+        print("Extracted %d files" % len(chosen))
+
+    def extract_all(self, extract_dir):
+        """Unpacks the whole blob and the patches and copies every dll and
+        bitcode file into the store.
+        """
         runfile = self.cu_blob
         patches = self.patches
         try:
             extract_name = '__extracted'
             extractdir = os.path.join(extract_dir, extract_name)
-            store_name = 'DLLs'
-            self.store = os.path.join(extract_dir, store_name)
             try:
                 os.mkdir(extractdir)
                 check_call(['7za', 'x', '-o%s' %
@@ -497,15 +1007,6 @@ class WindowsExtractor(Extractor):
             except FileExistsError:
                 print("Files already extracted.")
 
-                
-            nvt_path = os.environ.get('NVTOOLSEXT_INSTALL_PATH', self.nvtoolsextpath)
-            print("NvToolsExt path: %s" % nvt_path)
-            if nvt_path is not None:
-                if not Path(nvt_path).is_dir():
-                    msg = ("NVTOOLSEXT_INSTALL_PATH is invalid "
-                            "or inaccessible.")
-                    raise ValueError(msg)
-                
             # fetch all the dlls into DLLs
             try:
                 os.mkdir(self.store)
@@ -523,16 +1024,10 @@ class WindowsExtractor(Extractor):
                                 shutil.copy(
                                     os.path.join(path, filename),
                                     self.store)
-                if nvt_path is not None:
-                    for path, dirs, files in os.walk(nvt_path):
-                        for filename in fnmatch.filter(files, "*.dll"):
-                            if not Path(os.path.join(
-                                    self.store, filename)).is_file():
-                                shutil.copy(
-                                    os.path.join(path, filename),
-                                    self.store)
             except FileExistsError:
                 print("Files already copied into store.")
+            # only the store is used from here on
+            shutil.rmtree(extractdir, ignore_errors=True)
         except PermissionError:
             # TODO: fix this
             # cuda 8 has files that refuse to delete, figure out perm changes
@@ -544,15 +1039,56 @@ class LinuxExtractor(Extractor):
     """The linux extractor
     """
 
-    def copy(self, pkg_name):
-        basepath = self.store
-        self.copy_files(pkg_name,
-            cuda_lib_dir=os.path.join(
-                basepath, 'lib64'), nvvm_lib_dir=os.path.join(
-                basepath, 'nvvm', 'lib64'), libdevice_lib_dir=os.path.join(
-                basepath, 'nvvm', 'libdevice'))
+    platform = 'linux'
+
+    # the nested makeself archive in the installer holding the toolkit
+    toolkit_runfile = 'cuda-linux*.run'
+
+    # where the library directories are in the toolkit, each is extracted
+    # into the store directory of its key, see lib_dirs()
+    toolkit_dirs = {('lib64',): 'cuda',
+                    ('extras', 'CUPTI', 'lib64'): 'cuda',
+                    ('nvvm', 'lib64'): 'nvvm',
+                    ('nvvm', 'libdevice'): 'libdevice'}
+
+    # the store directory of each key, relative to the store
+    store_dirs = {'cuda': ('lib64',),
+                  'nvvm': ('nvvm', 'lib64'),
+                  'libdevice': ('nvvm', 'libdevice')}
+
+    def lib_dirs(self):
+        return tuple(os.path.join(self.store, *self.store_dirs[key])
+                     for key in ('cuda', 'nvvm', 'libdevice'))
+
+    def use_installer(self):
+        """Whether to run the NVIDIA installer rather than extracting just
+        the needed files, set CUDATOOLKIT_USE_INSTALLER (or the extraction
+        mode to full) to force this.
+        """
+        return (bool(os.environ.get('CUDATOOLKIT_USE_INSTALLER')) or
+                self.extract_mode() == 'full')
+
+    def _cache_key_parts(self):
+        method = 'installer' if self.use_installer() else 'selective'
+        return super()._cache_key_parts() + [method]
 
     def extract(self, extract_dir):
+        if not self.use_installer():
+            try:
+                self.extract_selective(extract_dir)
+                return
+            except ValueError as e:
+                if self.extract_mode() == 'stream':
+                    raise
+                print("Selective extraction failed (%s), running the "
+                      "installer" % e)
+                # the installer starts from an empty directory
+                for name in os.listdir(extract_dir):
+                    path = os.path.join(extract_dir, name)
+                    if os.path.isdir(path) and not os.path.islink(path):
+                        shutil.rmtree(path)
+                    else:
+                        os.remove(path)
         runfile = self.cu_blob
         patches = self.patches
         os.chmod(runfile, 0o777)
@@ -565,6 +1101,79 @@ class LinuxExtractor(Extractor):
                         '--installdir', extract_dir, '--accept-eula', '--silent'])
         self.store = extract_dir
 
+    def _member_selector(self):
+        """Returns a function mapping a toolkit member name to the path it
+        should be extracted to, or None if no package needs it. Only the
+        directories in toolkit_dirs are looked in, not every directory of
+        the same name, and a path chosen for two members of one archive
+        raises ValueError rather than one silently replacing the other.
+        Call it once per archive, the patches do replace the blob's files.
+        """
+        matchers = {}
+        for key, patterns in self.wanted_patterns().items():
+            regex = '|'.join(fnmatch.translate(p) for p in patterns)
+            matchers[key] = re.compile(regex).match
+        chosen = {}
+
+        def select(name):
+            parts = tuple(name.split('/'))
+            key = self.toolkit_dirs.get(parts[:-1])
+            if key is None or not matchers[key](parts[-1]):
+                return None
+            rel = os.path.join(*(self.store_dirs[key] + parts[-1:]))
+            if chosen.setdefault(rel, name) != name:
+                msg = ("Both %s and %s would be extracted to %s" %
+                       (chosen[rel], name, rel))
+                raise ValueError(msg)
+            return rel
+        return select
+
+    def _is_toolkit_runfile(self, name):
+        return fnmatch.fnmatch(posixpath.basename(name), self.toolkit_runfile)
+
+    def archive_listing(self):
+        import makeself  # imports tarfile, only needed when listing
+        import tarfile
+
+        found = {}
+        for runfile in [self.cu_blob] + self.patches:
+            try:
+                found.update(makeself.list_members(
+                    os.path.join(self.src_dir, runfile),
+                    self._member_selector(), self._is_toolkit_runfile))
+            except (tarfile.TarError, OSError) as e:
+                raise ValueError("%s: %s" % (runfile, e))
+        if not found:
+            raise ValueError("no libraries found in %s" % self.cu_blob)
+        listing = {}
+        for rel, (size, target) in sorted(found.items()):
+            dirname, name = posixpath.split(rel.replace(os.sep, '/'))
+            listing.setdefault(dirname, []).append([name, size, target])
+        return listing
+
+    def extract_selective(self, extract_dir):
+        """Extracts just the files the packages need by streaming the
+        makeself payloads of the blob and then the patches, which overlay
+        it. Raises ValueError if the blob cannot be read this way.
+        """
+        import makeself  # imports tarfile, only needed when extracting
+        import tarfile
+
+        written = []
+        for runfile in [self.cu_blob] + self.patches:
+            print("Extracting libraries from %s" % runfile)
+            try:
+                written += makeself.extract(os.path.join(self.src_dir, runfile),
+                                            extract_dir,
+                                            self._member_selector(),
+                                            self._is_toolkit_runfile)
+            except tarfile.TarError as e:
+                raise ValueError("%s: %s" % (runfile, e))
+        if not written:
+            raise ValueError("no libraries found in %s" % self.cu_blob)
+        print("Extracted %d files" % len(set(written)))
+        self.store = extract_dir
+
 
 @contextmanager
 def _hdiutil_mount(mntpnt, image):
@@ -572,63 +1181,167 @@ def _hdiutil_mount(mntpnt, image):
     unmounted on exit.
     """
     check_call(['hdiutil', 'attach', '-mountpoint', mntpnt, image])
+    try:
+        yield mntpnt
+    finally:
+        check_call(['hdiutil', 'detach', mntpnt])
+
+
+@contextmanager
+def _directory_mount(mntpnt, image):
+    """Stands in for _hdiutil_mount when the image is a plain directory
+    holding what the mounted image would.
+    """
+    yield image
+
+
+@contextmanager
+def _sevenzip_mount(mntpnt, image):
+    """Stands in for _hdiutil_mount off osx, the .tar.gz payloads of the
+    image are unpacked into mntpnt with 7za, which reads the dmg and the
+    HFS+ volume in it.
+    """
+    import sevenzip  # only needed when extracting
+
+    patterns = ['*.tar.gz', '*.hfs', '*.hfsx']
+    try:
+        sevenzip.extract_tree(image, mntpnt, patterns)
+        # depending on the 7-Zip version the volume is unpacked or given
+        # as an image of its own
+        for path, dirs, files in os.walk(mntpnt):
+            for volume in fnmatch.filter(files, '*.hfs*'):
+                volume = os.path.join(path, volume)
+                sevenzip.extract_tree(volume, path, patterns[:1])
+                os.remove(volume)
+    except ValueError as e:
+        raise ValueError("Cannot unpack %s: %s" % (image, e))
     yield mntpnt
-    check_call(['hdiutil', 'detach', mntpnt])
+
+
+def _extract_tarball(tarpath, store, tag):
+    """Extracts the .dylib and .bc members of the tarball at tarpath into
+    store under temporary names made unique by tag. Returns a list of
+    (filename, temporary name) in member order. Run in a worker process.
+    The tarball is read as a stream, decompressed off the reading thread
+    (see decompress.py).
+    """
+    import tarfile  # only needed when extracting
+    from decompress import decompressed
+
+    extracted = []
+    # member name to its temporary name, and link name to (temporary name,
+    # the name of the member it links to)
+    files, links = {}, {}
+    with open(tarpath, 'rb') as f, \
+            decompressed(f, os.path.basename(tarpath)) as stream, \
+            tarfile.open(fileobj=stream, mode='r|*') as tar:
+        for member in tar:
+            name = posixpath.normpath(member.name)
+            filename = posixpath.basename(name)
+            if os.path.splitext(filename)[-1] not in ('.dylib', '.bc'):
+                continue
+            tmpname = '.%s.%s-%d' % (filename, tag, len(extracted))
+            if member.isfile():
+                with tar.extractfile(member) as src, \
+                        open(os.path.join(store, tmpname), 'wb') as dst:
+                    shutil.copyfileobj(src, dst, 1024 * 1024)
+                os.chmod(os.path.join(store, tmpname), member.mode & 0o777)
+                files[name] = tmpname
+            elif member.issym():
+                links[name] = (tmpname, posixpath.normpath(posixpath.join(
+                    posixpath.dirname(name), member.linkname)))
+            elif member.islnk():
+                links[name] = (tmpname, posixpath.normpath(member.linkname))
+            else:
+                continue
+            extracted.append((filename, tmpname))
+    # links are read through, the store only holds plain files, the stream
+    # cannot go back so they are copied from their targets once all are in
+    missing = set()
+    for name, (tmpname, target) in links.items():
+        seen = {name}
+        while target in links and target not in seen:
+            seen.add(target)
+            target = links[target][1]
+        if target in files:
+            shutil.copyfile(os.path.join(store, files[target]),
+                            os.path.join(store, tmpname))
+        else:
+            print("Cannot extract %s, link target %s was not extracted" %
+                  (name, target))
+            missing.add(tmpname)
+    return [(fn, tmpname) for fn, tmpname in extracted
+            if tmpname not in missing]
 
 
 class OsxExtractor(Extractor):
-    """The osx extractor
+    """The osx extractor, off osx the images are unpacked with 7za rather
+    than mounted so this runs on any platform.
     """
 
-    def copy(self, pkg_name):
-        self.copy_files(pkg_name,
-                        cuda_lib_dir=self.store,
-                        nvvm_lib_dir=self.store,
-                        libdevice_lib_dir=self.store)
+    platform = 'osx'
 
-    def _extract_matcher(self, tarmembers):
-        """matcher helper for tarfile.extractall()
-        """
-        for tarinfo in tarmembers:
-            ext = os.path.splitext(tarinfo.name)[-1]
-            if ext == '.dylib' or ext == '.bc':
-                yield tarinfo
+    # context manager taking (mount point, image path) and yielding the
+    # directory the image's content is in, a plain directory given as the
+    # image is used as is
+    mount = staticmethod(_hdiutil_mount if sys.platform.startswith('darwin')
+                         else _sevenzip_mount)
+
+    def lib_dirs(self):
+        return self.store, self.store, self.store
 
-    def _mount_extract(self, image, store):
-        """Mounts and extracts the files from an image into store
+    def _mount_extract(self, image, store, tag):
+        """Mounts an image and extracts the dylibs and bitcode files from the
+        tarballs in it into store, the tarballs are read concurrently by a
+        process pool. Returns a list of (filename, temporary name) lists,
+        one per tarball in the order they were found.
         """
+        from concurrent.futures import ProcessPoolExecutor
+        mount = _directory_mount if os.path.isdir(image) else self.mount
         with tempdir() as tmpmnt:
-            with _hdiutil_mount(tmpmnt, os.path.join(os.getcwd(), image)) as mntpnt:
+            with mount(tmpmnt, image) as mntpnt:
+                tarballs = []
                 for tlpath, tldirs, tlfiles in os.walk(mntpnt):
-                    for tzfile in fnmatch.filter(tlfiles, "*.tar.gz"):
-                        with tarfile.open(os.path.join(tlpath, tzfile)) as tar:
-                            tar.extractall(
-                                store, members=self._extract_matcher(tar))
+                    tldirs.sort()
+                    for tzfile in sorted(fnmatch.filter(tlfiles, "*.tar.gz")):
+                        tarballs.append(os.path.join(tlpath, tzfile))
+                if not tarballs:
+                    return []
+                workers = min(len(tarballs), os.cpu_count() or 1)
+                with ProcessPoolExecutor(max_workers=workers) as pool:
+                    futures = [pool.submit(_extract_tarball, tarball, store,
+                                           '%s-%d' % (tag, i))
+                               for i, tarball in enumerate(tarballs)]
+                    return [f.result() for f in futures]
 
     def extract(self, extract_dir):
-        runfile = self.cu_blob
-        patches = self.patches
-        # fetch all the dylibs into lib64, but first get them out of the
-        # image and tar.gzs into tmpstore
-        extract_store_name = 'tmpstore'
-        extract_store = os.path.join(extract_dir, extract_store_name)
-        os.mkdir(extract_store)
+        # the dylibs go straight into lib64, each under a temporary name
+        # until it is known which of the files of the same name is wanted
         store_name = 'lib64'
         self.store = os.path.join(extract_dir, store_name)
-        try:
-            os.mkdir(self.store)
-        except FileExistsError:
-            pass
-        self._mount_extract(runfile, extract_store)
-        for p in self.patches:
-            self._mount_extract(p, extract_store)
-        for path, dirs, files in os.walk(extract_store):
-            for filename in fnmatch.filter(files, "*.dylib"):
-                if not Path(os.path.join(self.store, filename)).is_file():
-                    shutil.copy(os.path.join(path, filename), self.store)
-            for filename in fnmatch.filter(files, "*.bc"):
-                if not Path(os.path.join(self.store, filename)).is_file():
-                    shutil.copy(os.path.join(path, filename), self.store)
+        os.makedirs(self.store, exist_ok=True)
+        chosen = {}
+        leftover = []
+        for i, image in enumerate([self.cu_blob] + self.patches):
+            print("Extracting libraries from %s" % image)
+            found = {}
+            for extracted in self._mount_extract(
+                    os.path.join(self.src_dir, image), self.store, str(i)):
+                for filename, tmpname in extracted:
+                    # within an image the first of a name found wins, the
+                    # patches replace files from the images before them
+                    if filename in found:
+                        leftover.append(tmpname)
+                    else:
+                        found[filename] = tmpname
+            leftover += [chosen[fn] for fn in found if fn in chosen]
+            chosen.update(found)
+        for tmpname in leftover:
+            os.remove(os.path.join(self.store, tmpname))
+        for filename, tmpname in chosen.items():
+            os.replace(os.path.join(self.store, tmpname),
+                       os.path.join(self.store, filename))
+        print("Extracted %d files" % len(chosen))
 
 
 def getplatform():
@@ -647,41 +1360,289 @@ dispatcher = {'linux': LinuxExtractor,
               'osx': OsxExtractor}
 
 
-def _main():
+def build_all_outputs(extractor, output_root, jobs=None, tracer=None,
+                      staged_cache=None, restore=True):
+    """Stages every output of the recipe from a single extracted blob. Each
+    package is installed into its own prefix output_root/<pkg_name>, the
+    packages are staged concurrently by up to jobs threads. Outputs whose
+    fingerprint is in staged_cache are restored from it when restore is set,
+    the blob is only extracted if some output is not. The manifest of each
+    output is written to output_root/manifests/<pkg_name>.json.
+    """
+    tracer = tracer or PhaseTracer()
+    pkg_names = sorted(extractor.pkg_dict) + ['cudatoolkit']
+    # the extractor each output was staged (or restored) by
+    outputs = {}
+
+    def prefix(pkg_name):
+        return os.path.join(output_root, pkg_name)
+
+    def write_manifests():
+        with tracer.phase('manifest') as record:
+            for pkg_name in sorted(outputs):
+                staged = outputs[pkg_name]
+                manifest.write(output_root, staged.manifest(pkg_name))
+            record['files'] = len(outputs)
+
+    if staged_cache is not None and restore:
+        def restore_output(pkg_name):
+            staged = outputs[pkg_name] = extractor.for_prefix(prefix(pkg_name))
+            with tracer.phase('restore', pkg_name) as record:
+                restored = staged.restore_staged(staged_cache, pkg_name)
+                if restored is not None:
+                    record['files'] = restored
+            return restored is None
+
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            missed = list(pool.map(restore_output, pkg_names))
+        pkg_names = [p for p, miss in zip(pkg_names, missed) if miss]
+        if not pkg_names:
+            print("All outputs restored from the staged output cache")
+            write_manifests()
+            return
+
+    with tracer.phase('extract') as record:
+        extractor.extract_cached(ExtractCache(extractor.cache_dir))
+        if extractor.extract_peak_bytes is not None:
+            record['peak_disk_bytes'] = extractor.extract_peak_bytes
+
+    with tracer.phase('plan') as record:
+        # every package is planned, the cudatoolkit link scripts list the
+        # libraries of all of them
+        plan = extractor.plan(sorted(extractor.pkg_dict))
+        record['files'] = sum(len(plan[p]) for p in pkg_names if p in plan)
+
+    def stage(pkg_name):
+        staged = outputs[pkg_name] = extractor.for_prefix(prefix(pkg_name))
+        with tracer.phase('copy', pkg_name) as record:
+            record['files'] = staged.stage_plan(plan.get(pkg_name, []))
+            if staged.slim_saved is not None:
+                record['slim_saved_bytes'] = staged.slim_saved
+            if pkg_name in plan:
+                staged.write_lib_index(pkg_name, plan[pkg_name])
+        with tracer.phase('make_link_scripts', pkg_name):
+            staged.make_link_scripts(pkg_name, plan)
+        if staged_cache is not None:
+            with tracer.phase('save_staged', pkg_name):
+                staged.save_staged(staged_cache, pkg_name)
+        return pkg_name
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        for pkg_name in pool.map(stage, pkg_names):
+            print("Staged %s into %s" % (pkg_name, prefix(pkg_name)))
+    write_manifests()
+
+
+def _build(args, tracer):
     print("Running build")
 
     # package version decl must match cuda release version
-    cu_version = os.environ['PKG_VERSION']
+    cu_version = args.cuda_version
 
     print("CUDA Version: {}".format(cu_version))
 
-    # get an extractor
-    plat = getplatform()
+    # get an extractor, for the platform asked for which need not be this
+    # one
+    plat = args.platform
+    if plat != getplatform():
+        print("Building the %s packages on %s" % (plat, getplatform()))
     extractor_impl = dispatcher[plat]
     version_cfg = config[cu_version]
-    extractor = extractor_impl(cu_version, version_cfg, version_cfg[plat])
+    if args.all_outputs:
+        output_root = os.path.abspath(args.output_root)
+        prefix = os.path.join(output_root, 'cudatoolkit')
+        src_dir = os.environ.get('SRC_DIR', os.getcwd())
+        pkg_name = 'cudatoolkit'
+    else:
+        prefix = src_dir = None
+        pkg_name = os.environ['PKG_NAME']
+    # only the throwaway prefixes of --all-outputs may hard link the caches
+    extractor = extractor_impl(cu_version, version_cfg, version_cfg[plat],
+                               prefix=prefix, src_dir=src_dir,
+                               hardlink=args.all_outputs)
+    staged_cache = StagedCache(extractor.cache_dir, staged_cache_bytes())
 
     # download binaries
-    extractor.download_blobs()
+    with tracer.phase('download_blobs', pkg_name):
+        extractor.download_blobs()
 
     # check md5sum
-    extractor.check_md5()
-    try:
-        os.mkdir("blob_files")
-    except FileExistsError:
-        pass
+    with tracer.phase('check_md5', pkg_name):
+        extractor.check_md5()
+
+    if args.all_outputs:
+        build_all_outputs(extractor, output_root, args.jobs, tracer,
+                          staged_cache, restore=not args.rebuild)
+        return
+
+    # an output whose inputs are unchanged since it was last staged is
+    # restored as it was
+    if not args.rebuild:
+        with tracer.phase('restore', pkg_name) as record:
+            restored = extractor.restore_staged(staged_cache, pkg_name)
+            if restored is not None:
+                record['files'] = restored
+        if restored is not None:
+            return
 
-    # extract (just extracts libraries from distributed blob)
-    extractor.extract("blob_files")
+    # extract (just extracts libraries from distributed blob), this is
+    # shared between all the outputs via the extraction cache
+    with tracer.phase('extract', pkg_name) as record:
+        extractor.extract_cached(ExtractCache(extractor.cache_dir))
+        if extractor.extract_peak_bytes is not None:
+            record['peak_disk_bytes'] = extractor.extract_peak_bytes
 
-    pkg_name = os.environ['PKG_NAME']
+    with tracer.phase('copy', pkg_name) as record:
+        record['files'] = extractor.copy(pkg_name)
+        if extractor.slim_saved is not None:
+            record['slim_saved_bytes'] = extractor.slim_saved
 
-    extractor.copy(pkg_name)
+    with tracer.phase('make_link_scripts', pkg_name):
+        extractor.make_link_scripts(pkg_name)
 
-    extractor.make_link_scripts(pkg_name)
+    with tracer.phase('save_staged', pkg_name):
+        extractor.save_staged(staged_cache, pkg_name)
 
     # dump config
     # extractor.dump_config(pkg_name)
 
+
+def _plan(args):
+    """Writes the file plan of every package as JSON without downloading,
+    extracting or copying anything. The plan is made from, in order of
+    preference, the listing in args.listing, the extracted tree at
+    args.store, the extraction cache entry of the blobs in $SRC_DIR, or a
+    listing of those blobs read from the archives.
+    """
+    start = time.perf_counter()
+    cu_version = args.cuda_version
+    plat = args.platform
+    version_cfg = config[cu_version]
+    src_dir = os.environ.get('SRC_DIR', os.getcwd())
+    # the prefix is only used for the paths in the plan, nothing is
+    # written to it
+    prefix = os.environ.get('PREFIX') or os.path.abspath('prefix')
+    extractor = dispatcher[plat](cu_version, version_cfg, version_cfg[plat],
+                                 prefix=prefix, src_dir=src_dir)
+    if args.listing:
+        with open(args.listing, 'r') as f:
+            saved = json.load(f)
+        extractor.use_listing(saved['listing'], saved.get('store'))
+        source = 'listing %s' % args.listing
+    elif args.store:
+        extractor.store = os.path.abspath(args.store)
+        source = 'extracted tree %s' % extractor.store
+    else:
+        cache = ExtractCache(extractor.cache_dir)
+        try:
+            key = extractor.cache_key()
+        except FileNotFoundError:
+            key = None
+        meta = cache.lookup(key) if key is not None else None
+        if meta is not None:
+            extractor.store = os.path.normpath(
+                os.path.join(cache.entry(key), meta['store']))
+            source = 'extraction cache %s' % cache.entry(key)
+        else:
+            try:
+                extractor.use_listing(extractor.archive_listing())
+            except (OSError, ValueError) as e:
+                sys.exit("Cannot plan %s: nothing extracted and the archives "
+                         "cannot be listed (%s), use --store or --listing" %
+                         (cu_version, e))
+            source = 'archives in %s' % src_dir
+    plan = extractor.plan(sorted(version_cfg['pkg_libs']))
+    if args.write_listing:
+        write_json(args.write_listing,
+                   {'cuda_version': cu_version, 'platform': plat,
+                    'store': extractor.store,
+                    'listing': extractor.store_listing()})
+    result = {'cuda_version': cu_version,
+              'platform': plat,
+              'source': source,
+              'store': extractor.store,
+              'prefix': prefix,
+              'packages': plan,
+              'bytes': {pkg_name: sum(e.get('size') or 0 for e in entries)
+                        for pkg_name, entries in plan.items()},
+              'seconds': time.perf_counter() - start}
+    if args.plan == '-':
+        json.dump(result, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    else:
+        write_json(args.plan, result)
+
+
+def _validate(args):
+    """Checks the libraries just staged, returns whether all are sound
+    """
+    plat = args.platform
+    version_cfg = config[args.cuda_version]
+    if args.all_outputs:
+        output_root = os.path.abspath(args.output_root)
+        prefixes = {p: os.path.join(output_root, p)
+                    for p in version_cfg['pkg_libs']}
+    else:
+        prefixes = {os.environ['PKG_NAME']: os.environ['PREFIX']}
+    results = validate.validate(prefixes, version_cfg, version_cfg[plat],
+                                plat, args.cuda_version)
+    return validate.report(results)
+
+
+def _main(argv=None):
+    parser = argparse.ArgumentParser(description="Build the cudatoolkit "
+                                     "packages from the NVIDIA installers")
+    parser.add_argument('--all-outputs', action='store_true',
+                        help="stage every output in one pass rather than "
+                        "just $PKG_NAME")
+    parser.add_argument('--jobs', type=int, default=None,
+                        help="number of outputs to stage concurrently")
+    parser.add_argument('--output-root', default='staged',
+                        help="with --all-outputs, the directory holding "
+                        "a prefix per output")
+    parser.add_argument('--cuda-version', default=os.environ.get('PKG_VERSION'),
+                        help="the CUDA version to build, defaults to "
+                        "$PKG_VERSION")
+    parser.add_argument('--platform', default=getplatform(),
+                        choices=sorted(dispatcher),
+                        help="the platform to build the packages for, "
+                        "defaults to this one, the windows and osx "
+                        "installers are read with 7za elsewhere")
+    parser.add_argument('--rebuild', action='store_true',
+                        help="extract and copy even if the staged output "
+                        "cache has a payload for the unchanged inputs")
+    parser.add_argument('--validate', action='store_true',
+                        default=validate.enabled(),
+                        help="check the headers of the staged libraries "
+                        "afterwards, see validate.py, the default if "
+                        "CUDATOOLKIT_VALIDATE is set")
+    parser.add_argument('--plan', nargs='?', const='-', default=None,
+                        metavar='FILE',
+                        help="only write the file plan of every package as "
+                        "JSON to FILE (default stdout), nothing is "
+                        "downloaded, extracted or copied")
+    parser.add_argument('--store', default=None,
+                        help="with --plan, an extracted tree to plan from")
+    parser.add_argument('--listing', default=None,
+                        help="with --plan, a listing written by "
+                        "--write-listing to plan from")
+    parser.add_argument('--write-listing', default=None, metavar='FILE',
+                        help="with --plan, also write the listing of the "
+                        "library directories planned from to FILE")
+    args = parser.parse_args(argv)
+
+    if args.plan is not None:
+        _plan(args)
+        return
+
+    label = 'all-outputs' if args.all_outputs else os.environ.get('PKG_NAME')
+    with traced_run(label) as tracer:
+        _build(args, tracer)
+        if args.validate:
+            with tracer.phase('validate', label):
+                ok = _validate(args)
+            if not ok:
+                sys.exit(1)
+
 if __name__ == "__main__":
     _main()
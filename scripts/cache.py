@@ -0,0 +1,441 @@
+"""On-disk caches shared between the outputs of the cudatoolkit recipe.
+
+Every output of the recipe runs build.py in its own process, the caches
+in here let later outputs (and concurrent ones) reuse the work done by
+the first.
+"""
+import hashlib
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+
+from contextlib import contextmanager
+
+from stage import stage_file
+
+HASH_BUFSIZE = 1024 * 1024
+
+# the default byte budget of the download cache
+BLOB_CACHE_BYTES = 32 * 1024 ** 3
+
+# the default byte budget of the staged output cache
+STAGED_CACHE_BYTES = 16 * 1024 ** 3
+
+if sys.platform.startswith('win'):
+    import msvcrt
+else:
+    import fcntl
+
+
+def default_cache_dir():
+    """Returns the root directory of the build caches, this is the
+    environment variable CUDATOOLKIT_CACHE_DIR if set, otherwise a directory
+    in the user's cache.
+    """
+    path = os.environ.get('CUDATOOLKIT_CACHE_DIR')
+    if not path:
+        path = os.path.join(os.path.expanduser('~'), '.cache',
+                            'cudatoolkit-build')
+    return os.path.abspath(path)
+
+
+def blob_cache_config(cache_dir):
+    """Returns (root, byte budget) of the download cache, these are the
+    environment variables CUDATOOLKIT_BLOB_CACHE_DIR, which defaults to
+    cache_dir/blobs, and CUDATOOLKIT_BLOB_CACHE_BYTES.
+    """
+    root = os.environ.get('CUDATOOLKIT_BLOB_CACHE_DIR')
+    if not root:
+        root = os.path.join(cache_dir, 'blobs')
+    max_bytes = os.environ.get('CUDATOOLKIT_BLOB_CACHE_BYTES')
+    max_bytes = int(max_bytes) if max_bytes else BLOB_CACHE_BYTES
+    return os.path.abspath(root), max_bytes
+
+
+def staged_cache_bytes():
+    """Returns the byte budget of the staged output cache, the environment
+    variable CUDATOOLKIT_STAGED_CACHE_BYTES if set.
+    """
+    max_bytes = os.environ.get('CUDATOOLKIT_STAGED_CACHE_BYTES')
+    return int(max_bytes) if max_bytes else STAGED_CACHE_BYTES
+
+
+def tree_size(path):
+    """Returns the bytes of the files under path, symlinks are not followed
+    """
+    total = 0
+    for dirpath, dirs, files in os.walk(path):
+        for fn in files:
+            total += os.lstat(os.path.join(dirpath, fn)).st_size
+    return total
+
+
+@contextmanager
+def file_lock(path):
+    """Context manager holding an exclusive lock on the file at path, the
+    file is created if it does not exist. Blocks until the lock is acquired.
+    """
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+    try:
+        if sys.platform.startswith('win'):
+            while True:
+                try:
+                    msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    # LK_LOCK gives up after ~10s, keep waiting
+                    time.sleep(1)
+        else:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        yield path
+    finally:
+        if sys.platform.startswith('win'):
+            os.lseek(fd, 0, os.SEEK_SET)
+            msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+        else:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+
+def write_json(path, obj):
+    """Atomically writes obj as JSON to path
+    """
+    tmp = '%s.tmp-%d-%d' % (path, os.getpid(), threading.get_ident())
+    with open(tmp, 'w') as f:
+        json.dump(obj, f, indent=2, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def md5sum_file(path, algorithm='md5'):
+    """Returns the hex md5sum (or other hashlib algorithm) of the file at
+    path
+    """
+    h = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        for buf in iter(lambda: f.read(HASH_BUFSIZE), b''):
+            h.update(buf)
+    return h.hexdigest()
+
+
+def read_json(path):
+    """Reads JSON from path, returns None if it is missing or unreadable
+    """
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+class ExtractCache(object):
+    """Content addressed cache of extracted CUDA blobs.
+
+    Entries are directories named by a key computed from the blob and patch
+    hashes and the extractor type. An entry is populated once under a file
+    lock and then marked complete, complete entries are never modified so
+    they can be read without holding the lock.
+    """
+
+    marker = '.complete'
+    subdir = 'extract'
+    kind = 'Extraction'
+
+    def __init__(self, root):
+        self.root = os.path.join(root, self.subdir)
+        os.makedirs(self.root, exist_ok=True)
+
+    def entry(self, key):
+        return os.path.join(self.root, key)
+
+    def lookup(self, key):
+        """Returns the metadata recorded for a complete entry or None
+        """
+        return read_json(os.path.join(self.entry(key), self.marker))
+
+    def fetch(self, key, populate):
+        """Returns (entry_dir, metadata) for key. On a miss populate(entry_dir)
+        is called to fill the entry and must return a JSON serialisable
+        metadata dictionary.
+        """
+        entry = self.entry(key)
+        meta = self.lookup(key)
+        if meta is not None:
+            print("%s cache hit: %s" % (self.kind, entry))
+            return entry, meta
+        with file_lock(entry + '.lock'):
+            # another process may have filled it whilst we waited
+            meta = self.lookup(key)
+            if meta is not None:
+                print("%s cache hit: %s" % (self.kind, entry))
+                return entry, meta
+            print("%s cache miss, populating: %s" % (self.kind, entry))
+            if os.path.exists(entry):
+                # left over from an interrupted extraction
+                shutil.rmtree(entry)
+            os.makedirs(entry)
+            meta = populate(entry)
+            write_json(os.path.join(entry, self.marker), meta)
+        return entry, meta
+
+    def discard(self, key):
+        """Removes the entry of key, e.g. one found to be damaged, so the
+        next fetch() populates it again.
+        """
+        entry = self.entry(key)
+        with file_lock(entry + '.lock'):
+            try:
+                os.remove(os.path.join(entry, self.marker))
+            except FileNotFoundError:
+                pass
+            shutil.rmtree(entry, ignore_errors=True)
+
+
+class StagedCache(ExtractCache):
+    """Cache of the staged payload of each output.
+
+    Entries are keyed by the fingerprint of an output (see
+    Extractor.fingerprint()) and hold a copy of the files staged into its
+    prefix, the marker is the manifest of those files. A rebuild whose
+    inputs are unchanged restores the payload from here rather than
+    extracting and copying again, once the payload is checked against the
+    manifest.
+
+    An index records the size of each entry, the output it is for and when
+    it was last used. Saving an output drops the entries of its earlier
+    fingerprints, and the least recently used entries are evicted once the
+    cache holds more than max_bytes.
+    """
+
+    subdir = 'staged'
+    kind = 'Staged output'
+
+    def __init__(self, root, max_bytes=STAGED_CACHE_BYTES):
+        super().__init__(root)
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(self.root, 'index.json')
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _locked(self):
+        with self._lock, file_lock(self.index_path + '.lock'):
+            yield read_json(self.index_path) or {}
+
+    def lookup(self, key):
+        meta = super().lookup(key)
+        if meta is not None:
+            with self._locked() as index:
+                if key in index:
+                    index[key]['used'] = time.time()
+                    write_json(self.index_path, index)
+        return meta
+
+    def fetch(self, key, populate):
+        """As ExtractCache.fetch(), the metadata populate() returns may name
+        the output the entry is for, which replaces any entry of the same
+        output under another key.
+        """
+        entry, meta = super().fetch(key, populate)
+        output = meta.get('output')
+        with self._locked() as index:
+            if key not in index:
+                index[key] = {'bytes': tree_size(entry), 'output': output}
+            index[key]['used'] = time.time()
+            stale = [k for k, e in index.items()
+                     if output is not None and e.get('output') == output and
+                     k != key]
+            stale += self._over_budget(index, keep=key)
+            for k in stale:
+                index.pop(k, None)
+            write_json(self.index_path, index)
+        for k in stale:
+            print("Evicting %s from the staged output cache" % self.entry(k))
+            super().discard(k)
+        return entry, meta
+
+    def discard(self, key):
+        super().discard(key)
+        with self._locked() as index:
+            if index.pop(key, None) is not None:
+                write_json(self.index_path, index)
+
+    def _over_budget(self, index, keep):
+        """Returns the least recently used keys to evict from index to bring
+        the cache within its budget, keep is never evicted.
+        """
+        total = sum(e['bytes'] for e in index.values())
+        evict = []
+        for key in sorted(index, key=lambda k: index[k]['used']):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            evict.append(key)
+            total -= index[key]['bytes']
+        return evict
+
+
+class ChecksumCache(object):
+    """Persistent cache of file md5sums.
+
+    Entries are keyed by the real path of the file and are only valid
+    whilst its size, mtime and inode are unchanged, so a blob or patch that
+    has been verified once is not hashed again by later builds.
+    """
+
+    def __init__(self, root):
+        os.makedirs(root, exist_ok=True)
+        self.path = os.path.join(root, 'checksums.json')
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _stamp(path):
+        st = os.stat(path)
+        return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+    def lookup(self, path):
+        """Returns the recorded md5sum of path or None
+        """
+        entry = (read_json(self.path) or {}).get(os.path.realpath(path))
+        if entry is not None and entry['stamp'] == self._stamp(path):
+            return entry['md5']
+        return None
+
+    def record(self, path, md5sum):
+        """Records md5sum as the checksum of the file at path as it is now
+        """
+        entry = {'stamp': self._stamp(path), 'md5': md5sum}
+        with self._lock, file_lock(self.path + '.lock'):
+            entries = read_json(self.path) or {}
+            entries[os.path.realpath(path)] = entry
+            write_json(self.path, entries)
+
+    def md5sum(self, path):
+        """Returns the md5sum of path, from the cache if possible
+        """
+        md5sum = self.lookup(path)
+        if md5sum is None:
+            print("Computing md5sum of %s" % path)
+            md5sum = md5sum_file(path)
+            self.record(path, md5sum)
+        return md5sum
+
+
+class BlobCache(object):
+    """Content addressed cache of downloaded files shared between builds.
+
+    The files are stored by md5sum, an index maps each url to the md5sum
+    and size of its content along with when it was last used. Files are
+    added by hard linking (or copying) a completed download into place and
+    renaming it, and are materialised into a build by hard linking them out
+    again, both under the cache lock so eviction never races a reader.
+    The least recently used files are evicted once the cache holds more
+    than max_bytes.
+    """
+
+    def __init__(self, root, max_bytes=BLOB_CACHE_BYTES, checksums=None):
+        """Arguments:
+          root - the directory of the cache
+          max_bytes - the byte budget of the cache
+          checksums - the ChecksumCache used to verify hits, defaults to
+                      one in root
+        """
+        self.root = root
+        self.max_bytes = max_bytes
+        self.objects = os.path.join(root, 'objects')
+        os.makedirs(self.objects, exist_ok=True)
+        self.index_path = os.path.join(root, 'index.json')
+        self.checksums = checksums or ChecksumCache(root)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _locked(self):
+        with self._lock, file_lock(self.index_path + '.lock'):
+            yield read_json(self.index_path) or {}
+
+    def object_path(self, md5sum):
+        return os.path.join(self.objects, md5sum)
+
+    def materialize(self, url, path):
+        """Places the cached content of url at path, returns its md5sum or
+        None on a miss. A cached file that no longer matches its md5sum is
+        dropped from the cache.
+        """
+        with self._locked() as index:
+            entry = index.get(url)
+            if entry is None:
+                return None
+            obj = self.object_path(entry['md5'])
+            try:
+                valid = (os.path.getsize(obj) == entry['size'] and
+                         self.checksums.md5sum(obj) == entry['md5'])
+            except FileNotFoundError:
+                valid = False
+            if not valid:
+                print("Dropping bad download cache entry for %s" % url)
+                self._drop(index, url)
+                write_json(self.index_path, index)
+                return None
+            method = stage_file(obj, path)
+            entry['used'] = time.time()
+            write_json(self.index_path, index)
+        print("Download cache hit for %s (%s)" % (url, method))
+        return entry['md5']
+
+    def drop(self, url):
+        """Removes url from the cache, along with its file unless another url
+        has the same content.
+        """
+        with self._locked() as index:
+            if url in index:
+                self._drop(index, url)
+                write_json(self.index_path, index)
+
+    def _drop(self, index, url):
+        md5sum = index.pop(url)['md5']
+        if not any(e['md5'] == md5sum for e in index.values()):
+            self._remove(self.object_path(md5sum))
+
+    def insert(self, url, path, md5sum):
+        """Adds the completed download of url at path with the given md5sum,
+        then evicts the least recently used files over the budget. Only
+        downloads checked against a published checksum should be added, the
+        cache has no way to tell a bad one.
+        """
+        obj = self.object_path(md5sum)
+        size = os.path.getsize(path)
+        with self._locked() as index:
+            if not os.path.isfile(obj):
+                tmp = '%s.tmp-%d-%d' % (obj, os.getpid(), threading.get_ident())
+                stage_file(path, tmp)
+                os.replace(tmp, obj)
+                self.checksums.record(obj, md5sum)
+            index[url] = {'md5': md5sum, 'size': size, 'used': time.time()}
+            self._evict(index, keep=md5sum)
+            write_json(self.index_path, index)
+
+    def _evict(self, index, keep):
+        sizes = {e['md5']: e['size'] for e in index.values()}
+        used = {}
+        for e in index.values():
+            used[e['md5']] = max(used.get(e['md5'], 0), e['used'])
+        total = sum(sizes.values())
+        for md5sum in sorted(used, key=used.get):
+            if total <= self.max_bytes:
+                break
+            if md5sum == keep:
+                continue
+            print("Evicting %s from the download cache" % md5sum)
+            self._remove(self.object_path(md5sum))
+            total -= sizes[md5sum]
+            for url in [u for u, e in index.items() if e['md5'] == md5sum]:
+                del index[url]
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,78 @@
+"""Finds the libraries of the cudatoolkit packages from their indexes.
+
+Each package installs <libdir>/cudatoolkit-libs/<package>.json, written by
+build.py when it is staged, mapping the logical name of each library it
+holds to the exact file, the symlinks to it and its SONAME. The logical
+name is the library's name in the configuration (e.g. cublas or nvvm), or
+for libdevice the file name without .bc (libdevice.10 from CUDA 9,
+libdevice.compute_35.10 before). This module has no dependencies beyond
+the standard library and ships with the cudart package, so a library can
+be found with one small file read rather than by listing and matching the
+library directory:
+
+    import cudalibs
+    cudalibs.find('cublas')
+    cudalibs.find('libdevice.10', package='nvvm')
+"""
+import json
+import os
+import sys
+
+INDEX_DIR = 'cudatoolkit-libs'
+
+
+def libdir(prefix=None):
+    """Returns the directory the libraries are installed in under prefix,
+    which defaults to sys.prefix.
+    """
+    prefix = prefix or sys.prefix
+    if sys.platform.startswith('win'):
+        return os.path.join(prefix, 'Library', 'bin')
+    return os.path.join(prefix, 'lib')
+
+
+def packages(prefix=None):
+    """Returns the names of the packages with an index under prefix
+    """
+    try:
+        names = os.listdir(os.path.join(libdir(prefix), INDEX_DIR))
+    except FileNotFoundError:
+        return []
+    return sorted(fn[:-len('.json')] for fn in names if fn.endswith('.json'))
+
+
+def load(package, prefix=None):
+    """Returns the index of package under prefix, or None if it has none
+    """
+    path = os.path.join(libdir(prefix), INDEX_DIR, '%s.json' % package)
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def lookup(name, package=None, prefix=None):
+    """Returns the index entry of the library name, with its path added,
+    or None if no package under prefix has it. The package of the same
+    name is looked in first, so most lookups read a single index.
+    """
+    if package is not None:
+        candidates = [package]
+    else:
+        candidates = [name] + [p for p in packages(prefix) if p != name]
+    for pkg in candidates:
+        index = load(pkg, prefix)
+        if index is None or name not in index['libraries']:
+            continue
+        entry = dict(index['libraries'][name])
+        entry['path'] = os.path.join(libdir(prefix), entry['file'])
+        return entry
+    return None
+
+
+def find(name, package=None, prefix=None):
+    """Returns the path of the library name or None
+    """
+    entry = lookup(name, package, prefix)
+    return None if entry is None else entry['path']
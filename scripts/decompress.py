@@ -0,0 +1,455 @@
+"""Decompression of the installer payloads off the reading thread.
+
+The payloads of the installers are gzip, xz or bzip2 compressed tarballs.
+Rather than having tarfile decompress them in the thread that parses them,
+the compression is detected from the magic bytes and the stream is piped
+through a multi-threaded decompressor (pigz, xz -T0, lbzip2 or pbzip2)
+in its own process. Without one an xz or bzip2 stream is decompressed by
+a Python thread (lzma and bz2 release the GIL), so decompression still
+overlaps the parsing and writing of the members. A gzip stream is
+decompressed inline, zlib is fast enough that a single thread handing
+the data over is slower than decompressing where it is parsed.
+
+Whichever way, the data is read the same: concatenated compressed streams
+(as gzip and bzip2 allow) are decompressed one after the other, and
+anything after the last of them that is not another stream, such as the
+zero padding after a makeself payload, is ignored. A decompressor tool
+may exit with an error at such data. The error is let pass only when it
+is about that data: the tool says it ignored trailing garbage, or for xz,
+whose messages do not tell, the end of the input holds the index of
+every stream and the tool wrote as much as they record. Any other
+failure, a truncated or corrupt stream, raises ValueError as in the
+other modes.
+
+CUDATOOLKIT_DECOMPRESS selects how:
+  auto - a decompressor tool if one is installed, else as above (default)
+  python - always the Python thread
+  inline - always in the reading thread
+"""
+from __future__ import print_function
+import bz2
+import lzma
+import os
+import queue
+import re
+import shutil
+import struct
+import subprocess
+import threading
+import time
+import zlib
+
+from collections import deque
+from contextlib import contextmanager
+
+BUFSIZE = 1024 * 1024
+
+# how much of the end of the input fed to a tool is kept to check a failure
+TAIL_BYTES = 4 * 1024 * 1024
+
+MAGICS = [(b'\x1f\x8b', 'gzip'),
+          (b'\xfd7zXZ\x00', 'xz'),
+          (b'BZh', 'bzip2')]
+
+# tried in order, the first installed is used
+TOOLS = {'gzip': [['pigz', '-d', '-c']],
+         'xz': [['xz', '-d', '-c', '-T0']],
+         'bzip2': [['lbzip2', '-d', '-c'], ['pbzip2', '-d', '-c']]}
+
+# how the tools report data after the last stream (gzip, pigz, bzip2 and
+# its parallel versions), xz does not
+_TRAILING_RE = re.compile(r'trailing (garbage|junk)', re.I)
+
+_DECOMPRESSORS = {'gzip': lambda: zlib.decompressobj(zlib.MAX_WBITS | 16),
+                  'xz': lzma.LZMADecompressor,
+                  'bzip2': bz2.BZ2Decompressor}
+
+
+def mode():
+    """Returns the decompression mode, CUDATOOLKIT_DECOMPRESS
+    """
+    value = os.environ.get('CUDATOOLKIT_DECOMPRESS', 'auto')
+    if value not in ('auto', 'python', 'inline'):
+        raise ValueError("Unknown decompression mode: %s" % value)
+    return value
+
+
+def detect(head):
+    """Returns the compression of data starting with head, one of 'gzip',
+    'xz', 'bzip2' or None if it is none of these.
+    """
+    for magic, compression in MAGICS:
+        if head.startswith(magic):
+            return compression
+    return None
+
+
+def find_tool(compression):
+    """Returns the command of an installed decompressor for compression, or
+    None
+    """
+    for command in TOOLS.get(compression, []):
+        path = shutil.which(command[0])
+        if path is not None:
+            return [path] + command[1:]
+    return None
+
+
+class Stats(object):
+    """Bytes in and out of a decompression and how long it took
+    """
+
+    def __init__(self, compression, method):
+        self.compression = compression
+        self.method = method
+        self.bytes_in = self.bytes_out = 0
+        self.start = time.perf_counter()
+        self.seconds = None
+
+    @property
+    def mb_per_s(self):
+        """Decompressed MB per second"""
+        if not self.seconds:
+            return 0.0
+        return self.bytes_out / self.seconds / 1e6
+
+    def __str__(self):
+        return ("%.1f MB of %s decompressed from %.1f MB in %.2fs, %.1f MB/s "
+                "(%s)" % (self.bytes_out / 1e6, self.compression,
+                          self.bytes_in / 1e6, self.seconds or 0.0,
+                          self.mb_per_s, self.method))
+
+
+class _Reader(object):
+    """Read only binary stream over an iterator of chunks of data, raising
+    any exception the iterator does
+    """
+
+    def __init__(self, chunks, stats):
+        self._chunks = chunks
+        self._chunk = b''
+        self._pos = 0
+        self._done = False
+        self.stats = stats
+
+    def _next_chunk(self):
+        try:
+            self._chunk, self._pos = next(self._chunks), 0
+        except StopIteration:
+            self._done = True
+        except Exception:
+            self._done = True
+            raise
+
+    def read(self, size=-1):
+        parts = []
+        wanted = size
+        while size < 0 or wanted > 0:
+            if self._pos == len(self._chunk):
+                if self._done:
+                    break
+                self._next_chunk()
+                continue
+            end = len(self._chunk)
+            if size >= 0:
+                end = min(end, self._pos + wanted)
+                wanted -= end - self._pos
+            parts.append(self._chunk[self._pos:end])
+            self._pos = end
+        data = parts[0] if len(parts) == 1 else b''.join(parts)
+        self.stats.bytes_out += len(data)
+        return data
+
+
+def _queued(chunks):
+    """Yields the chunks put on the queue chunks by another thread until a
+    chunk of None, a chunk that is an exception is raised.
+    """
+    while True:
+        chunk = chunks.get()
+        if chunk is None:
+            return
+        if isinstance(chunk, Exception):
+            raise chunk
+        yield chunk
+
+
+class _Prefixed(object):
+    """f with head, already read from it, put back in front
+    """
+
+    def __init__(self, head, f):
+        self._head = head
+        self._f = f
+
+    def read(self, size=-1):
+        if self._head:
+            if size < 0:
+                data, self._head = self._head + self._f.read(), b''
+                return data
+            data, self._head = self._head[:size], self._head[size:]
+            if len(data) < size:
+                data += self._f.read(size - len(data))
+            return data
+        return self._f.read(size)
+
+
+def _decompress(head, f, compression, stats, stop=None):
+    """Yields the decompressed data of the stream head followed by the rest
+    of f, until the end of the last of any concatenated streams. Stops
+    early once stop is set. Raises ValueError if the data is truncated or
+    cannot be decompressed.
+    """
+    magic = next(m for m, c in MAGICS if c == compression)
+    decomp = _DECOMPRESSORS[compression]()
+    data = head
+    stats.bytes_in += len(data)
+    try:
+        while stop is None or not stop.is_set():
+            if not data:
+                data = f.read(BUFSIZE)
+                if not data:
+                    break
+                stats.bytes_in += len(data)
+            if decomp.eof:
+                # another stream may follow, anything else is trailing data
+                while len(data) < len(magic):
+                    more = f.read(BUFSIZE)
+                    if not more:
+                        break
+                    stats.bytes_in += len(more)
+                    data += more
+                if not data.startswith(magic):
+                    return
+                decomp = _DECOMPRESSORS[compression]()
+            out = decomp.decompress(data)
+            if out:
+                yield out
+            data = decomp.unused_data if decomp.eof else b''
+    except (zlib.error, lzma.LZMAError, OSError, EOFError) as e:
+        raise ValueError("%s decompression failed: %s" % (compression, e))
+    if not decomp.eof and (stop is None or not stop.is_set()):
+        raise ValueError("Truncated %s stream" % compression)
+
+
+def _python_worker(head, f, compression, chunks, stats, stop):
+    try:
+        for out in _decompress(head, f, compression, stats, stop):
+            chunks.put(out)
+        chunks.put(None)
+    except Exception as e:
+        chunks.put(e if isinstance(e, ValueError) else
+                   ValueError("%s decompression failed: %s" %
+                              (compression, e)))
+
+
+class _Tail(object):
+    """The last TAIL_BYTES (or a little more) of the data fed to a tool and
+    the offset they start at
+    """
+
+    def __init__(self):
+        self._chunks = deque()
+        self._bytes = 0
+        self.offset = 0
+
+    def add(self, data):
+        self._chunks.append(data)
+        self._bytes += len(data)
+        while self._bytes - len(self._chunks[0]) >= TAIL_BYTES:
+            dropped = self._chunks.popleft()
+            self._bytes -= len(dropped)
+            self.offset += len(dropped)
+
+    def data(self):
+        return b''.join(self._chunks)
+
+
+def _varint(data, pos):
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        value |= (byte & 0x7f) << shift
+        pos += 1
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+        if shift > 63:
+            raise ValueError("bad varint")
+
+
+def _xz_stream_before(data, end):
+    """Returns (start, uncompressed size) of the xz stream that ends at end
+    in data, raises ValueError (or IndexError) if there is no intact stream
+    footer and index there.
+    """
+    footer = data[end - 12:end]
+    if end < 12 or footer[10:] != b'YZ' or \
+            zlib.crc32(footer[4:10]) != struct.unpack('<I', footer[:4])[0]:
+        raise ValueError("no stream footer")
+    index_size = (struct.unpack('<I', footer[4:8])[0] + 1) * 4
+    index = data[end - 12 - index_size:end - 12]
+    if end - 12 - index_size < 0 or index[0] != 0 or \
+            zlib.crc32(index[:-4]) != struct.unpack('<I', index[-4:])[0]:
+        raise ValueError("no stream index")
+    count, pos = _varint(index, 1)
+    blocks = size = 0
+    for _ in range(count):
+        unpadded, pos = _varint(index, pos)
+        uncompressed, pos = _varint(index, pos)
+        blocks += (unpadded + 3) // 4 * 4
+        size += uncompressed
+    return end - (12 + blocks + index_size + 12), size
+
+
+def _xz_complete_size(tail):
+    """Returns the uncompressed size of the xz streams the input fed to a
+    tool is made of, if their ends are in tail (a _Tail) and only data that
+    is not another stream follows, else None. The footer and index of the
+    last stream suffice for a single stream, any before it must have
+    theirs in tail too.
+    """
+    data = tail.data()
+    magic = MAGICS[1][0]
+    end = len(data)
+    while True:
+        end = data.rfind(b'YZ', 0, end) + 2
+        if end < 2:
+            return None
+        try:
+            start, total = _xz_stream_before(data, end)
+        except (ValueError, IndexError, struct.error):
+            end -= 2
+            continue
+        if data[end:].lstrip(b'\0').startswith(magic):
+            # a stream the tool could not read follows
+            return None
+        while tail.offset + start > 0:
+            # the streams before, and the padding between them
+            while start >= 4 and data[start - 4:start] == b'\0' * 4:
+                start -= 4
+            try:
+                start, size = _xz_stream_before(data, start)
+            except (ValueError, IndexError, struct.error):
+                return None
+            total += size
+        return total if tail.offset + start == 0 else None
+
+
+def _feed(head, f, pipe, stats, tail):
+    try:
+        data = head
+        while data:
+            stats.bytes_in += len(data)
+            tail.add(data)
+            pipe.write(data)
+            data = f.read(BUFSIZE)
+    except (BrokenPipeError, ValueError, OSError):
+        # the reader stopped early, e.g. at the end of the tar archive
+        pass
+    finally:
+        try:
+            pipe.close()
+        except OSError:
+            pass
+
+
+def _pipe_reader(proc, compression, chunks, stats, stop, feeder, tail):
+    written = 0
+    while True:
+        data = proc.stdout.read1(BUFSIZE)
+        if not data:
+            break
+        written += len(data)
+        chunks.put(data)
+    error = proc.stderr.read().decode('utf-8', 'replace').strip()
+    if proc.wait() != 0 and not stop.is_set():
+        feeder.join()
+        if _TRAILING_RE.search(error) or (
+                compression == 'xz' and _xz_complete_size(tail) == written):
+            # the tool stopped at data after the last stream, which is
+            # ignored as elsewhere
+            stats.method += ', trailing data ignored'
+        else:
+            chunks.put(ValueError("%s failed with exit status %d: %s" %
+                                  (os.path.basename(proc.args[0]),
+                                   proc.returncode, error)))
+            return
+    chunks.put(None)
+
+
+def _method(compression):
+    """Returns how to decompress compression in the current mode(), the
+    command of a decompressor tool, 'python' or 'inline'.
+    """
+    value = mode()
+    if value == 'auto':
+        command = find_tool(compression)
+        if command is not None:
+            return command
+        return 'inline' if compression == 'gzip' else 'python'
+    return value
+
+
+@contextmanager
+def decompressed(f, label=None):
+    """Context manager yielding a binary stream of the decompressed content
+    read from the binary file object f, from its current position. Data
+    that is not compressed is passed through, so the stream should be
+    opened with tarfile mode 'r|*'. Otherwise the stream has a stats
+    attribute (see Stats), which is printed on exit, and reading it raises
+    ValueError if the data cannot be decompressed.
+    """
+    head = f.read(6)
+    compression = detect(head)
+    if compression is None:
+        yield _Prefixed(head, f)
+        return
+    method = _method(compression)
+    stats = Stats(compression, method if isinstance(method, str)
+                  else os.path.basename(method[0]))
+    threads = []
+    proc = None
+    if method == 'inline':
+        reader = _Reader(_decompress(head, f, compression, stats), stats)
+    else:
+        # bounded so a stalled reader does not buffer the whole payload
+        chunks = queue.Queue(maxsize=64)
+        stop = threading.Event()
+        if method == 'python':
+            threads.append(threading.Thread(
+                target=_python_worker, args=(head, f, compression, chunks,
+                                             stats, stop), daemon=True))
+        else:
+            proc = subprocess.Popen(method, stdin=subprocess.PIPE,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE)
+            tail = _Tail()
+            feeder = threading.Thread(
+                target=_feed, args=(head, f, proc.stdin, stats, tail),
+                daemon=True)
+            threads.append(feeder)
+            threads.append(threading.Thread(
+                target=_pipe_reader, args=(proc, compression, chunks, stats,
+                                           stop, feeder, tail),
+                daemon=True))
+        for thread in threads:
+            thread.start()
+        reader = _Reader(_queued(chunks), stats)
+    try:
+        yield reader
+    finally:
+        if threads:
+            stop.set()
+        if proc is not None and proc.poll() is None:
+            proc.kill()
+        # unblock the producers waiting on a full queue
+        while any(thread.is_alive() for thread in threads):
+            try:
+                chunks.get(timeout=0.05)
+            except queue.Empty:
+                pass
+        if proc is not None:
+            proc.wait()
+        stats.seconds = time.perf_counter() - stats.start
+        print("%s%s" % ('%s: ' % label if label else '', stats))
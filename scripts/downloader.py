@@ -0,0 +1,252 @@
+"""Resumable, parallel HTTP downloads of the CUDA blobs.
+
+Files are downloaded into <path>.part and only renamed to <path> once they
+are complete and verified, so an existing <path> is always a good download.
+Where the server honours HTTP Range requests the file is fetched as
+fixed size chunks by a pool of threads and the completed chunks are
+recorded in <path>.part.json, an interrupted download resumes from the
+chunks that are missing.
+
+The md5sum of each download is computed as the data arrives, streamed
+bytes are hashed as they are written and Range chunks are hashed, in
+order, as soon as they and all the chunks before them are complete.
+
+Any url urllib opens can be fetched, including file:// urls, which is how
+a mirror on a local or network disk is read (see mirror_url()).
+"""
+import hashlib
+import os
+import threading
+import urllib.parse as urlparse
+
+from pathlib import Path
+
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import HASH_BUFSIZE, read_json, write_json
+
+CHUNK_SIZE = 64 * 1024 * 1024
+BUFSIZE = 1024 * 1024
+RETRIES = 3
+TIMEOUT = 60
+
+
+def mirror_path(url):
+    """Returns where url is kept in a mirror, relative to the root of the
+    mirror: the host and path of the url.
+    """
+    parts = urlparse.urlsplit(url)
+    names = [urlparse.unquote(n) for n in parts.path.split('/') if n]
+    return os.path.join(parts.netloc, *names)
+
+
+def mirror_url(mirror, url):
+    """Returns the url of the copy of url in mirror, the root of a mirror as
+    a url (http, https or file) or a local directory.
+    """
+    if '://' not in mirror:
+        mirror = Path(os.path.abspath(mirror)).as_uri()
+    rel = mirror_path(url).replace(os.sep, '/')
+    return '%s/%s' % (mirror.rstrip('/'), urlparse.quote(rel))
+
+
+def _open(url, start=None, end=None):
+    # urllib.request pulls in http.client, email and ssl, only import it
+    # when something is actually downloaded
+    import urllib.request
+    req = urllib.request.Request(url)
+    if start is not None:
+        stop = '' if end is None else str(end)
+        req.add_header('Range', 'bytes=%d-%s' % (start, stop))
+    return urllib.request.urlopen(req, timeout=TIMEOUT)
+
+
+def probe(url):
+    """Returns (size, ranges) for url, size is None if the server does not
+    say, ranges is whether the server honours Range requests.
+    """
+    with _open(url, 0, 0) as resp:
+        if resp.status == 206:
+            total = resp.headers.get('Content-Range', '').rpartition('/')[2]
+            if total.isdigit():
+                return int(total), True
+            return None, True
+        length = resp.headers.get('Content-Length')
+        return (int(length) if length else None), False
+
+
+class _ChunkHasher(object):
+    """Computes the md5sum of a file written as out of order chunks, each
+    chunk is hashed once it and all the chunks before it are on disk.
+    """
+
+    def __init__(self, path, size, chunk_size):
+        self.path = path
+        self.size = size
+        self.chunk_size = chunk_size
+        self.md5 = hashlib.md5()
+        self.next = 0
+        self.done = set()
+        self.lock = threading.Lock()
+
+    def chunk_done(self, i):
+        with self.lock:
+            self.done.add(i)
+            if self.next not in self.done:
+                return
+            with open(self.path, 'rb') as f:
+                f.seek(self.next * self.chunk_size)
+                while self.next in self.done:
+                    start = self.next * self.chunk_size
+                    remaining = min(self.size, start + self.chunk_size) - start
+                    while remaining:
+                        buf = f.read(min(HASH_BUFSIZE, remaining))
+                        self.md5.update(buf)
+                        remaining -= len(buf)
+                    self.next += 1
+
+    def hexdigest(self):
+        return self.md5.hexdigest()
+
+
+def _copy_stream(resp, f, nbytes=None, md5=None):
+    """Copies nbytes (or everything) from resp to f, updating md5 (if
+    given) with the data. Returns bytes copied.
+    """
+    copied = 0
+    while nbytes is None or copied < nbytes:
+        want = BUFSIZE if nbytes is None else min(BUFSIZE, nbytes - copied)
+        buf = resp.read(want)
+        if not buf:
+            break
+        f.write(buf)
+        if md5 is not None:
+            md5.update(buf)
+        copied += len(buf)
+    if nbytes is not None and copied != nbytes:
+        raise IOError('Short read, got %d of %d bytes' % (copied, nbytes))
+    return copied
+
+
+def _retry(what, func, *args):
+    for attempt in range(RETRIES):
+        try:
+            return func(*args)
+        except OSError as e:
+            if attempt == RETRIES - 1:
+                raise
+            print("Retrying %s after error: %s" % (what, e))
+
+
+def _fetch_ranges(url, part, size, jobs, chunk_size):
+    """Fetches url into part as parallel Range requests, resuming from the
+    chunks recorded as done in the state file. Returns the md5sum of part.
+    """
+    state_path = part + '.json'
+    state = read_json(state_path)
+    nchunks = -(-size // chunk_size)
+    fresh = {'url': url, 'size': size, 'chunk_size': chunk_size, 'done': []}
+    if (state is None or not os.path.isfile(part) or
+            any(state.get(k) != fresh[k] for k in ('url', 'size', 'chunk_size'))):
+        state = fresh
+        with open(part, 'wb') as f:
+            f.truncate(size)
+        write_json(state_path, state)
+    else:
+        print("Resuming %s, %d of %d chunks present" %
+              (part, len(state['done']), nchunks))
+    done = set(state['done'])
+    lock = threading.Lock()
+    hasher = _ChunkHasher(part, size, chunk_size)
+    for i in sorted(done):
+        hasher.chunk_done(i)
+
+    def get_chunk(i):
+        start = i * chunk_size
+        end = min(size, start + chunk_size) - 1
+        with _open(url, start, end) as resp, open(part, 'r+b') as f:
+            if resp.status != 206:
+                raise IOError('Range request not honoured by %s' % url)
+            f.seek(start)
+            _copy_stream(resp, f, end - start + 1)
+
+    def fetch_chunk(i):
+        _retry('chunk %d of %s' % (i, url), get_chunk, i)
+        with lock:
+            done.add(i)
+            state['done'] = sorted(done)
+            write_json(state_path, state)
+        hasher.chunk_done(i)
+
+    todo = [i for i in range(nchunks) if i not in done]
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        list(pool.map(fetch_chunk, todo))
+    return hasher.hexdigest()
+
+
+def _fetch_stream(url, part, resume):
+    """Fetches url into part as a single stream, if resume is set an
+    existing part is continued with a Range request. Returns the md5sum of
+    part.
+    """
+    start = os.path.getsize(part) if resume and os.path.isfile(part) else 0
+    if start:
+        print("Resuming %s from byte %d" % (part, start))
+    md5 = hashlib.md5()
+    with _open(url, start or None) as resp:
+        if start and resp.status != 206:
+            start = 0
+        if start:
+            with open(part, 'rb') as f:
+                _copy_stream(f, _NullWriter(), start, md5)
+        with open(part, 'ab' if start else 'wb') as f:
+            _copy_stream(resp, f, md5=md5)
+    return md5.hexdigest()
+
+
+class _NullWriter(object):
+    def write(self, buf):
+        pass
+
+
+def _discard(part):
+    for fn in (part, part + '.json'):
+        try:
+            os.remove(fn)
+        except FileNotFoundError:
+            pass
+
+
+def fetch(url, path, jobs=4, chunk_size=CHUNK_SIZE, verify=None):
+    """Downloads url to path unless path already exists.
+    Arguments:
+      url - the url to fetch
+      path - where to put the file
+      jobs - the number of concurrent Range requests
+      chunk_size - the size of each Range request
+      verify - optional callable taking the path of the completed download
+               and its md5sum, it should raise if the download is bad
+    Returns the md5sum of the download, or None if path already existed.
+    """
+    if os.path.isfile(path):
+        print("Using existing downloaded file: %s" % path)
+        return None
+    part = path + '.part'
+    size, ranges = probe(url)
+    print("downloading %s to %s" % (url, path))
+    if ranges and size is not None:
+        md5sum = _fetch_ranges(url, part, size, jobs, chunk_size)
+    else:
+        md5sum = _retry(url, _fetch_stream, url, part, ranges)
+    if size is not None and os.path.getsize(part) != size:
+        _discard(part)
+        raise IOError('Download of %s is incomplete' % url)
+    if verify is not None:
+        try:
+            verify(part, md5sum)
+        except Exception:
+            _discard(part)
+            raise
+    os.replace(part, path)
+    _discard(part)
+    return md5sum
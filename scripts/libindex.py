@@ -0,0 +1,121 @@
+"""Index of the extracted library directories.
+
+A directory is scanned once and every filename pattern the packages use is
+matched against it in that single pass, lookups are then dictionary
+accesses. Symlinks are recorded so chains can be followed without going
+back to the filesystem. An index can also be built from a listing of the
+directory, e.g. of an archive, without the directory existing at all.
+"""
+import fnmatch
+import os
+import re
+
+_VERSION_RE = re.compile(r'\d+')
+
+
+def version_key(filename):
+    """Sort key ordering library filenames by the version numbers in them,
+    so libfoo.so.9.1.10 sorts after libfoo.so.9.1.9.
+    """
+    return tuple(int(x) for x in _VERSION_RE.findall(filename)), filename
+
+
+class LibraryIndex(object):
+    """The files and symlinks in a directory, matched against filename
+    patterns.
+    """
+
+    def __init__(self, dirpath, patterns=(), listing=None):
+        """Scans dirpath and matches its entries against patterns
+        Arguments:
+          dirpath - the directory to index
+          patterns - fnmatch patterns the index will be asked for
+          listing - entries of the directory as returned by listing(), if
+                    given the directory is not scanned
+        """
+        self.dirpath = dirpath
+        self.files = set()
+        self.links = {}
+        self.sizes = {}
+        if listing is None:
+            with os.scandir(dirpath) as it:
+                for entry in it:
+                    if entry.is_symlink():
+                        self.links[entry.name] = os.readlink(entry.path)
+                    elif entry.is_file():
+                        self.files.add(entry.name)
+        else:
+            for name, size, target in listing:
+                if target is None:
+                    self.files.add(name)
+                    self.sizes[name] = size
+                else:
+                    self.links[name] = target
+        self.names = sorted(self.files.union(self.links))
+        self._matches = {}
+        self.add_patterns(patterns)
+
+    def add_patterns(self, patterns):
+        """Matches every entry against the patterns not already indexed
+        """
+        new = [p for p in set(patterns) if p not in self._matches]
+        if not new:
+            return
+        matchers = [(p, re.compile(fnmatch.translate(p)).match) for p in new]
+        for p in new:
+            self._matches[p] = []
+        for name in self.names:
+            for p, match in matchers:
+                if match(name):
+                    self._matches[p].append(name)
+
+    def find(self, pattern):
+        """Returns the names in the directory matching pattern
+        """
+        if pattern not in self._matches:
+            self.add_patterns([pattern])
+        return list(self._matches[pattern])
+
+    def path(self, name):
+        return os.path.join(self.dirpath, name)
+
+    def size(self, name):
+        """Returns the size of the file name, the file is only looked at if
+        the index was not built from a listing.
+        """
+        if name not in self.sizes:
+            self.sizes[name] = os.path.getsize(self.path(name))
+        return self.sizes[name]
+
+    def listing(self, names=None):
+        """Returns [name, size, symlink target or None] for names, which
+        default to every entry, the listing the index can be rebuilt from.
+        """
+        return [[name, None, self.links[name]] if name in self.links else
+                [name, self.size(name), None]
+                for name in (self.names if names is None else names)]
+
+    def is_link(self, name):
+        return name in self.links
+
+    def resolve(self, name):
+        """Follows the symlink chain from name, returns the name of the file
+        it ends at or None if it leaves the directory or is broken.
+        """
+        seen = set()
+        while name in self.links:
+            if name in seen:
+                return None
+            seen.add(name)
+            target = self.links[name]
+            if os.path.dirname(target) not in ('', os.curdir):
+                return None
+            name = os.path.basename(target)
+        return name if name in self.files else None
+
+    def exists(self, name):
+        """Whether name is a file or a symlink to one
+        """
+        if self.resolve(name) is not None:
+            return True
+        return name in self.links and os.path.isfile(self.path(name))
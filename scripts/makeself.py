@@ -0,0 +1,159 @@
+"""Pure Python reader for makeself self extracting archives.
+
+The NVIDIA CUDA .run installers (and the patches to them) are makeself
+archives: a shell script header followed by a compressed tarball. The
+toolkit itself is another makeself archive nested inside that tarball.
+This module streams the payloads with tarfile and writes out only the
+members that are asked for, nothing else touches the disk. The same
+members can be listed without writing anything. The payloads are
+decompressed off the parsing thread, see decompress.py.
+"""
+import os
+import posixpath
+import re
+import shutil
+import tarfile
+
+from decompress import decompressed
+
+BUFSIZE = 1024 * 1024
+
+# the header length in lines, how this is spelled varies between makeself
+# versions
+_SKIP_RES = [re.compile(br'head -n "?(\d+)"? "?\$[01]"?'),
+             re.compile(br'^skip="?(\d+)"?\s*$', re.I)]
+
+MAX_HEADER_LINES = 10000
+
+
+def read_header(f):
+    """Reads the shell script header of a makeself archive from the binary
+    file object f, leaving f at the start of the payload. f need not be
+    seekable. Returns the header, raises ValueError if f does not look like
+    a makeself archive.
+    """
+    lines = []
+    skip = None
+    while skip is None or len(lines) < skip:
+        line = f.readline()
+        if not line or (not lines and not line.startswith(b'#!')):
+            raise ValueError('Not a makeself archive')
+        lines.append(line)
+        if skip is None:
+            for skip_re in _SKIP_RES:
+                m = skip_re.search(line)
+                if m:
+                    skip = int(m.group(1))
+                    break
+            if len(lines) > MAX_HEADER_LINES:
+                raise ValueError('Not a makeself archive')
+    return b''.join(lines)
+
+
+def iter_payload(f, label=None):
+    """Yields (member, tar) for each member of the makeself archive read
+    from the binary file object f, the payload is read as a stream so
+    members must be consumed in order. label names the archive in the
+    decompression report.
+    """
+    read_header(f)
+    with decompressed(f, label) as payload:
+        with tarfile.open(fileobj=payload, mode='r|*') as tar:
+            for member in tar:
+                yield member, tar
+
+
+def _normalise(name):
+    name = posixpath.normpath(name)
+    return '' if name == '.' else name.lstrip('/')
+
+
+def _write_member(tar, member, target, written):
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    if os.path.lexists(target):
+        # patches overlay the base archive
+        os.remove(target)
+    if member.issym():
+        os.symlink(member.linkname, target)
+    elif member.isfile():
+        with tar.extractfile(member) as src, open(target, 'wb') as dst:
+            shutil.copyfileobj(src, dst, BUFSIZE)
+        os.chmod(target, member.mode & 0o777)
+    elif member.islnk():
+        # hard link to a member earlier in the stream
+        source = written.get(_normalise(member.linkname))
+        if source is None:
+            print("Cannot extract %s, link target %s was not extracted" %
+                  (member.name, member.linkname))
+            return False
+        shutil.copy2(source, target)
+    else:
+        return False
+    return True
+
+
+def _extract_stream(f, dest, select, descend, written, label):
+    for member, tar in iter_payload(f, label):
+        name = _normalise(member.name)
+        if descend is not None and member.isfile() and descend(name):
+            print("Descending into nested archive %s" % name)
+            with tar.extractfile(member) as nested:
+                _extract_stream(nested, dest, select, descend, written,
+                                posixpath.basename(name))
+            continue
+        rel = select(name)
+        if rel is None:
+            continue
+        target = os.path.join(dest, rel)
+        if _write_member(tar, member, target, written):
+            written[name] = target
+
+
+def extract(path, dest, select, descend=None):
+    """Extracts selected members of a makeself archive.
+    Arguments:
+      path - the makeself archive
+      dest - the directory to extract into
+      select - callable taking a member name and returning the path to
+               extract it to relative to dest, or None to skip it
+      descend - optional callable taking a member name and returning
+                whether it is a nested makeself archive to extract from
+    Members later in the stream replace those already extracted to the
+    same path. Returns the list of paths written.
+    """
+    written = {}
+    with open(path, 'rb') as f:
+        _extract_stream(f, dest, select, descend, written,
+                        os.path.basename(path))
+    return sorted(set(written.values()))
+
+
+def _list_stream(f, select, descend, found, sizes, label):
+    for member, tar in iter_payload(f, label):
+        name = _normalise(member.name)
+        if descend is not None and member.isfile() and descend(name):
+            with tar.extractfile(member) as nested:
+                _list_stream(nested, select, descend, found, sizes,
+                             posixpath.basename(name))
+            continue
+        rel = select(name)
+        if rel is None:
+            continue
+        if member.issym():
+            found[rel] = (None, member.linkname)
+        elif member.isfile():
+            found[rel] = sizes[name] = (member.size, None)
+        elif member.islnk() and _normalise(member.linkname) in sizes:
+            found[rel] = sizes[name] = sizes[_normalise(member.linkname)]
+
+
+def list_members(path, select, descend=None):
+    """Lists what extract() with the same arguments would write, without
+    writing anything. Returns a dictionary of the path relative to dest to
+    (size, symlink target), the size is None for a symlink and the target
+    None for a file.
+    """
+    found = {}
+    with open(path, 'rb') as f:
+        _list_stream(f, select, descend, found, {}, os.path.basename(path))
+    return found
@@ -0,0 +1,205 @@
+"""Manifests of the staged outputs and a report across them.
+
+The manifest of an output lists every file staged into its prefix with
+its size and sha256, and every symlink with its target and the file the
+chain ends at. build.py --all-outputs writes them to
+<output-root>/manifests/<pkg_name>.json and matrix.py to
+<output-root>/<version>/manifests/<pkg_name>.json.
+
+The report reads any number of manifests and totals the bytes of each
+package, per version and overall, flags content staged more than once
+(by several outputs of a version, or unchanged across versions) and
+concrete shared libraries no symlink leads to, e.g. a stale DSO left next
+to the current one:
+
+    python scripts/manifest.py staged --top 20 --json report.json
+"""
+from __future__ import print_function
+import argparse
+import glob
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import md5sum_file, read_json, write_json
+
+MANIFEST_DIR = 'manifests'
+
+
+def describe(prefix, relpaths, digest=None, jobs=None):
+    """Returns the files and links part of a manifest of relpaths, paths
+    relative to prefix, as (files, links). files maps a path to its size
+    and sha256, links maps a path to its target and the file the chain
+    ends at, None if it is broken or leaves prefix.
+    Arguments:
+      prefix - the prefix the paths are staged in
+      relpaths - the staged paths
+      digest - function returning the sha256 of a file, defaults to hashing
+               it
+      jobs - number of files hashed concurrently
+    """
+    digest = digest or (lambda path: md5sum_file(path, 'sha256'))
+    root = os.path.realpath(prefix)
+    names, links = [], {}
+    for rel in sorted(set(relpaths)):
+        path = os.path.join(prefix, rel)
+        if not os.path.islink(path):
+            names.append(rel)
+            continue
+        real = os.path.realpath(path)
+        end = os.path.relpath(real, root)
+        if end.startswith(os.pardir) or not os.path.isfile(real):
+            end = None
+        links[rel] = {'target': os.readlink(path), 'file': end}
+
+    def entry(rel):
+        path = os.path.join(prefix, rel)
+        return {'size': os.path.getsize(path), 'sha256': digest(path)}
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        files = dict(zip(names, pool.map(entry, names)))
+    return files, links
+
+
+def manifest_path(root, pkg_name):
+    return os.path.join(root, MANIFEST_DIR, '%s.json' % pkg_name)
+
+
+def write(root, manifest):
+    """Writes manifest to root/manifests/<package>.json
+    """
+    path = manifest_path(root, manifest['package'])
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    write_json(path, manifest)
+    return path
+
+
+def find(paths):
+    """Returns the manifests in paths, each a manifest file or a directory
+    searched for manifests/*.json at any depth.
+    """
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            pattern = os.path.join(path, '**', MANIFEST_DIR, '*.json')
+            found += sorted(glob.glob(pattern, recursive=True))
+        else:
+            found.append(path)
+    manifests = []
+    for fn in found:
+        manifest = read_json(fn)
+        if manifest is None or 'files' not in manifest:
+            print("Skipping %s, not a manifest" % fn)
+            continue
+        manifests.append(manifest)
+    return manifests
+
+
+def _is_shared_library(name):
+    base = os.path.basename(name)
+    return '.so' in base or base.endswith('.dylib')
+
+
+def report(manifests):
+    """Returns a dictionary summarising manifests:
+      packages - package name to {'versions': {version: bytes}, 'bytes': n}
+      bytes - the bytes of every output together
+      duplicates - content staged more than once, each with its sha256,
+                   size, the (version, package, path) it is staged as,
+                   whether those are all one version and the bytes a single
+                   copy would save, most bytes first
+      duplicate_bytes - the bytes of all the duplicates together
+      unlinked - (version, package, path, size) of concrete shared libraries
+                 no symlink leads to, in outputs that have symlinks
+      broken - (version, package, path) of broken symlinks
+    """
+    packages = {}
+    by_content = {}
+    unlinked = []
+    broken = []
+    for m in manifests:
+        version, pkg = m['cuda_version'], m['package']
+        size = sum(f['size'] for f in m['files'].values())
+        info = packages.setdefault(pkg, {'versions': {}, 'bytes': 0})
+        info['versions'][version] = info['versions'].get(version, 0) + size
+        info['bytes'] += size
+        for rel, f in m['files'].items():
+            copies = by_content.setdefault((f['sha256'], f['size']), [])
+            copies.append((version, pkg, rel))
+        linked = set()
+        for rel, link in m['links'].items():
+            if link['file'] is None:
+                broken.append((version, pkg, rel))
+            else:
+                linked.add(link['file'])
+        if m['links']:
+            unlinked += [(version, pkg, rel, f['size'])
+                         for rel, f in sorted(m['files'].items())
+                         if _is_shared_library(rel) and rel not in linked]
+    duplicates = []
+    for (sha256, size), copies in by_content.items():
+        if len(copies) < 2 or size == 0:
+            continue
+        duplicates.append({'sha256': sha256, 'size': size,
+                           'copies': sorted(copies),
+                           'same_version': len({c[0] for c in copies}) == 1,
+                           'saving': size * (len(copies) - 1)})
+    duplicates.sort(key=lambda d: (-d['saving'], d['sha256']))
+    return {'packages': packages,
+            'bytes': sum(p['bytes'] for p in packages.values()),
+            'duplicates': duplicates,
+            'duplicate_bytes': sum(d['saving'] for d in duplicates),
+            'unlinked': sorted(unlinked),
+            'broken': sorted(broken)}
+
+
+def format_report(summary, top=10):
+    """Returns report() as a text table, listing the top duplicates
+    """
+    versions = sorted({v for p in summary['packages'].values()
+                       for v in p['versions']},
+                      key=lambda v: [int(x) for x in v.split('.')])
+    header = '%-12s' % 'package' + ''.join('%14s' % v for v in versions)
+    lines = [header + '%14s' % 'total']
+    for pkg, info in sorted(summary['packages'].items(),
+                            key=lambda item: -item[1]['bytes']):
+        cells = ''.join('%14s' % info['versions'].get(v, '-')
+                        for v in versions)
+        lines.append('%-12s' % pkg + cells + '%14d' % info['bytes'])
+    lines.append("Total: %d bytes, %d in %d duplicated files" %
+                 (summary['bytes'], summary['duplicate_bytes'],
+                  len(summary['duplicates'])))
+    for d in summary['duplicates'][:top]:
+        scope = 'within a version' if d['same_version'] else 'across versions'
+        lines.append("  %d bytes x %d (%s) %s" %
+                     (d['size'], len(d['copies']), scope, d['sha256'][:12]))
+        for version, pkg, rel in d['copies']:
+            lines.append("      %s %s %s" % (version, pkg, rel))
+    for version, pkg, rel, size in summary['unlinked']:
+        lines.append("Unlinked library: %s %s %s (%d bytes)" %
+                     (version, pkg, rel, size))
+    for version, pkg, rel in summary['broken']:
+        lines.append("Broken symlink: %s %s %s" % (version, pkg, rel))
+    return '\n'.join(lines)
+
+
+def _main(argv=None):
+    parser = argparse.ArgumentParser(description="Report the sizes of the "
+                                     "staged outputs and the content they "
+                                     "share")
+    parser.add_argument('paths', nargs='+',
+                        help="manifests, or directories to search for them")
+    parser.add_argument('--top', type=int, default=10,
+                        help="number of duplicates to list")
+    parser.add_argument('--json', default=None,
+                        help="also write the report as JSON to this file")
+    args = parser.parse_args(argv)
+
+    summary = report(find(args.paths))
+    print(format_report(summary, args.top))
+    if args.json:
+        write_json(args.json, summary)
+
+
+if __name__ == "__main__":
+    _main()
@@ -0,0 +1,314 @@
+"""Builds every CUDA version and output in one run.
+
+The work for each version is split into tasks, download, verify, a
+restore task per output (from the staged output cache), extract and a
+stage task per output, which form a dependency graph. Extract does
+nothing when every output was restored, otherwise it also makes the file
+plan of every package once for all the stage tasks, as build.py
+--all-outputs does. The tasks run
+as soon as their dependencies are done, each kind in its own bounded pool
+so the network, the CPU (hashing and decompression) and the disk (staging)
+are kept busy at once, e.g. one version downloads whilst another extracts.
+
+    python scripts/matrix.py --versions 9.0 9.1 --output-root staged
+
+The packages of another platform are built with --platform, e.g. the
+windows and osx packages on a linux host (see build.py).
+
+Each output is staged into <output-root>/<version>/<pkg_name>, with its
+manifest in <output-root>/<version>/manifests/<pkg_name>.json. The run is
+traced like build.py (see phasetrace.py), and ends with a summary of the
+tasks and the critical path through the graph, and a report of the sizes
+of the outputs and the content they duplicate (see manifest.py).
+"""
+from __future__ import print_function
+import argparse
+import os
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import build
+import manifest
+from cache import (ExtractCache, StagedCache, default_cache_dir,
+                   staged_cache_bytes, write_json)
+from phasetrace import traced_run
+
+
+class Task(object):
+    """A unit of work run on one of the resource pools once all the tasks
+    in deps are done.
+    """
+
+    def __init__(self, name, resource, func, deps=()):
+        self.name = name
+        self.resource = resource
+        self.func = func
+        self.deps = list(deps)
+        self.queued = self.start = self.end = None
+
+    @property
+    def seconds(self):
+        return self.end - self.start
+
+
+class Scheduler(object):
+    """Runs a graph of tasks with a concurrency limit per resource
+    """
+
+    def __init__(self, limits):
+        """Arguments:
+          limits - dictionary of resource name to the number of tasks using
+                   it that may run at once
+        """
+        self.limits = limits
+
+    def run(self, tasks):
+        """Runs tasks, which must list each task after its dependencies.
+        Returns when all are done, raises the first error of a task in
+        which case the tasks depending on it are not run.
+        """
+        pending = {task: len(task.deps) for task in tasks}
+        dependents = {task: [] for task in tasks}
+        for task in tasks:
+            for dep in task.deps:
+                dependents[dep].append(task)
+        pools = {r: ThreadPoolExecutor(max_workers=n, thread_name_prefix=r)
+                 for r, n in self.limits.items()}
+        lock = threading.Lock()
+        finished = threading.Event()
+        state = {'done': 0, 'error': None}
+
+        def submit(task):
+            if state['error'] is not None:
+                return
+            task.queued = time.perf_counter()
+            pools[task.resource].submit(execute, task)
+
+        def execute(task):
+            task.start = time.perf_counter()
+            try:
+                task.func()
+            except BaseException as e:
+                with lock:
+                    if state['error'] is None:
+                        print("Task %s failed: %s" % (task.name, e))
+                        state['error'] = e
+                finished.set()
+                return
+            finally:
+                task.end = time.perf_counter()
+            with lock:
+                state['done'] += 1
+                ready = []
+                for other in dependents[task]:
+                    pending[other] -= 1
+                    if pending[other] == 0:
+                        ready.append(other)
+                if state['done'] == len(tasks):
+                    finished.set()
+            for other in ready:
+                submit(other)
+
+        try:
+            for task in tasks:
+                if not task.deps:
+                    submit(task)
+            if tasks:
+                finished.wait()
+        finally:
+            for pool in pools.values():
+                pool.shutdown(wait=True, cancel_futures=True)
+        if state['error'] is not None:
+            raise state['error']
+
+
+def critical_path(tasks):
+    """Returns (seconds, tasks) of the longest chain of dependent tasks by
+    run time, a lower bound of the time the graph can be run in.
+    """
+    longest = {}
+    for task in sorted(tasks, key=lambda t: t.end):
+        before = max((longest[dep] for dep in task.deps),
+                     key=lambda chain: chain[0], default=(0.0, []))
+        longest[task] = (before[0] + task.seconds, before[1] + [task])
+    return max(longest.values(), key=lambda chain: chain[0],
+               default=(0.0, []))
+
+
+def summary(tasks, wall):
+    """Returns a text table of the tasks and the critical path
+    """
+    lines = ['%-28s %-8s %10s %10s %10s' %
+             ('task', 'resource', 'waited', 'seconds', 'finished')]
+    t0 = min(task.queued for task in tasks)
+    for task in sorted(tasks, key=lambda t: t.start):
+        lines.append('%-28s %-8s %10.3f %10.3f %10.3f' %
+                     (task.name, task.resource, task.start - task.queued,
+                      task.seconds, task.end - t0))
+    seconds, path = critical_path(tasks)
+    lines.append("Critical path: %.3fs, %s" %
+                 (seconds, ' -> '.join(task.name for task in path)))
+    lines.append("Wall time: %.3fs" % wall)
+    return '\n'.join(lines)
+
+
+def version_tasks(version, plat, output_root, src_root, tracer,
+                  staged_cache, restore_outputs=True):
+    """Returns the tasks building every output of version, in dependency
+    order. Each output is restored from staged_cache if restore_outputs is
+    set, the blob is only extracted if some output is not.
+    """
+    ver_config = build.config[version]
+    src_dir = os.path.join(src_root, version)
+    os.makedirs(src_dir, exist_ok=True)
+    out_dir = os.path.join(output_root, version)
+    extractor = build.dispatcher[plat](
+        version, ver_config, ver_config[plat],
+        prefix=os.path.join(out_dir, 'cudatoolkit'), src_dir=src_dir,
+        hardlink=True)
+    label = 'cudatoolkit-%s' % version
+
+    def download():
+        with tracer.phase('download_blobs', label):
+            extractor.download_blobs()
+
+    def verify():
+        with tracer.phase('check_md5', label):
+            extractor.check_md5()
+
+    def prefix(pkg_name):
+        return os.path.join(out_dir, pkg_name)
+
+    pkg_names = sorted(ver_config['pkg_libs']) + ['cudatoolkit']
+    # the extractor each output was staged (or restored) by, and the outputs
+    # the staged output cache had no payload for, only these need the blob
+    # extracted
+    outputs = {}
+    missed = set() if restore_outputs else set(pkg_names)
+    # the file plan of every package, made once the blob is extracted and
+    # shared by the outputs staged from it as in build.py --all-outputs
+    plan = {}
+
+    def restore(pkg_name):
+        restored_by = extractor.for_prefix(prefix(pkg_name))
+        with tracer.phase('restore', '%s-%s' % (pkg_name, version)) as record:
+            restored = restored_by.restore_staged(staged_cache, pkg_name)
+            if restored is not None:
+                record['files'] = restored
+        if restored is None:
+            missed.add(pkg_name)
+        else:
+            outputs[pkg_name] = restored_by
+
+    def extract():
+        if not missed:
+            print("All outputs of %s restored from the staged output cache"
+                  % version)
+            return
+        with tracer.phase('extract', label) as record:
+            extractor.extract_cached(ExtractCache(extractor.cache_dir))
+            if extractor.extract_peak_bytes is not None:
+                record['peak_disk_bytes'] = extractor.extract_peak_bytes
+        with tracer.phase('plan', label) as record:
+            # the cudatoolkit link scripts list the libraries of every
+            # package
+            plan.update(extractor.plan(sorted(extractor.pkg_dict)))
+            record['files'] = sum(len(plan[p]) for p in missed if p in plan)
+
+    def stage(pkg_name):
+        output = '%s-%s' % (pkg_name, version)
+        if pkg_name in missed:
+            staged = outputs[pkg_name] = extractor.for_prefix(prefix(pkg_name))
+            with tracer.phase('copy', output) as record:
+                record['files'] = staged.stage_plan(plan.get(pkg_name, []))
+                if staged.slim_saved is not None:
+                    record['slim_saved_bytes'] = staged.slim_saved
+                if pkg_name in plan:
+                    staged.write_lib_index(pkg_name, plan[pkg_name])
+            with tracer.phase('make_link_scripts', output):
+                staged.make_link_scripts(pkg_name, plan)
+            with tracer.phase('save_staged', output):
+                staged.save_staged(staged_cache, pkg_name)
+        with tracer.phase('manifest', output):
+            manifest.write(out_dir, outputs[pkg_name].manifest(pkg_name))
+
+    t_download = Task('download %s' % version, 'network', download)
+    t_verify = Task('verify %s' % version, 'cpu', verify, [t_download])
+    t_restores = []
+    if restore_outputs:
+        t_restores = [Task('restore %s %s' % (version, pkg_name), 'disk',
+                           lambda pkg_name=pkg_name: restore(pkg_name),
+                           [t_verify])
+                      for pkg_name in pkg_names]
+    # does nothing if every output was restored
+    t_extract = Task('extract %s' % version, 'cpu', extract,
+                     t_restores or [t_verify])
+    tasks = [t_download, t_verify] + t_restores + [t_extract]
+    for pkg_name in pkg_names:
+        tasks.append(Task('stage %s %s' % (version, pkg_name), 'disk',
+                          lambda pkg_name=pkg_name: stage(pkg_name),
+                          [t_extract]))
+    return tasks
+
+
+def _main(argv=None):
+    parser = argparse.ArgumentParser(description="Build every output of "
+                                     "several CUDA versions in one run")
+    parser.add_argument('--versions', nargs='+', default=build.versions,
+                        help="the CUDA versions to build, default all")
+    parser.add_argument('--output-root', default='staged',
+                        help="the directory holding <version>/<pkg_name> "
+                        "prefixes")
+    parser.add_argument('--src-root', default=None,
+                        help="the directory holding a download directory "
+                        "per version, defaults to $SRC_DIR or the current "
+                        "directory")
+    parser.add_argument('--network-jobs', type=int, default=2,
+                        help="number of versions downloading at once")
+    parser.add_argument('--cpu-jobs', type=int, default=os.cpu_count() or 1,
+                        help="number of verify and extract tasks at once")
+    parser.add_argument('--disk-jobs', type=int, default=4,
+                        help="number of outputs staging at once")
+    parser.add_argument('--platform', default=build.getplatform(),
+                        choices=sorted(build.dispatcher),
+                        help="the platform to build the packages for, "
+                        "defaults to this one")
+    parser.add_argument('--rebuild', action='store_true',
+                        help="do not restore outputs from the staged "
+                        "output cache")
+    parser.add_argument('--report', default=None,
+                        help="also write the size and duplication report "
+                        "as JSON to this file")
+    args = parser.parse_args(argv)
+
+    plat = args.platform
+    output_root = os.path.abspath(args.output_root)
+    src_root = os.path.abspath(args.src_root or
+                               os.environ.get('SRC_DIR', os.getcwd()))
+    limits = {'network': args.network_jobs, 'cpu': args.cpu_jobs,
+              'disk': args.disk_jobs}
+    with traced_run('matrix') as tracer:
+        staged_cache = StagedCache(default_cache_dir(), staged_cache_bytes())
+        tasks = []
+        for version in args.versions:
+            tasks += version_tasks(version, plat, output_root, src_root,
+                                   tracer, staged_cache,
+                                   restore_outputs=not args.rebuild)
+        start = time.perf_counter()
+        try:
+            Scheduler(limits).run(tasks)
+        finally:
+            done = [task for task in tasks if task.end is not None]
+            if done:
+                print(summary(done, time.perf_counter() - start))
+        report = manifest.report(manifest.find(
+            [os.path.join(output_root, v) for v in args.versions]))
+        print(manifest.format_report(report))
+        if args.report:
+            write_json(args.report, report)
+
+
+if __name__ == "__main__":
+    _main()
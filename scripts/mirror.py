@@ -0,0 +1,158 @@
+"""A mirror of the CUDA blobs, patches and md5sum lists in the configuration.
+
+Build hosts without a reliable route to developer.nvidia.com build from a
+mirror instead, synced by a host that has one:
+
+    python scripts/mirror.py /srv/cuda-mirror --versions 9.0 9.1
+
+Every version and platform in the configuration is synced unless fewer
+are asked for. Each file is kept at <root>/<host>/<path> of its url (see
+downloader.mirror_path()) and the files are downloaded concurrently. The
+md5sum lists are fetched first and each blob and patch is checked against
+them as in a build, a file that fails is removed. <root>/mirror.json
+lists every file in the mirror with its url, size and md5sum.
+
+A build uses the mirror when CUDATOOLKIT_MIRROR is set to its root, as a
+directory, a file:// url or the http(s) url it is served at. Each file is
+fetched from the mirror and only from upstream if the mirror does not
+have a good copy.
+"""
+from __future__ import print_function
+import argparse
+import os
+import sys
+
+from concurrent.futures import ThreadPoolExecutor
+
+import build
+from cache import ChecksumCache, default_cache_dir, read_json, write_json
+from downloader import fetch, mirror_path
+
+MANIFEST = 'mirror.json'
+
+PLATFORMS = ('linux', 'windows', 'osx')
+
+
+def downloads(versions, platforms):
+    """Returns the files to mirror for versions and platforms as (md5 urls,
+    blobs), the urls of the md5sum lists and a list of (url, filename, md5
+    url, required) of the blobs and patches, required is whether the file
+    must be in the md5sum list.
+    """
+    md5_urls = []
+    blobs = []
+    seen = set()
+    for version in versions:
+        ver_config = build.config[version]
+        if ver_config['md5_url'] not in md5_urls:
+            md5_urls.append(ver_config['md5_url'])
+        for plt in platforms:
+            for i, (url, fn) in enumerate(
+                    build.blob_downloads(ver_config, ver_config[plt])):
+                if url not in seen:
+                    seen.add(url)
+                    blobs.append((url, fn, ver_config['md5_url'], i == 0))
+    return md5_urls, blobs
+
+
+def sync(root, versions, platforms, jobs=4):
+    """Syncs the files of versions and platforms into the mirror at root
+    and updates its manifest. Files already in the mirror are checked
+    rather than downloaded again, except the md5sum lists which are always
+    refreshed. Returns the urls that could not be mirrored.
+    """
+    md5_urls, blobs = downloads(versions, platforms)
+    checksums = ChecksumCache(default_cache_dir())
+    manifest_path = os.path.join(root, MANIFEST)
+    files = (read_json(manifest_path) or {}).get('files', {})
+    failed = []
+
+    def local(url):
+        path = os.path.join(root, mirror_path(url))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def key(url):
+        return mirror_path(url).replace(os.sep, '/')
+
+    def record(url, path, md5sum):
+        files[key(url)] = {'url': url, 'size': os.path.getsize(path),
+                           'md5': md5sum}
+
+    def get_md5_list(url):
+        path = local(url)
+        fresh = path + '.sync'
+        if os.path.isfile(fresh):
+            os.remove(fresh)
+        try:
+            md5sum = fetch(url, fresh)
+        except (OSError, ValueError) as e:
+            if not os.path.isfile(path):
+                print("Cannot mirror %s: %s" % (url, e))
+                failed.append(url)
+                return
+            print("Cannot refresh %s (%s), keeping the mirrored copy" %
+                  (url, e))
+            md5sum = checksums.md5sum(path)
+        else:
+            os.replace(fresh, path)
+        record(url, path, md5sum)
+
+    def get_blob(item):
+        url, fn, md5_url, required = item
+        path = local(url)
+        md5_path = local(md5_url)
+
+        def verify(part, md5sum):
+            build.check_published_md5(md5_path, fn, md5sum, required)
+
+        try:
+            md5sum = fetch(url, path, verify=verify)
+            if md5sum is None:
+                md5sum = checksums.md5sum(path)
+                try:
+                    verify(path, md5sum)
+                except RuntimeError:
+                    os.remove(path)
+                    raise
+            else:
+                checksums.record(path, md5sum)
+        except (OSError, ValueError, RuntimeError) as e:
+            print("Cannot mirror %s: %s" % (url, e))
+            failed.append(url)
+            if not os.path.isfile(path):
+                files.pop(key(url), None)
+            return
+        record(url, path, md5sum)
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        list(pool.map(get_md5_list, md5_urls))
+        list(pool.map(get_blob, blobs))
+    write_json(manifest_path, {'files': files})
+    nbytes = sum(f['size'] for f in files.values())
+    print("Mirror %s holds %d files, %d bytes" % (root, len(files), nbytes))
+    return failed
+
+
+def _main(argv=None):
+    parser = argparse.ArgumentParser(description="Sync the CUDA blobs, "
+                                     "patches and md5sum lists into a mirror")
+    parser.add_argument('root', help="the directory holding the mirror")
+    parser.add_argument('--versions', nargs='+', default=build.versions,
+                        help="the CUDA versions to mirror, default all")
+    parser.add_argument('--platforms', nargs='+', default=list(PLATFORMS),
+                        choices=PLATFORMS,
+                        help="the platforms to mirror, default all")
+    parser.add_argument('--jobs', type=int, default=4,
+                        help="number of files downloaded at once")
+    args = parser.parse_args(argv)
+
+    failed = sync(os.path.abspath(args.root), args.versions, args.platforms,
+                  args.jobs)
+    for url in failed:
+        print("Not mirrored: %s" % url)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(_main())
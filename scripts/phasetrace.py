@@ -0,0 +1,192 @@
+"""Timing of the build phases.
+
+Each phase records its wall time and the bytes the process read and wrote
+while it ran (from /proc/self/io, so only where that exists, and work done
+by child processes such as the NVIDIA installer or 7za is not counted).
+Concurrent phases see each other's I/O. The events can be written as a
+Chrome trace (chrome://tracing, Perfetto) which is also plain JSON.
+
+DiskMeter samples the bytes on disk under a directory whilst something
+runs, to report the peak footprint of e.g. extraction. Each sample walks
+the directory, so builds only meter extraction when they are traced or
+profiled (see disk_metering()), and the samples grow further apart.
+
+Set CUDATOOLKIT_TRACE_DIR to write a trace per build.py run, and
+CUDATOOLKIT_PROFILE to also write a cProfile dump there (or to the current
+directory if no trace directory is set).
+"""
+import json
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+
+
+def _io_counters():
+    """Returns (bytes read, bytes written) by this process so far or None
+    """
+    try:
+        with open('/proc/self/io', 'r') as f:
+            counters = dict(line.split(':') for line in f if ':' in line)
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def disk_usage(path):
+    """Returns the bytes allocated on disk to the files under path, hard
+    linked files are counted once.
+    """
+    seen = set()
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in dirnames + filenames:
+            try:
+                st = os.lstat(os.path.join(dirpath, name))
+            except OSError:
+                # removed whilst walking
+                continue
+            if (st.st_dev, st.st_ino) in seen:
+                continue
+            seen.add((st.st_dev, st.st_ino))
+            blocks = getattr(st, 'st_blocks', None)
+            total += st.st_size if blocks is None else blocks * 512
+    return total
+
+
+def disk_metering():
+    """Whether a build meters the disk usage of extraction, only when it
+    writes a trace or a profile (CUDATOOLKIT_TRACE_DIR or
+    CUDATOOLKIT_PROFILE is set).
+    """
+    return bool(os.environ.get('CUDATOOLKIT_TRACE_DIR') or
+                os.environ.get('CUDATOOLKIT_PROFILE'))
+
+
+class DiskMeter(object):
+    """Context manager sampling disk_usage(path) from a background thread,
+    the peak attribute is the most seen and final the usage on exit. The
+    interval between samples grows by growth each time, up to
+    max_interval, a long extraction is not walked over and over.
+    """
+
+    def __init__(self, path, interval=0.05, growth=1.5, max_interval=5.0):
+        self.path = path
+        self.interval = interval
+        self.growth = growth
+        self.max_interval = max_interval
+        self.peak = self.final = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        interval = self.interval
+        while True:
+            self.peak = max(self.peak, disk_usage(self.path))
+            if self._stop.wait(interval):
+                return
+            interval = min(interval * self.growth, self.max_interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.final = disk_usage(self.path)
+        self.peak = max(self.peak, self.final)
+
+
+class PhaseTracer(object):
+    """Records the phases of a build as Chrome trace "complete" events
+    """
+
+    def __init__(self):
+        self.events = []
+        self.pid = os.getpid()
+        self._t0 = time.perf_counter()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name, output='cudatoolkit', **args):
+        """Context manager timing the phase name of output, yields a
+        dictionary of extra values (e.g. files) to record with it.
+        """
+        record = dict(args)
+        io_start = _io_counters()
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            end = time.perf_counter()
+            io_end = _io_counters()
+            if io_start is not None and io_end is not None:
+                record.setdefault('bytes_read', io_end[0] - io_start[0])
+                record.setdefault('bytes_written', io_end[1] - io_start[1])
+            event = {'name': name, 'cat': output, 'ph': 'X',
+                     'ts': (start - self._t0) * 1e6,
+                     'dur': (end - start) * 1e6,
+                     'pid': self.pid, 'tid': threading.get_ident(),
+                     'args': record}
+            with self._lock:
+                self.events.append(event)
+
+    def summary(self):
+        """Returns a text table of the phases
+        """
+        lines = ['%-18s %-12s %10s %14s %14s %7s' %
+                 ('phase', 'output', 'seconds', 'bytes read',
+                  'bytes written', 'files')]
+        for ev in sorted(self.events, key=lambda ev: ev['ts']):
+            args = ev['args']
+            lines.append('%-18s %-12s %10.3f %14s %14s %7s' %
+                         (ev['name'], ev['cat'], ev['dur'] / 1e6,
+                          args.get('bytes_read', '-'),
+                          args.get('bytes_written', '-'),
+                          args.get('files', '-')))
+        return '\n'.join(lines)
+
+    def write(self, path):
+        """Writes the events as a Chrome trace JSON file
+        """
+        with self._lock:
+            trace = {'traceEvents': list(self.events),
+                     'displayTimeUnit': 'ms'}
+        with open(path, 'w') as f:
+            json.dump(trace, f, indent=1)
+
+
+@contextmanager
+def traced_run(label):
+    """Context manager for a whole build.py run, yields a PhaseTracer and on
+    exit prints its summary and writes the trace and profile requested by
+    the environment, named after label.
+    """
+    trace_dir = os.environ.get('CUDATOOLKIT_TRACE_DIR')
+    profile = os.environ.get('CUDATOOLKIT_PROFILE')
+    tracer = PhaseTracer()
+    profiler = None
+    if profile:
+        import cProfile  # only needed when profiling
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        yield tracer
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        print("Phase timings:\n%s" % tracer.summary())
+        name = '%s-%d' % (label, os.getpid())
+        out_dir = trace_dir or os.getcwd()
+        if trace_dir or profiler is not None:
+            os.makedirs(out_dir, exist_ok=True)
+        if trace_dir:
+            path = os.path.join(out_dir, 'trace-%s.json' % name)
+            tracer.write(path)
+            print("Wrote trace to %s" % path)
+        if profiler is not None:
+            path = os.path.join(out_dir, 'profile-%s.prof' % name)
+            profiler.dump_stats(path)
+            print("Wrote profile to %s" % path)
@@ -0,0 +1,77 @@
+"""Listing and selective extraction of 7z archives with 7za.
+
+The NVIDIA windows installers (and the patches to them) are self
+extracting 7z archives. Rather than unpacking everything, the archive is
+listed once and just the members asked for are extracted. 7za also reads
+the osx .dmg images, which is how they are unpacked off osx.
+"""
+import os
+import subprocess
+import tempfile
+
+SEVENZIP = '7za'
+
+
+def _run(args):
+    try:
+        return subprocess.check_output([SEVENZIP] + args)
+    except subprocess.CalledProcessError as e:
+        raise ValueError("7za failed with exit status %d" % e.returncode)
+
+
+def list_files(path):
+    """Returns the names of the files (not directories) in the archive at
+    path, with / as the separator. Raises ValueError if 7za cannot list it.
+    """
+    return [name for name, size in list_members(path)]
+
+
+def list_members(path):
+    """Returns (name, size) of the files in the archive at path, as
+    list_files()
+    """
+    out = _run(['l', '-slt', path]).decode('utf-8', 'replace')
+    # the technical listing is a block of "key = value" lines per item,
+    # the items follow the dashed line after the archive's own properties
+    _, sep, items = out.partition('\n----------')
+    if not sep:
+        raise ValueError("Cannot list %s" % path)
+    names = []
+    for block in items.replace('\r\n', '\n').split('\n\n'):
+        props = dict(line.split(' = ', 1) for line in block.splitlines()
+                     if ' = ' in line)
+        if 'Path' not in props:
+            continue
+        if props.get('Folder') == '+' or 'D' in props.get('Attributes', ''):
+            continue
+        size = int(props['Size']) if props.get('Size') else None
+        names.append((props['Path'].replace('\\', '/'), size))
+    return names
+
+
+def extract_files(path, members, dest):
+    """Extracts members of the archive at path into the directory dest,
+    without their directories, replacing files already there.
+    Arguments:
+      path - the archive
+      members - names as returned by list_files()
+      dest - the directory to extract into
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        listfile = os.path.join(tmp, 'members.txt')
+        with open(listfile, 'w', encoding='utf-8') as f:
+            for name in members:
+                f.write(name.replace('/', os.sep) + '\n')
+        _run(['e', '-y', '-aoa', '-bd', '-scsUTF-8', '-o%s' % dest, path,
+              '@%s' % listfile])
+
+
+def extract_tree(path, dest, patterns=None):
+    """Extracts the archive at path into the directory dest keeping its
+    directories, just the files whose names match one of the wildcard
+    patterns (at any depth) if given. Raises ValueError if 7za fails.
+    """
+    args = ['x', '-y', '-aoa', '-bd', '-scsUTF-8', '-o%s' % dest, path]
+    if patterns:
+        args += ['-r'] + list(patterns)
+    _run(args)
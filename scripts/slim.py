@@ -0,0 +1,86 @@
+"""Slimming of the staged linux libraries.
+
+The shared libraries in the installers carry static symbol tables and
+other sections that are never loaded. With CUDATOOLKIT_SLIM set the copies
+staged into the prefix are stripped of them with the binutils, strip
+--strip-unneeded or objcopy --strip-unneeded, whichever is installed. The
+stripped library replaces the staged copy only if its SONAME and dynamic
+symbols are unchanged, otherwise the library is staged as it was. The
+extracted store is never modified, a staged copy linked to it is replaced
+rather than rewritten.
+"""
+from __future__ import print_function
+import os
+import shutil
+import subprocess
+
+from concurrent.futures import ThreadPoolExecutor
+
+import binfmt
+
+# tried in order, the first installed is used; each takes (source, target)
+TOOLS = [('strip', lambda src, dst: ['--strip-unneeded', '-o', dst, src]),
+         ('objcopy', lambda src, dst: ['--strip-unneeded', src, dst])]
+
+
+def enabled():
+    """Whether the staged libraries are slimmed, CUDATOOLKIT_SLIM
+    """
+    return bool(os.environ.get('CUDATOOLKIT_SLIM'))
+
+
+def find_tool():
+    """Returns (path, arguments) of the installed tool to slim with, where
+    arguments takes (source, target) and returns the rest of the command
+    line, or None if there is none.
+    """
+    for name, arguments in TOOLS:
+        path = shutil.which(name)
+        if path is not None:
+            return path, arguments
+    return None
+
+
+def _interface(path):
+    return binfmt.soname(path), binfmt.dynamic_symbols(path)
+
+
+def slim_file(path, tool):
+    """Slims the ELF library at path in place with tool, see find_tool().
+    Returns the bytes saved, None if path is not an ELF file or 0 if it is
+    left as it was because slimming failed or changed its interface.
+    """
+    if binfmt.identify(path) != 'elf':
+        return None
+    exe, arguments = tool
+    slimmed = path + '.slim'
+    try:
+        before = _interface(path)
+        subprocess.check_call([exe] + arguments(path, slimmed))
+        if _interface(slimmed) != before:
+            print("Not slimming %s, its dynamic symbols would change" % path)
+            return 0
+        saved = os.path.getsize(path) - os.path.getsize(slimmed)
+        if saved <= 0:
+            return 0
+        shutil.copymode(path, slimmed)
+        os.replace(slimmed, path)
+        return saved
+    except (subprocess.CalledProcessError, ValueError) as e:
+        print("Not slimming %s: %s" % (path, e))
+        return 0
+    finally:
+        if os.path.lexists(slimmed):
+            os.remove(slimmed)
+
+
+def slim_files(paths, tool, jobs=None):
+    """Slims the libraries at paths concurrently, see slim_file(). Returns
+    (slimmed, bytes before, bytes saved) over the ELF files in paths.
+    """
+    sizes = {path: os.path.getsize(path) for path in paths}
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        saved = list(pool.map(lambda path: slim_file(path, tool), paths))
+    elf = [(path, n) for path, n in zip(paths, saved) if n is not None]
+    return (sum(1 for path, n in elf if n), sum(sizes[path] for path, n in elf),
+            sum(n for path, n in elf))
@@ -0,0 +1,97 @@
+"""Placing extracted files into a package prefix with as little I/O as
+possible.
+
+The extracted blobs and the prefixes are usually on the same filesystem,
+so a file is hard linked if it can be, else reflinked (or copied in kernel
+with copy_file_range), and only read and written through Python as a
+last resort.
+
+Hard links share the inode with the extraction cache, anything modifying
+the staged files in place modifies the cached copy too. conda-build does
+exactly that to the libraries in its $PREFIX when it relocates them, so
+files staged there use the 'clone' mode, a reflink or a copy of their own
+(see unshared()). Only staging roots nothing edits are hard linked.
+"""
+import errno
+import os
+import shutil
+import sys
+
+MODES = ('auto', 'hardlink', 'reflink', 'copy', 'clone')
+
+# from linux/fs.h
+FICLONE = 0x40049409
+
+_UNSUPPORTED = (errno.EXDEV, errno.EPERM, errno.EACCES, errno.EMLINK,
+                errno.EOPNOTSUPP, errno.ENOTSUP, errno.EINVAL, errno.ENOSYS,
+                errno.ENOTTY, errno.EBADF)
+
+
+def _hardlink(src, dst):
+    os.link(src, dst)
+
+
+def _reflink(src, dst):
+    if not sys.platform.startswith('linux'):
+        raise OSError(errno.ENOSYS, 'reflink unsupported on this platform')
+    import fcntl
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED:
+                raise
+            # no reflinks here, have the kernel copy the data instead
+            remaining = os.fstat(fsrc.fileno()).st_size
+            while remaining > 0:
+                copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(),
+                                            remaining)
+                if copied == 0:
+                    break
+                remaining -= copied
+    shutil.copymode(src, dst)
+
+
+def _copy(src, dst):
+    shutil.copy(src, dst)
+
+
+_METHODS = {'hardlink': _hardlink, 'reflink': _reflink, 'copy': _copy}
+
+# the methods each mode tries, in turn
+_ORDER = {'auto': ('hardlink', 'reflink', 'copy'),
+          'clone': ('reflink', 'copy')}
+
+
+def unshared(mode):
+    """Returns the mode to stage with instead of mode where the staged file
+    must not share its inode with the source, i.e. 'clone' rather than
+    any mode that hard links.
+    """
+    return 'clone' if mode in ('auto', 'hardlink') else mode
+
+
+def stage_file(src, dst, mode='auto'):
+    """Places a copy of the regular file src at dst, replacing dst if it
+    exists. Returns the method used.
+    Arguments:
+      src - the file to stage
+      dst - the path to stage it to
+      mode - one of 'hardlink', 'reflink' or 'copy' to use just that
+             method, 'auto' to try each in turn or 'clone' to try all
+             but hardlink
+    """
+    if mode not in MODES:
+        raise ValueError("Unknown staging mode: %s" % mode)
+    if os.path.lexists(dst):
+        os.remove(dst)
+    methods = _ORDER.get(mode, (mode,))
+    for method in methods:
+        try:
+            _METHODS[method](src, dst)
+            return method
+        except OSError as e:
+            if method == methods[-1] or e.errno not in _UNSUPPORTED:
+                raise
+            if os.path.lexists(dst):
+                os.remove(dst)
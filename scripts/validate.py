@@ -0,0 +1,231 @@
+"""Checks the libraries of built cudatoolkit packages without a GPU.
+
+For every library pkg_libs lists for a package the files matching its
+pattern in the package's library directory are found, symlink chains are
+followed to the one concrete file, and that file's headers are checked:
+  linux   - a 64 bit ELF shared object whose SONAME is in the directory
+            and leads back to it, with the CUDA version in the SONAME of
+            the CUDA libraries
+  osx     - a Mach-O dylib whose install name is in the directory, with
+            the CUDA version in it for the CUDA libraries
+  windows - a 64 bit PE DLL, with the CUDA version in the file name of
+            the CUDA libraries
+  libdevice files must be LLVM bitcode.
+The headers are read through mmap (see binfmt.py) and the files are
+checked concurrently, nothing is loaded so neither numba nor a driver is
+needed.
+
+The naming rules above have only been tried on synthetic installers, so a
+recipe build runs the check only if CUDATOOLKIT_VALIDATE is set (or
+build.py is given --validate) until it has passed on the real installers
+of every version and platform.
+
+    python validate.py --prefix $PREFIX --cuda-version 9.1 cublas nvvm
+    python validate.py --output-root staged --cuda-version 9.1
+"""
+from __future__ import print_function
+import argparse
+import os
+import sys
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import binfmt
+from libindex import LibraryIndex
+
+LIBDIRS = {'linux': 'lib',
+           'osx': 'lib',
+           'windows': os.path.join('Library', 'bin')}
+
+
+def enabled():
+    """Whether a build checks the libraries it staged, CUDATOOLKIT_VALIDATE
+    """
+    return bool(os.environ.get('CUDATOOLKIT_VALIDATE'))
+
+
+def expected_libraries(pkg_name, ver_config, plt_config):
+    """Returns [(library, pattern, kind)] for the libraries of pkg_name,
+    kind is one of 'cuda', 'nvtx', 'nvvm' or 'libdevice'.
+    """
+    if pkg_name == 'nvvm':
+        libs = [('nvvm', plt_config['nvvm_lib_fmt'].format('nvvm'), 'nvvm')]
+        for v in ver_config['libdevice_versions']:
+            pattern = plt_config['libdevice_lib_fmt'].format(v)
+            libs.append((os.path.splitext(pattern)[0], pattern, 'libdevice'))
+        return libs
+    if pkg_name == 'nvtx':
+        return [(lib, plt_config['nvtoolsext_fmt'].format(lib), 'nvtx')
+                for lib in ver_config['pkg_libs'][pkg_name]]
+    return [(lib, plt_config['cuda_lib_fmt'].format(lib), 'cuda')
+            for lib in ver_config['pkg_libs'].get(pkg_name, [])]
+
+
+def check_file(index, name, kind, platform, version):
+    """Returns the problems found with the concrete library file name in
+    index, an empty list if there are none.
+    """
+    path = index.path(name)
+    try:
+        info = binfmt.inspect(path)
+    except (OSError, ValueError) as e:
+        return ['%s: %s' % (name, e)]
+    fmt = info['format']
+    problems = []
+    if kind == 'libdevice':
+        if fmt != 'bitcode':
+            problems.append('%s: not LLVM bitcode' % name)
+        return problems
+    if platform == 'linux':
+        if fmt != 'elf':
+            return ['%s: not an ELF file' % name]
+        if info['type'] != binfmt.ET_DYN or info['bits'] != 64:
+            problems.append('%s: not a 64 bit ELF shared object' % name)
+        loaded_as = info['soname']
+        if loaded_as is None:
+            problems.append('%s: no SONAME' % name)
+        elif index.resolve(loaded_as) != name:
+            problems.append('%s: SONAME %s does not lead to it' %
+                            (name, loaded_as))
+        if kind == 'cuda' and loaded_as and '.so.%s' % version not in loaded_as:
+            problems.append('%s: SONAME %s is not for CUDA %s' %
+                            (name, loaded_as, version))
+    elif platform == 'osx':
+        if fmt != 'macho':
+            return ['%s: not a Mach-O file' % name]
+        if info['type'] != binfmt.MH_DYLIB:
+            problems.append('%s: not a Mach-O dylib' % name)
+        loaded_as = info['install_name']
+        if loaded_as is None:
+            problems.append('%s: no install name' % name)
+        elif index.resolve(os.path.basename(loaded_as)) != name:
+            problems.append('%s: install name %s does not lead to it' %
+                            (name, loaded_as))
+        if kind == 'cuda' and loaded_as and '.%s.' % version not in loaded_as:
+            problems.append('%s: install name %s is not for CUDA %s' %
+                            (name, loaded_as, version))
+    else:
+        if fmt != 'pe':
+            return ['%s: not a PE file' % name]
+        if not info['dll'] or info['machine'] != 'x86_64':
+            problems.append('%s: not a 64 bit DLL' % name)
+        if kind == 'cuda' and version.replace('.', '') not in name:
+            problems.append('%s: not named for CUDA %s' % (name, version))
+    return problems
+
+
+def package_checks(prefix, pkg_name, ver_config, plt_config, platform,
+                   version):
+    """Returns (checks, problems) for pkg_name installed in prefix, checks
+    is a list of arguments to check_file() and problems those found
+    finding the files.
+    """
+    dirpath = os.path.join(prefix, LIBDIRS[platform])
+    libs = expected_libraries(pkg_name, ver_config, plt_config)
+    if not libs:
+        return [], []
+    try:
+        index = LibraryIndex(dirpath, [pattern for _, pattern, _ in libs])
+    except FileNotFoundError:
+        return [], ['%s: no library directory %s' % (pkg_name, dirpath)]
+    checks = []
+    problems = []
+    for lib, pattern, kind in libs:
+        names = index.find(pattern)
+        if not names:
+            problems.append('%s: nothing matches %s' % (lib, pattern))
+            continue
+        concrete = set()
+        for name in names:
+            target = index.resolve(name)
+            if target is None:
+                problems.append('%s: broken symlink %s' % (lib, name))
+            else:
+                concrete.add(target)
+        if len(concrete) > 1:
+            problems.append('%s: several files %s' %
+                            (lib, ', '.join(sorted(concrete))))
+        for name in sorted(concrete):
+            checks.append((index, name, kind, platform, version))
+    return checks, problems
+
+
+def validate(prefixes, ver_config, plt_config, platform, version, jobs=None):
+    """Checks the packages in prefixes, a dictionary of package name to its
+    prefix. Returns a dictionary of package name to (files checked, list of
+    problems, seconds).
+    """
+    results = {}
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        for pkg_name, prefix in sorted(prefixes.items()):
+            start = time.perf_counter()
+            checks, problems = package_checks(prefix, pkg_name, ver_config,
+                                              plt_config, platform, version)
+            for found in pool.map(lambda args: check_file(*args), checks):
+                problems += found
+            results[pkg_name] = (len(checks), problems,
+                                 time.perf_counter() - start)
+    return results
+
+
+def report(results):
+    """Prints results as returned by validate(), returns whether there were
+    no problems.
+    """
+    ok = True
+    for pkg_name, (nfiles, problems, seconds) in sorted(results.items()):
+        status = 'OK' if not problems else 'FAILED'
+        print("%-12s %-6s %3d files %8.3fs" % (pkg_name, status, nfiles,
+                                               seconds))
+        for problem in problems:
+            print("    %s" % problem)
+        ok = ok and not problems
+    return ok
+
+
+def _main(argv=None):
+    import build  # for the version configuration
+
+    parser = argparse.ArgumentParser(description="Check the libraries of "
+                                     "built cudatoolkit packages")
+    parser.add_argument('packages', nargs='*',
+                        help="the packages to check, defaults to $PKG_NAME "
+                        "or else every package")
+    parser.add_argument('--prefix', default=os.environ.get('PREFIX'),
+                        help="the prefix the packages are installed in, "
+                        "defaults to $PREFIX")
+    parser.add_argument('--output-root', default=None,
+                        help="check a tree staged by build.py --all-outputs, "
+                        "with a prefix per package, instead of --prefix")
+    parser.add_argument('--cuda-version', default=os.environ.get('PKG_VERSION'),
+                        help="defaults to $PKG_VERSION")
+    parser.add_argument('--platform', default=None,
+                        choices=sorted(LIBDIRS),
+                        help="the platform the packages are for, defaults "
+                        "to this one")
+    parser.add_argument('--jobs', type=int, default=None,
+                        help="number of files to check concurrently")
+    args = parser.parse_args(argv)
+
+    version = args.cuda_version
+    ver_config = build.config[version]
+    platform = args.platform or build.getplatform()
+    packages = args.packages
+    if not packages:
+        pkg_name = os.environ.get('PKG_NAME')
+        if pkg_name and pkg_name != 'cudatoolkit':
+            packages = [pkg_name]
+        else:
+            packages = sorted(ver_config['pkg_libs'])
+    if args.output_root:
+        prefixes = {p: os.path.join(args.output_root, p) for p in packages}
+    else:
+        prefixes = {p: args.prefix for p in packages}
+    results = validate(prefixes, ver_config, ver_config[platform], platform,
+                       version, args.jobs)
+    return 0 if report(results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(_main())
@@ -0,0 +1,30 @@
+import os
+import sys
+
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, os.pardir, 'scripts'))
+sys.path.insert(0, os.path.join(HERE, os.pardir, 'benchmarks'))
+
+
+@pytest.fixture
+def linux_src(tmp_path):
+    """A synthetic CUDA 9.1 linux installer and its patch in a source
+    directory, returns (ver_config, plt_config, src_dir)
+    """
+    import build
+    import synthetic
+
+    site = str(tmp_path / 'site')
+    ver_cfg, plt_cfg = synthetic.build_site(
+        site, 'http://localhost/', '9.1', 'linux', build.config['9.1'],
+        build.config['9.1']['linux'], lib_size=4096, filler_size=4096)
+    src_dir = str(tmp_path / 'src')
+    os.makedirs(src_dir)
+    for dirpath, dirs, files in os.walk(site):
+        for fn in files:
+            if fn == plt_cfg['blob'] or fn in plt_cfg['patches']:
+                os.replace(os.path.join(dirpath, fn),
+                           os.path.join(src_dir, fn))
+    return ver_cfg, plt_cfg, src_dir
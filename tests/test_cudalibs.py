@@ -0,0 +1,43 @@
+import os
+
+import pytest
+
+import build
+import cudalibs
+
+
+@pytest.fixture
+def prefix(tmp_path, monkeypatch, linux_src):
+    monkeypatch.delenv('CUDATOOLKIT_SLIM', raising=False)
+    ver_cfg, plt_cfg, src_dir = linux_src
+    prefix = str(tmp_path / 'prefix')
+    extractor = build.LinuxExtractor('9.1', ver_cfg, plt_cfg, prefix=prefix,
+                                     src_dir=src_dir,
+                                     cache_dir=str(tmp_path / 'cache'))
+    extractor.extract_selective(str(tmp_path / 'store'))
+    for pkg_name in ('cudart', 'cublas', 'nvvm'):
+        extractor.copy(pkg_name)
+    return prefix
+
+
+def test_find(prefix):
+    lib = os.path.join(prefix, 'lib')
+    assert cudalibs.packages(prefix) == ['cublas', 'cudart', 'nvvm']
+    assert cudalibs.find('cublas', prefix=prefix) == \
+        os.path.join(lib, 'libcublas.so.9.1.99.100')
+    assert cudalibs.find('libdevice.10', package='nvvm', prefix=prefix) == \
+        os.path.join(lib, 'libdevice.10.bc')
+    # found without naming the package, after the one named like it
+    assert cudalibs.find('libdevice.10', prefix=prefix) == \
+        os.path.join(lib, 'libdevice.10.bc')
+    assert cudalibs.find('cufft', prefix=prefix) is None
+    assert os.path.isfile(os.path.join(lib, cudalibs.INDEX_DIR,
+                                       'cudalibs.py'))
+
+
+def test_entry(prefix):
+    entry = cudalibs.lookup('cudart', prefix=prefix)
+    assert entry['soname'] == 'libcudart.so.9.1'
+    assert entry['links'] == ['libcudart.so', 'libcudart.so.9.1']
+    # relocation rewrites the file after the index is written
+    assert 'sha256' not in entry and 'size' not in entry
@@ -0,0 +1,140 @@
+import bz2
+import gzip
+import io
+import lzma
+import os
+import random
+import tarfile
+
+import pytest
+
+import decompress
+
+COMPRESS = {'gzip': gzip.compress, 'xz': lzma.compress,
+            'bzip2': bz2.compress}
+
+
+def tar_bytes():
+    rng = random.Random(0)
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w') as tar:
+        for i in range(3):
+            data = bytes(rng.getrandbits(8) for _ in range(30000))
+            info = tarfile.TarInfo('lib64/libfoo.so.%d' % i)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+
+TAR = tar_bytes()
+
+
+def members(data):
+    """Reads the tarball data as makeself.py does, returns the names and
+    contents of its members
+    """
+    found = []
+    with decompress.decompressed(io.BytesIO(data)) as stream, \
+            tarfile.open(fileobj=stream, mode='r|*') as tar:
+        for member in tar:
+            found.append((member.name, tar.extractfile(member).read()))
+    return found
+
+
+def expected():
+    with tarfile.open(fileobj=io.BytesIO(TAR)) as tar:
+        return [(m.name, tar.extractfile(m).read()) for m in tar]
+
+
+@pytest.fixture(params=['inline', 'python', 'auto'])
+def mode(request, monkeypatch):
+    monkeypatch.setenv('CUDATOOLKIT_DECOMPRESS', request.param)
+    return request.param
+
+
+@pytest.mark.parametrize('compression', sorted(COMPRESS))
+@pytest.mark.parametrize('trailing', [b'', b'\0' * 1001, b'<html>junk'])
+def test_trailing_data_ignored(mode, compression, trailing):
+    assert members(COMPRESS[compression](TAR) + trailing) == expected()
+
+
+@pytest.mark.parametrize('compression', sorted(COMPRESS))
+def test_concatenated_streams(mode, compression):
+    half = len(TAR) // 2
+    data = COMPRESS[compression](TAR[:half]) + \
+        COMPRESS[compression](TAR[half:])
+    assert members(data) == expected()
+
+
+@pytest.mark.parametrize('compression', sorted(COMPRESS))
+def test_truncated(mode, compression):
+    data = COMPRESS[compression](TAR)
+    with pytest.raises((ValueError, tarfile.TarError)):
+        members(data[:len(data) * 2 // 3])
+
+
+def test_uncompressed(mode):
+    assert members(TAR) == expected()
+
+
+def test_gzip_inline_without_tool(monkeypatch):
+    monkeypatch.setenv('CUDATOOLKIT_DECOMPRESS', 'auto')
+    monkeypatch.setattr(decompress, 'find_tool', lambda compression: None)
+    assert decompress._method('gzip') == 'inline'
+    assert decompress._method('xz') == 'python'
+    monkeypatch.setenv('CUDATOOLKIT_DECOMPRESS', 'python')
+    assert decompress._method('gzip') == 'python'
+
+
+def member_boundary():
+    """The offset in TAR of the end of its first member"""
+    with tarfile.open(fileobj=io.BytesIO(TAR)) as tar:
+        first = tar.next()
+        return first.offset_data + (first.size + 511) // 512 * 512
+
+
+@pytest.mark.parametrize('compression', sorted(COMPRESS))
+def test_truncated_at_member_boundary(mode, compression):
+    # the second stream is cut short, the data decompressed up to there
+    # ends with a whole member
+    boundary = member_boundary()
+    second = COMPRESS[compression](TAR[boundary:])
+    data = COMPRESS[compression](TAR[:boundary]) + second[:len(second) // 2]
+    with pytest.raises(ValueError):
+        members(data)
+
+
+@pytest.mark.parametrize('compression', sorted(COMPRESS))
+def test_corrupt(mode, compression):
+    data = bytearray(COMPRESS[compression](TAR))
+    data[len(data) * 2 // 3] ^= 0xff
+    with pytest.raises((ValueError, tarfile.TarError)):
+        members(bytes(data))
+
+
+def read_all(data):
+    with decompress.decompressed(io.BytesIO(data)) as stream:
+        return stream.read(), stream.stats.method
+
+
+@pytest.mark.skipif(decompress.find_tool('xz') is None,
+                    reason='xz is not installed')
+@pytest.mark.parametrize('streams', [1, 2])
+def test_xz_tool_trailing_data(monkeypatch, streams):
+    monkeypatch.setenv('CUDATOOLKIT_DECOMPRESS', 'auto')
+    if streams == 1:
+        data = lzma.compress(TAR)
+        # less than the input is kept to check the failure
+        monkeypatch.setattr(decompress, 'BUFSIZE', 1024)
+        monkeypatch.setattr(decompress, 'TAIL_BYTES', len(data) // 3)
+    else:
+        half = len(TAR) // 2
+        data = (lzma.compress(TAR[:half]) + b'\0' * 8 +
+                lzma.compress(TAR[half:]))
+    assert read_all(data) == (TAR, 'xz')
+    assert read_all(data + b'<html>junk') == \
+        (TAR, 'xz, trailing data ignored')
+    for bad in (data[:-1] + b'<html>junk', data[:-1],
+                data[:len(data) // 2] + data[-100:]):
+        with pytest.raises(ValueError):
+            read_all(bad)
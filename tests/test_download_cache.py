@@ -0,0 +1,105 @@
+import os
+
+import pytest
+
+import build
+import synthetic
+from httpserver import LocalServer
+
+
+@pytest.fixture
+def site(tmp_path, monkeypatch):
+    monkeypatch.delenv('CUDATOOLKIT_MIRROR', raising=False)
+    monkeypatch.delenv('CUDATOOLKIT_BLOB_CACHE_DIR', raising=False)
+    monkeypatch.delenv('CUDATOOLKIT_BLOB_CACHE_BYTES', raising=False)
+    root = str(tmp_path / 'site')
+    with LocalServer(root) as server:
+        ver_cfg, plt_cfg = synthetic.build_site(
+            root, server.url, '9.1', 'linux', build.config['9.1'],
+            build.config['9.1']['linux'], lib_size=4096, filler_size=4096)
+        yield root, ver_cfg, plt_cfg
+
+
+def extractor(tmp_path, site, run):
+    root, ver_cfg, plt_cfg = site
+    src_dir = str(tmp_path / ('src%d' % run))
+    os.makedirs(src_dir)
+    return build.LinuxExtractor('9.1', ver_cfg, plt_cfg,
+                                prefix=str(tmp_path / 'prefix'),
+                                src_dir=src_dir,
+                                cache_dir=str(tmp_path / 'cache'))
+
+
+def served(site, *names):
+    root, ver_cfg, plt_cfg = site
+    for dirpath, dirs, files in os.walk(root):
+        for fn in files:
+            if fn in names:
+                return os.path.join(dirpath, fn)
+    raise KeyError(names)
+
+
+def test_cached_downloads(tmp_path, site):
+    root, ver_cfg, plt_cfg = site
+    first = extractor(tmp_path, site, 0)
+    first.download_blobs()
+    first.check_md5()
+    # the blob and the patch are cached, the md5sum list is not
+    with first.blob_cache._locked() as entries:
+        assert sorted(entries) == sorted(
+            url for url, fn in build.blob_downloads(ver_cfg, plt_cfg))
+
+    # served from the cache, the server now fails the blob
+    blob = served(site, plt_cfg['blob'])
+    with open(blob, 'wb') as f:
+        f.write(b'<html>Service Unavailable</html>')
+    second = extractor(tmp_path, site, 1)
+    second.download_blobs()
+    second.check_md5()
+    assert second.md5sums == first.md5sums
+
+
+def test_bad_patch_not_cached(tmp_path, site):
+    root, ver_cfg, plt_cfg = site
+    patch = served(site, *plt_cfg['patches'])
+    with open(patch, 'rb') as f:
+        good = f.read()
+    # a truncated download of the patch
+    with open(patch, 'wb') as f:
+        f.write(good[:len(good) // 2])
+    first = extractor(tmp_path, site, 0)
+    with pytest.raises(RuntimeError):
+        first.download_blobs()
+    with first.blob_cache._locked() as entries:
+        assert not any(url.endswith(plt_cfg['patches'][0])
+                       for url in entries)
+    assert not os.path.exists(os.path.join(first.src_dir,
+                                           plt_cfg['patches'][0]))
+
+    with open(patch, 'wb') as f:
+        f.write(good)
+    second = extractor(tmp_path, site, 1)
+    second.download_blobs()
+    second.check_md5()
+
+
+def test_md5_list_refetched(tmp_path, site):
+    root, ver_cfg, plt_cfg = site
+    first = extractor(tmp_path, site, 0)
+    first.download_blobs()
+    # upstream replaces the blob and publishes its new md5sum
+    blob = served(site, plt_cfg['blob'])
+    with open(blob, 'ab') as f:
+        f.write(b'\0' * 1024)
+    md5_list = served(site, 'md5sum.txt')
+    with open(md5_list, 'r') as f:
+        lines = f.read().splitlines()
+    lines[0] = '%s  %s' % (synthetic.md5sum(blob), plt_cfg['blob'])
+    with open(md5_list, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+    # the cached blob no longer matches the fresh list and is fetched again
+    second = extractor(tmp_path, site, 1)
+    second.download_blobs()
+    second.check_md5()
+    assert second.md5sums[plt_cfg['blob']] == synthetic.md5sum(blob)
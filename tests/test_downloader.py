@@ -0,0 +1,111 @@
+import hashlib
+import os
+
+import pytest
+
+import downloader
+from cache import read_json, write_json
+from httpserver import LocalServer
+
+CHUNK = 4096
+
+
+@pytest.fixture
+def site(tmp_path):
+    root = tmp_path / 'site'
+    root.mkdir()
+    data = os.urandom(5 * CHUNK + 123)
+    (root / 'blob').write_bytes(data)
+    return root, data
+
+
+def md5(data):
+    return hashlib.md5(data).hexdigest()
+
+
+def test_fetch_ranges(site, tmp_path):
+    root, data = site
+    path = str(tmp_path / 'blob')
+    with LocalServer(str(root)) as server:
+        md5sum = downloader.fetch(server.url + 'blob', path,
+                                  chunk_size=CHUNK)
+    assert md5sum == md5(data)
+    with open(path, 'rb') as f:
+        assert f.read() == data
+    assert not os.path.exists(path + '.part')
+    assert not os.path.exists(path + '.part.json')
+
+
+def test_resume_from_state(site, tmp_path):
+    root, data = site
+    path = str(tmp_path / 'blob')
+    part = path + '.part'
+    with LocalServer(str(root)) as server:
+        url = server.url + 'blob'
+        # chunks 0 and 2 are recorded as done, they hold a marker rather
+        # than the served bytes so refetching them would show
+        local = bytearray(len(data))
+        local[0:CHUNK] = b'a' * CHUNK
+        local[2 * CHUNK:3 * CHUNK] = b'c' * CHUNK
+        with open(part, 'wb') as f:
+            f.write(local)
+        write_json(part + '.json', {'url': url, 'size': len(data),
+                                    'chunk_size': CHUNK, 'done': [0, 2]})
+        md5sum = downloader.fetch(url, path, chunk_size=CHUNK)
+    expected = bytearray(data)
+    expected[0:CHUNK] = b'a' * CHUNK
+    expected[2 * CHUNK:3 * CHUNK] = b'c' * CHUNK
+    with open(path, 'rb') as f:
+        assert f.read() == bytes(expected)
+    # the md5sum covers the resumed chunks as they are on disk
+    assert md5sum == md5(bytes(expected))
+
+
+def test_stale_state_starts_over(site, tmp_path):
+    root, data = site
+    path = str(tmp_path / 'blob')
+    part = path + '.part'
+    with LocalServer(str(root)) as server:
+        url = server.url + 'blob'
+        with open(part, 'wb') as f:
+            f.write(b'x' * len(data))
+        # recorded with another chunk size, none of it can be trusted
+        write_json(part + '.json', {'url': url, 'size': len(data),
+                                    'chunk_size': CHUNK * 2, 'done': [0]})
+        md5sum = downloader.fetch(url, path, chunk_size=CHUNK)
+    assert md5sum == md5(data)
+    with open(path, 'rb') as f:
+        assert f.read() == data
+
+
+def test_range_fallback(site, tmp_path):
+    root, data = site
+    path = str(tmp_path / 'blob')
+    part = path + '.part'
+    # a partial download cannot be continued without Range support
+    with open(part, 'wb') as f:
+        f.write(b'x' * CHUNK)
+    with LocalServer(str(root), ranges=False) as server:
+        url = server.url + 'blob'
+        assert downloader.probe(url) == (len(data), False)
+        md5sum = downloader.fetch(url, path, chunk_size=CHUNK)
+    assert md5sum == md5(data)
+    with open(path, 'rb') as f:
+        assert f.read() == data
+    assert read_json(part + '.json') is None
+
+
+def test_verify_failure_discards(site, tmp_path):
+    root, data = site
+    path = str(tmp_path / 'blob')
+
+    def verify(part, md5sum):
+        raise RuntimeError('bad download')
+
+    with LocalServer(str(root)) as server:
+        with pytest.raises(RuntimeError):
+            downloader.fetch(server.url + 'blob', path, chunk_size=CHUNK,
+                             verify=verify)
+    assert not os.path.exists(path)
+    assert not os.path.exists(path + '.part')
+    assert not os.path.exists(path + '.part.json')
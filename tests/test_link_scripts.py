@@ -0,0 +1,59 @@
+import pytest
+
+import build
+
+MESSAGES = '>> "%PREFIX%\\.messages.txt" 2>&1'
+
+
+def dll_names(version):
+    """The names of the dlls the cudatoolkit link scripts of version list,
+    as the windows config formats them
+    """
+    ver_cfg = build.config[version]
+    plt_cfg = ver_cfg['windows']
+    names = []
+    for pkg, libs in ver_cfg['pkg_libs'].items():
+        if pkg == 'nvvm':
+            names.append(plt_cfg['nvvm_lib_fmt'].format('nvvm'))
+        elif pkg == 'nvtx':
+            names += [plt_cfg['nvtoolsext_fmt'].format(lib) for lib in libs]
+        else:
+            names += [plt_cfg['cuda_lib_fmt'].format(lib) for lib in libs]
+    return sorted(names)
+
+
+@pytest.mark.parametrize('version, expected', [
+    ('7.5', ['cublas64_75.dll', 'nvvm64_30_0.dll']),
+    ('8.0', ['cublas64_80.dll', 'nvToolsExt64_1.dll', 'nvvm64_31_0.dll']),
+    ('9.0', ['cublas64_90.dll', 'nvToolsExt64_1.dll', 'nvvm64_32_0.dll']),
+    ('9.1', ['cublas64_91.dll', 'nvToolsExt64_1.dll', 'nvvm64_32_0.dll']),
+])
+def test_naming(version, expected):
+    names = dll_names(version)
+    assert set(expected) <= set(names)
+    if version == '7.5':
+        assert not any(n.startswith('nvToolsExt') for n in names)
+    post_link, pre_unlink = build.windows_link_scripts(names)
+    post_lines = post_link.splitlines()
+    pre_lines = pre_unlink.splitlines()
+    for name in names:
+        src = '"%PREFIX%\\Library\\bin\\{}"'.format(name)
+        dst = '"%PREFIX%\\DLLs\\{}"'.format(name)
+        link = '  mklink /H {1} {0} || copy /Y {0} {1}'.format(src, dst)
+        assert post_lines.count(link) == 1
+        assert pre_lines.count('  del /F /Q ' + dst) == 1
+    assert post_lines[:3] == [
+        '@echo off', 'if not exist "%PREFIX%\\DLLs" mkdir "%PREFIX%\\DLLs"',
+        '(']
+    assert pre_lines[:2] == ['@echo off', '(']
+    # a single redirection of the whole block in each script
+    for lines in (post_lines, pre_lines):
+        assert lines[-1] == ') ' + MESSAGES
+        assert sum(MESSAGES in line for line in lines) == 1
+    assert len(post_lines) == len(names) + 4
+    assert len(pre_lines) == len(names) + 3
+
+
+def test_empty_package():
+    post_link, pre_unlink = build.windows_link_scripts([])
+    assert post_link == pre_unlink == '@echo off\n'
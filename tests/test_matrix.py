@@ -0,0 +1,88 @@
+import os
+
+import pytest
+
+import build
+import matrix
+import synthetic
+from cache import StagedCache
+from httpserver import LocalServer
+from phasetrace import PhaseTracer
+
+
+@pytest.fixture
+def site(tmp_path, monkeypatch):
+    monkeypatch.setenv('CUDATOOLKIT_CACHE_DIR', str(tmp_path / 'cache'))
+    for var in ('CUDATOOLKIT_MIRROR', 'CUDATOOLKIT_BLOB_CACHE_DIR',
+                'CUDATOOLKIT_SLIM', 'CUDATOOLKIT_EXTRACT_MODE'):
+        monkeypatch.delenv(var, raising=False)
+    root = str(tmp_path / 'site')
+    with LocalServer(root) as server:
+        ver_cfg, plt_cfg = synthetic.build_site(
+            root, server.url, '9.1', 'linux', build.config['9.1'],
+            build.config['9.1']['linux'], lib_size=4096, filler_size=4096)
+        monkeypatch.setitem(build.config, '9.1', dict(ver_cfg, linux=plt_cfg))
+        yield
+
+
+def run(tmp_path, number):
+    tracer = PhaseTracer()
+    tasks = matrix.version_tasks('9.1', 'linux',
+                                 str(tmp_path / ('out%d' % number)),
+                                 str(tmp_path / ('src%d' % number)), tracer,
+                                 StagedCache(str(tmp_path / 'cache')))
+    matrix.Scheduler({'network': 1, 'cpu': 2, 'disk': 2}).run(tasks)
+    return tracer
+
+
+def phases(tracer, name):
+    return sorted(ev['cat'] for ev in tracer.events if ev['name'] == name)
+
+
+def test_cached_rerun_skips_extract(tmp_path, site, monkeypatch):
+    run(tmp_path, 0)
+    lib = tmp_path / 'out0' / '9.1' / 'cublas' / 'lib'
+    assert any(fn.startswith('libcublas.so') for fn in os.listdir(str(lib)))
+
+    def extract_cached(self, cache):
+        raise AssertionError('extracted with every output cached')
+
+    monkeypatch.setattr(build.Extractor, 'extract_cached', extract_cached)
+    tracer = run(tmp_path, 1)
+    assert phases(tracer, 'copy') == []
+    staged = tmp_path / 'out1' / '9.1'
+    assert sorted(os.listdir(str(staged / 'cublas' / 'lib'))) == \
+        sorted(os.listdir(str(lib)))
+    assert (staged / 'manifests' / 'cudatoolkit.json').is_file()
+
+
+def test_miss_extracts(tmp_path, site):
+    run(tmp_path, 0)
+    # losing the payload of one output extracts again, for that output only
+    cache = StagedCache(str(tmp_path / 'cache'))
+    key = next(fn for fn in sorted(os.listdir(cache.root))
+               if cache.lookup(fn) is not None)
+    cache.discard(key)
+    tracer = run(tmp_path, 1)
+    assert phases(tracer, 'extract') == ['cudatoolkit-9.1']
+    assert len(phases(tracer, 'copy')) == 1
+    outputs = len(build.config['9.1']['pkg_libs']) + 1
+    assert len(phases(tracer, 'manifest')) == outputs
+
+
+def test_planned_once(tmp_path, site, monkeypatch):
+    plans = []
+    plan = build.Extractor.plan
+
+    def counted(self, pkg_names):
+        plans.append(sorted(pkg_names))
+        return plan(self, pkg_names)
+
+    monkeypatch.setattr(build.Extractor, 'plan', counted)
+    tracer = run(tmp_path, 0)
+    assert plans == [sorted(build.config['9.1']['pkg_libs'])]
+    assert phases(tracer, 'plan') == ['cudatoolkit-9.1']
+    outputs = len(build.config['9.1']['pkg_libs']) + 1
+    assert len(phases(tracer, 'copy')) == outputs
+    index = tmp_path / 'out0' / '9.1' / 'cublas' / 'lib' / 'cudatoolkit-libs'
+    assert (index / 'cublas.json').is_file()
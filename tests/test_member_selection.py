@@ -0,0 +1,104 @@
+import os
+
+import pytest
+
+import build
+
+
+@pytest.fixture
+def extractor(tmp_path):
+    ver_config = build.config['9.1']
+    return build.LinuxExtractor('9.1', ver_config, ver_config['linux'],
+                                prefix=str(tmp_path / 'prefix'),
+                                src_dir=str(tmp_path / 'src'),
+                                cache_dir=str(tmp_path / 'cache'))
+
+
+@pytest.mark.parametrize('name, rel', [
+    ('lib64/libcublas.so.9.1.85', 'lib64/libcublas.so.9.1.85'),
+    ('lib64/libcublas.so', 'lib64/libcublas.so'),
+    ('nvvm/lib64/libnvvm.so.3.2.0', 'nvvm/lib64/libnvvm.so.3.2.0'),
+    ('nvvm/libdevice/libdevice.10.bc', 'nvvm/libdevice/libdevice.10.bc'),
+    ('extras/CUPTI/lib64/libcupti.so.9.1.85', 'lib64/libcupti.so.9.1.85'),
+])
+def test_selected(extractor, name, rel):
+    assert extractor._member_selector()(name) == os.path.join(*rel.split('/'))
+
+
+@pytest.mark.parametrize('name', [
+    # not a library any package needs
+    'lib64/libcudadevrt.a',
+    'lib64/libOpenCL.so.1',
+    'doc/pdf/CUDA_Toolkit_Release_Notes.pdf',
+    # the right names in the wrong directories
+    'libcublas.so.9.1.85',
+    'samples/lib64/libcublas.so.9.1.85',
+    'extras/Debugger/lib64/libcudart.so.9.1.85',
+    'nvvm/lib64/libcublas.so.9.1.85',
+    'lib64/libnvvm.so.3.2.0',
+    'lib64/stubs/libcublas.so',
+])
+def test_not_selected(extractor, name):
+    assert extractor._member_selector()(name) is None
+
+
+def test_duplicate_destination(extractor):
+    select = extractor._member_selector()
+    select('extras/CUPTI/lib64/libcupti.so.9.1.85')
+    # the same member listed again is fine
+    select('extras/CUPTI/lib64/libcupti.so.9.1.85')
+    with pytest.raises(ValueError):
+        select('lib64/libcupti.so.9.1.85')
+    # a new selector, as for a patch, may replace it
+    assert extractor._member_selector()('lib64/libcupti.so.9.1.85')
+
+
+def test_extract_selective(extractor, tmp_path, linux_src):
+    extractor.src_dir = linux_src[2]
+    extractor.extract_selective(str(tmp_path / 'store'))
+    cuda, nvvm, libdevice = extractor.lib_dirs()
+    names = os.listdir(cuda)
+    assert 'libcupti.so.9.1.99' in names
+    assert 'filler.pdf' not in names
+    # the patch adds a newer cublas alongside the blob's and relinks it
+    assert 'libcublas.so.9.1.99' in names
+    assert os.readlink(os.path.join(cuda, 'libcublas.so.9.1')) == \
+        'libcublas.so.9.1.99.100'
+    assert os.path.isfile(os.path.join(nvvm, 'libnvvm.so.9.1.99'))
+    assert os.listdir(libdevice) == ['libdevice.10.bc']
+
+
+def test_installer_fallback(extractor, tmp_path, monkeypatch):
+    src = tmp_path / 'src'
+    src.mkdir()
+    for fn in [extractor.cu_blob] + extractor.patches:
+        (src / fn).write_bytes(b'')
+    monkeypatch.chdir(str(src))
+    monkeypatch.delenv('CUDATOOLKIT_USE_INSTALLER', raising=False)
+    monkeypatch.delenv('CUDATOOLKIT_EXTRACT_MODE', raising=False)
+    extract_dir = tmp_path / 'extract'
+    extract_dir.mkdir()
+
+    def duplicate(extract_dir):
+        # a member is written before the selection fails
+        os.makedirs(os.path.join(extract_dir, 'lib64'))
+        select = extractor._member_selector()
+        for name in ('extras/CUPTI/lib64/libcupti.so.9.1.85',
+                     'lib64/libcupti.so.9.1.85'):
+            with open(os.path.join(extract_dir, select(name)), 'wb'):
+                pass
+
+    installed = []
+
+    def installer(args):
+        installed.append((os.path.basename(args[0]),
+                          os.listdir(str(extract_dir))))
+
+    monkeypatch.setattr(extractor, 'extract_selective', duplicate)
+    monkeypatch.setattr(build, 'check_call', installer)
+    extractor.extract(str(extract_dir))
+    assert [runfile for runfile, found in installed] == \
+        [extractor.cu_blob] + extractor.patches
+    # the installer ran into an empty directory
+    assert installed[0][1] == []
+    assert extractor.store == str(extract_dir)
@@ -0,0 +1,119 @@
+import hashlib
+import os
+from pathlib import Path
+
+import pytest
+
+import build
+import downloader
+from httpserver import LocalServer
+
+UPSTREAM = ('http://developer.download.nvidia.com/compute/cuda/9.1/Prod/'
+            'local_installers/cuda_9.1.85_387.26_linux')
+
+
+def test_mirror_path():
+    assert downloader.mirror_path(UPSTREAM) == os.path.join(
+        'developer.download.nvidia.com', 'compute', 'cuda', '9.1', 'Prod',
+        'local_installers', 'cuda_9.1.85_387.26_linux')
+    assert downloader.mirror_path('https://host:8080/a//b%20c?x=1') == \
+        os.path.join('host:8080', 'a', 'b c')
+
+
+def test_mirror_url(tmp_path):
+    rel = ('developer.download.nvidia.com/compute/cuda/9.1/Prod/'
+           'local_installers/cuda_9.1.85_387.26_linux')
+    for root in ('http://mirror/cuda', 'http://mirror/cuda/'):
+        assert downloader.mirror_url(root, UPSTREAM) == \
+            'http://mirror/cuda/' + rel
+    # a directory is a file url of its absolute path
+    root = tmp_path / 'cuda mirror'
+    assert downloader.mirror_url(str(root), UPSTREAM) == \
+        root.as_uri() + '/' + rel
+    assert downloader.mirror_url(root.as_uri(), UPSTREAM) == \
+        root.as_uri() + '/' + rel
+    # the path in the mirror is quoted again
+    assert downloader.mirror_url('http://mirror', 'http://host/a%20b') == \
+        'http://mirror/host/a%20b'
+
+
+@pytest.fixture
+def upstream(tmp_path):
+    root = tmp_path / 'upstream'
+    (root / 'cuda').mkdir(parents=True)
+    data = os.urandom(10000)
+    (root / 'cuda' / 'blob').write_bytes(data)
+    with LocalServer(str(root)) as server:
+        yield server.url + 'cuda/blob', data
+
+
+def extractor(tmp_path, monkeypatch, mirror):
+    monkeypatch.setenv('CUDATOOLKIT_MIRROR', mirror)
+    src_dir = tmp_path / 'src'
+    src_dir.mkdir()
+    return build.LinuxExtractor('9.1', build.config['9.1'],
+                                build.config['9.1']['linux'],
+                                prefix=str(tmp_path / 'prefix'),
+                                src_dir=str(src_dir),
+                                cache_dir=str(tmp_path / 'cache'))
+
+
+def mirrored(mirror, url, data):
+    path = Path(mirror, downloader.mirror_path(url))
+    path.parent.mkdir(parents=True)
+    path.write_bytes(data)
+
+
+def fetched(ext, url, verify=None):
+    path = os.path.join(ext.src_dir, 'blob')
+    md5sum = ext.fetch_mirrored(url, path, verify)
+    with open(path, 'rb') as f:
+        data = f.read()
+    assert md5sum == hashlib.md5(data).hexdigest()
+    return data
+
+
+@pytest.mark.parametrize('as_url', [False, True])
+def test_from_mirror(tmp_path, monkeypatch, upstream, as_url):
+    url, data = upstream
+    mirror = tmp_path / 'mirror'
+    mirrored(mirror, url, b'mirrored')
+    root = mirror.as_uri() if as_url else str(mirror)
+    ext = extractor(tmp_path, monkeypatch, root)
+    assert fetched(ext, url) == b'mirrored'
+
+
+def test_missing_from_mirror(tmp_path, monkeypatch, upstream):
+    url, data = upstream
+    mirror = tmp_path / 'mirror'
+    mirror.mkdir()
+    ext = extractor(tmp_path, monkeypatch, str(mirror))
+    assert fetched(ext, url) == data
+
+
+def test_bad_copy_in_mirror(tmp_path, monkeypatch, upstream):
+    url, data = upstream
+    mirror = tmp_path / 'mirror'
+    mirrored(mirror, url, b'<html>Not Found</html>')
+    good = hashlib.md5(data).hexdigest()
+
+    def verify(part, md5sum):
+        if md5sum != good:
+            raise RuntimeError("md5sum mismatch for blob: %s" % md5sum)
+        return True
+
+    ext = extractor(tmp_path, monkeypatch, str(mirror))
+    assert fetched(ext, url, verify) == data
+
+
+def test_http_mirror(tmp_path, monkeypatch, upstream):
+    url, data = upstream
+    mirror = tmp_path / 'mirror'
+    mirrored(mirror, url, b'mirrored')
+    with LocalServer(str(mirror)) as server:
+        ext = extractor(tmp_path, monkeypatch, server.url)
+        assert fetched(ext, url) == b'mirrored'
+        # a file the http mirror does not serve comes from upstream
+        os.remove(os.path.join(str(mirror), downloader.mirror_path(url)))
+        os.remove(os.path.join(ext.src_dir, 'blob'))
+        assert fetched(ext, url) == data
@@ -0,0 +1,50 @@
+import os
+
+import build
+from cache import ExtractCache
+from phasetrace import DiskMeter, disk_metering
+
+
+def test_disk_metering(monkeypatch):
+    monkeypatch.delenv('CUDATOOLKIT_TRACE_DIR', raising=False)
+    monkeypatch.delenv('CUDATOOLKIT_PROFILE', raising=False)
+    assert not disk_metering()
+    monkeypatch.setenv('CUDATOOLKIT_PROFILE', '1')
+    assert disk_metering()
+
+
+def test_disk_meter_peak(tmp_path):
+    path = tmp_path / 'extract'
+    path.mkdir()
+    with DiskMeter(str(path), interval=0.001, max_interval=0.01) as meter:
+        (path / 'big').write_bytes(os.urandom(1 << 20))
+        (path / 'big').unlink()
+        (path / 'small').write_bytes(b'x')
+    assert meter.final < 1 << 20
+    assert meter.peak >= meter.final
+
+
+def extract_cached(tmp_path, monkeypatch, run):
+    ver_config = build.config['9.1']
+    extractor = build.LinuxExtractor('9.1', ver_config, ver_config['linux'],
+                                     prefix=str(tmp_path / 'prefix'),
+                                     src_dir=str(tmp_path / 'src'),
+                                     cache_dir=str(tmp_path / 'cache'))
+    extractor.md5sums = {fn: str(run) * 32 for fn in
+                         [extractor.cu_blob] + extractor.patches}
+
+    def extract(extract_dir):
+        extractor.store = extract_dir
+
+    monkeypatch.setattr(extractor, 'extract', extract)
+    extractor.extract_cached(ExtractCache(str(tmp_path / 'cache')))
+    return extractor
+
+
+def test_extract_metered_only_when_traced(tmp_path, monkeypatch):
+    monkeypatch.delenv('CUDATOOLKIT_TRACE_DIR', raising=False)
+    monkeypatch.delenv('CUDATOOLKIT_PROFILE', raising=False)
+    assert extract_cached(tmp_path, monkeypatch, 0).extract_peak_bytes is None
+    monkeypatch.setenv('CUDATOOLKIT_TRACE_DIR', str(tmp_path / 'traces'))
+    assert extract_cached(tmp_path, monkeypatch, 1).extract_peak_bytes \
+        is not None
@@ -0,0 +1,62 @@
+import os
+
+import pytest
+
+import build
+from stage import stage_file, unshared
+
+
+@pytest.fixture
+def src(tmp_path):
+    path = tmp_path / 'libfoo.so.1'
+    path.write_bytes(b'\x7fELF' + os.urandom(1000))
+    return str(path)
+
+
+def test_auto_hardlinks(src, tmp_path):
+    dst = str(tmp_path / 'staged')
+    assert stage_file(src, dst) == 'hardlink'
+    assert os.path.samefile(src, dst)
+
+
+@pytest.mark.parametrize('mode', ['clone', 'copy', unshared('auto'),
+                                  unshared('hardlink')])
+def test_unshared(src, tmp_path, mode):
+    dst = str(tmp_path / 'staged')
+    assert stage_file(src, dst, mode) in ('reflink', 'copy')
+    assert not os.path.samefile(src, dst)
+    assert os.stat(src).st_nlink == 1
+    # editing the staged copy in place leaves the source alone
+    with open(src, 'rb') as f:
+        before = f.read()
+    with open(dst, 'r+b') as f:
+        f.write(b'patched')
+    with open(src, 'rb') as f:
+        assert f.read() == before
+
+
+def test_unknown_mode(src, tmp_path):
+    with pytest.raises(ValueError):
+        stage_file(src, str(tmp_path / 'staged'), 'symlink')
+
+
+@pytest.mark.parametrize('env, hardlink, expected', [
+    (None, False, 'clone'),
+    ('hardlink', False, 'clone'),
+    ('copy', False, 'copy'),
+    ('reflink', False, 'reflink'),
+    (None, True, 'auto'),
+    ('hardlink', True, 'hardlink'),
+])
+def test_extractor_stage_mode(tmp_path, monkeypatch, env, hardlink, expected):
+    if env is None:
+        monkeypatch.delenv('CUDATOOLKIT_STAGE_MODE', raising=False)
+    else:
+        monkeypatch.setenv('CUDATOOLKIT_STAGE_MODE', env)
+    ver_config = build.config['9.1']
+    extractor = build.LinuxExtractor('9.1', ver_config, ver_config['linux'],
+                                     prefix=str(tmp_path / 'prefix'),
+                                     src_dir=str(tmp_path / 'src'),
+                                     cache_dir=str(tmp_path / 'cache'),
+                                     hardlink=hardlink)
+    assert extractor.stage_mode == expected
@@ -0,0 +1,94 @@
+import os
+
+import pytest
+
+import build
+from cache import StagedCache
+
+
+@pytest.fixture
+def extractor(tmp_path):
+    ver_config = build.config['9.1']
+    plt_config = ver_config['linux']
+    extractor = build.LinuxExtractor('9.1', ver_config, plt_config,
+                                     prefix=str(tmp_path / 'prefix'),
+                                     src_dir=str(tmp_path / 'src'),
+                                     cache_dir=str(tmp_path / 'cache'))
+    # stands in for hashing the downloaded blobs
+    for fn in [plt_config['blob']] + plt_config['patches']:
+        extractor.md5sums[fn] = '0' * 32
+    lib = os.path.join(extractor.prefix, 'lib')
+    os.makedirs(lib)
+    with open(os.path.join(lib, 'libcublas.so.9.1.85'), 'wb') as f:
+        f.write(b'\x7fELF' + os.urandom(4096))
+    os.symlink('libcublas.so.9.1.85', os.path.join(lib, 'libcublas.so.9.1'))
+    extractor.staged = ['lib/libcublas.so.9.1.85', 'lib/libcublas.so.9.1']
+    return extractor
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_save_and_restore(extractor, tmp_path):
+    cache = StagedCache(str(tmp_path / 'cache'))
+    lib = os.path.join(extractor.prefix, 'lib', 'libcublas.so.9.1.85')
+    original = read(lib)
+    extractor.save_staged(cache, 'cublas')
+    # conda-build relocating the library in place
+    with open(lib, 'r+b') as f:
+        f.seek(100)
+        f.write(b'relocated')
+
+    restored = extractor.for_prefix(str(tmp_path / 'again'))
+    assert restored.restore_staged(cache, 'cublas') == 2
+    again = os.path.join(restored.prefix, 'lib')
+    assert read(os.path.join(again, 'libcublas.so.9.1.85')) == original
+    assert os.readlink(os.path.join(again, 'libcublas.so.9.1')) == \
+        'libcublas.so.9.1.85'
+
+
+def test_damaged_payload_is_a_miss(extractor, tmp_path):
+    cache = StagedCache(str(tmp_path / 'cache'))
+    extractor.save_staged(cache, 'cublas')
+    key = extractor.fingerprint('cublas')
+    payload = os.path.join(cache.entry(key), 'payload', 'lib',
+                           'libcublas.so.9.1.85')
+    with open(payload, 'r+b') as f:
+        f.seek(100)
+        f.write(b'relocated')
+
+    restored = extractor.for_prefix(str(tmp_path / 'again'))
+    assert restored.restore_staged(cache, 'cublas') is None
+    assert cache.lookup(key) is None
+    assert not os.path.exists(os.path.join(restored.prefix, 'lib'))
+    # the next save populates the entry again
+    extractor.save_staged(cache, 'cublas')
+    assert restored.restore_staged(cache, 'cublas') == 2
+
+
+def test_stale_fingerprints_dropped(extractor, tmp_path, monkeypatch):
+    cache = StagedCache(str(tmp_path / 'cache'))
+    extractor.save_staged(cache, 'cublas')
+    old = extractor.fingerprint('cublas')
+    # an edit to the build scripts changes every fingerprint
+    monkeypatch.setattr(build, 'scripts_digest', lambda: 'edited')
+    new = extractor.fingerprint('cublas')
+    assert new != old
+    extractor.save_staged(cache, 'cublas')
+    assert cache.lookup(old) is None
+    assert not os.path.exists(cache.entry(old))
+    assert cache.lookup(new) is not None
+
+
+def test_budget_evicts_least_recently_used(extractor, tmp_path):
+    cache = StagedCache(str(tmp_path / 'cache'), max_bytes=10000)
+    for pkg_name in ('cublas', 'cufft', 'curand'):
+        extractor.save_staged(cache, pkg_name)
+        # each entry is over 4KB, the budget holds two
+        cache.lookup(extractor.fingerprint('cublas'))
+    assert cache.lookup(extractor.fingerprint('cublas')) is not None
+    assert cache.lookup(extractor.fingerprint('cufft')) is None
+    assert not os.path.exists(cache.entry(extractor.fingerprint('cufft')))
+    assert cache.lookup(extractor.fingerprint('curand')) is not None
@@ -0,0 +1,34 @@
+import os
+
+import build
+import validate
+
+
+def test_opt_in(monkeypatch):
+    monkeypatch.delenv('CUDATOOLKIT_VALIDATE', raising=False)
+    assert not validate.enabled()
+    monkeypatch.setenv('CUDATOOLKIT_VALIDATE', '1')
+    assert validate.enabled()
+
+
+def test_synthetic_install(tmp_path, monkeypatch, linux_src):
+    monkeypatch.delenv('CUDATOOLKIT_SLIM', raising=False)
+    ver_cfg, plt_cfg, src_dir = linux_src
+    prefix = str(tmp_path / 'prefix')
+    extractor = build.LinuxExtractor('9.1', ver_cfg, plt_cfg, prefix=prefix,
+                                     src_dir=src_dir,
+                                     cache_dir=str(tmp_path / 'cache'))
+    extractor.extract_selective(str(tmp_path / 'store'))
+    pkg_names = ('cudart', 'cublas', 'nvtx', 'nvvm')
+    for pkg_name in pkg_names:
+        extractor.copy(pkg_name)
+    results = validate.validate({p: prefix for p in pkg_names}, ver_cfg,
+                                plt_cfg, 'linux', '9.1')
+    assert {p: problems for p, (n, problems, s) in results.items()} == \
+        {p: [] for p in pkg_names}
+
+    # a library staged without its SONAME link
+    os.remove(os.path.join(prefix, 'lib', 'libcudart.so.9.1'))
+    results = validate.validate({'cudart': prefix}, ver_cfg, plt_cfg,
+                                'linux', '9.1')
+    assert results['cudart'][1]